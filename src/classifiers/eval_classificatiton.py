@@ -1,9 +1,8 @@
 from classifiers.classify import classify_PlayerData
-from features.evaluate_features import get_feature_relevances
 
 
 def test_classification_accuracy(
-    config, toon_dict, dbms, n_sample_games, columns_to_remove, profile_mode, max_games_to_use
+    config, toon_dir, dbms, n_sample_games, columns_to_remove, profile_mode, max_games_to_use
 ):
     """
     Tests the classification accuracy, note that this will be easier with less people in the database.
@@ -20,7 +19,7 @@ def test_classification_accuracy(
     # First calculate feature_relevances just once with all the data, this will cause a tiny amount of usage of test
     # data but this should be highly insignificant and the alternative is that the program takes like 15 times longer
     # to run.
-    feature_relevances = get_feature_relevances(dbms.rep_feats.features)
+    feature_relevances = dbms.get_feature_relevances()
 
     n_trials = 0
     n_correct = 0
@@ -35,7 +34,7 @@ def test_classification_accuracy(
             test_player_data.features.pop(col)
 
         toon_estimate, non_barcode_toon_estimate = classify_PlayerData(
-            config, toon_dict, test_player_data, test_dbms, to_visualize=False,
+            config, toon_dir, test_player_data, test_dbms, to_visualize=False,
             pre_calculated_feature_relevances=feature_relevances
         )
         if non_barcode_toon_estimate == test_player_data.toon_race:
@@ -0,0 +1,34 @@
+import numpy as np
+
+
+# Helpers shared by the nearest neighbour classifiers, see mean_feature_classify and n_gram_classify.
+
+
+def best_games_mean(game_dists, game_players, n_players, k):
+    """
+    Aggregates the distances to single games into a distance per player, the mean of the player's k smallest ones (or
+    of all of them if the player has fewer games). Done for all games at once by sorting them by player and distance.
+    @param game_players: np.ndarray with the player (0 to n_players - 1) of each game.
+    @return: np.ndarray with the distance of each player, inf for players without games.
+    """
+    if len(game_dists) == 0:
+        return np.full(n_players, np.inf)
+    game_dists = np.asarray(game_dists, dtype=np.float64)
+    # Sorted by player, and by distance within each player.
+    order = np.lexsort((game_dists, game_players))
+    n_games = np.bincount(game_players, minlength=n_players)
+    rank_in_player = np.arange(len(order)) - np.repeat(np.cumsum(n_games) - n_games, n_games)
+    best = order[rank_in_player < k]
+    sums = np.bincount(game_players[best], weights=game_dists[best], minlength=n_players)
+    counts = np.bincount(game_players[best], minlength=n_players)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.inf)
+
+
+def closest_indices(dists, k):
+    """@return: the indices of the k smallest distances, sorted by distance, without sorting all of them."""
+    if k < len(dists):
+        indices = np.argpartition(dists, k)[:k]
+    else:
+        indices = np.arange(len(dists))
+    return indices[np.argsort(dists[indices], kind="stable")]
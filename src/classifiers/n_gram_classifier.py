@@ -3,12 +3,13 @@ import numpy as np
 from sklearn.preprocessing import normalize
 
 from features.player_dataclass import PlayerData
-from utils.utils import toon_race_to_toon, is_barcode
+from classifiers.k_nearest import best_games_mean, closest_indices
+from utils.utils import toon_race_to_race
 
 
-def n_gram_log_prob(X, Y, c):
+def n_gram_log_probs(log_prob_matrix, Y_columns, sum_Y, c):
     """
-    Performs the operation
+    Performs the operation below for many X at once, one per row of log_prob_matrix.
 
     The idea of this function is as follows.
 
@@ -95,44 +96,103 @@ def n_gram_log_prob(X, Y, c):
     easy to access. The final equation is then
 
          log_sequence_prob = log(c) * (sum(Y) - sum(Y2)) + log(X2+c)*Y2
+
+    Each row of log_prob_matrix holds log(X+c) - log(c) (see NGrams.race_log_prob_matrix), which is 0 in section 0, so
+
+        log_sequence_prob = log(c) * sum(Y) + (log(X2+c) - log(c))*Y2
+
+    where the last term is the matrix-vector product since the matrix is 0 wherever X is.
+    The matrix only has columns for the n_grams in the database (see NGramVocabulary), the n_grams of Y that are not
+    among them are in section 0 of every X, so they only count towards sum(Y).
+    @param Y_columns: csr_array of shape (1, n_columns), Y in the columns of log_prob_matrix.
+    @param sum_Y: the sum of all of Y.
+    @return: np.array with the log_sequence_prob of each row.
+    """
+    return log_prob_matrix @ Y_columns.toarray().ravel() + np.log(c) * sum_Y
+
+
+def n_gram_candidates(log_prob_matrix, inverted_index, column_max, Y_columns, sum_Y, c, budget, n_closest):
+    """
+    Finds the n_closest players (highest log_sequence_prob of n_gram_log_probs) without scoring all of them, when
+    possible.
+
+    The n_grams of Y are gone through from the most distinctive (had by the fewest players) to the least, adding up
+    each player's part of the matrix-vector product of n_gram_log_probs from the inverted index. Once budget players
+    have been found, the budget players with the highest partial products are the candidates and are scored exactly.
+    Since the matrix is never negative, no other player can get more than its partial product plus column_max*Y over
+    the n_grams that are left, so the n_grams are gone through until no other player can beat the n_closest best
+    candidates. If that does not happen before all n_grams are gone through, the partial products are then exact
+    for every player, so all players are returned instead.
+    @param inverted_index, column_max: see NGrams.race_inverted_index.
+    @return: (players, dists) where players are rows of log_prob_matrix, which include the n_closest closest, and
+    dists their distances (-log_sequence_prob).
+    """
+    n_players = log_prob_matrix.shape[0]
+    y = Y_columns.data
+    columns = Y_columns.indices
+    order = np.argsort(np.diff(inverted_index.indptr)[columns], kind="stable")
+    # remaining[step] is the most that the n_grams order[step:] can add to the product of any player.
+    upper_bounds = y[order] * column_max[columns[order]]
+    remaining = np.append(np.cumsum(upper_bounds[::-1])[::-1], 0)
+    constant = np.log(c) * sum_Y
+
+    partial = np.zeros(n_players)
+    found = np.zeros(n_players, dtype=bool)
+    n_found = 0
+    candidates = None
+    for step, i in enumerate(order):
+        start, end = inverted_index.indptr[columns[i]], inverted_index.indptr[columns[i] + 1]
+        players = inverted_index.indices[start:end]
+        partial[players] += y[i] * inverted_index.data[start:end]
+        n_found += len(players) - np.count_nonzero(found[players])
+        found[players] = True
+
+        if candidates is None and n_found >= budget:
+            candidates = np.flatnonzero(found)
+            candidates = candidates[np.argpartition(-partial[candidates], budget - 1)[:budget]]
+            dists = -(log_prob_matrix[candidates] @ Y_columns.toarray().ravel() + constant)
+            if n_closest > len(candidates):
+                return np.arange(n_players), -n_gram_log_probs(log_prob_matrix, Y_columns, sum_Y, c)
+            threshold = -np.partition(dists, n_closest - 1)[n_closest - 1] - constant
+            others = np.ones(n_players, dtype=bool)
+            others[candidates] = False
+        # Partial products never decrease, so the maximum of the others only has to be checked when it could pass.
+        if candidates is not None and remaining[step + 1] <= threshold:
+            if remaining[step + 1] + np.max(partial[others], initial=0) <= threshold:
+                return candidates, dists
+
+    # Every n_gram has been gone through without ruling out the other players, so the products are exact.
+    return np.arange(n_players), -(partial + constant)
+
+
+def _closest_non_barcodes(toon_dir, toons, players, dists, n_non_barcodes):
+    """
+    Only the closest players are sorted, enough of them to find n_non_barcodes non-barcode players.
+    @param toons: the toon of each player id, see PlayerKeys.toons.
+    @param players: the ids of the players that dists belong to.
+    @return: (closest, barcode) the indices into dists of the closest players sorted by distance, and whether each
+    one is a barcode.
     """
-    # SPEEDUP: instead of repeating this function many times I can call it with the entire db_v n_grams rather than
-    # repeating it for every player, will allow me to sort less and remove the slow df.addition appending in
-    # the process.
-
-    # First sort the indices and make the data follow the same shuffling
-    perm = X.indices.argsort()
-    X_ind = X.indices[perm]
-    X_data = X.data[perm]
-    perm = Y.indices.argsort()
-    Y_ind = Y.indices[perm]
-    Y_data = Y.data[perm]
-
-    # Get np vectors Y_2 and X_2, using Y_1 = Y[:, section_2_ind] on a csr array was very slow, and I could not find
-    # similar syntax for dok / lil, so I do it myself instead.
-    X_ind_set = set(X_ind)
-    Y_ind_set = set(Y_ind)
-    q = [i in X_ind_set for i in Y_ind]
-    Y_2 = Y_data[q]
-    q = [i in Y_ind_set for i in X_ind]
-    X_2 = X_data[q]
-
-    dot_prod = np.dot(np.log(X_2 + c), Y_2)
-    sum_Y2 = np.sum(Y_2)
-    sum_Y = np.sum(Y.data)
-    log_seq_prob = np.log(c) * (sum_Y - sum_Y2) + dot_prod
-    return log_seq_prob
-
-
-def n_gram_classify(config, toon_dict, player_data: PlayerData, n_gram_means, to_visualize: bool):
+    k = n_non_barcodes
+    while True:
+        closest = closest_indices(dists, k)
+        barcode = np.array(
+            [toon_dir.is_barcode(toons[players[i]]) for i in closest], dtype=bool
+        )
+        if np.sum(~barcode) >= n_non_barcodes or k >= len(dists):
+            return closest, barcode
+        k *= 2
+
+
+def n_gram_classify(config, toon_dir, player_data: PlayerData, n_grams, to_visualize: bool):
     """
-    Performs the classification of one of the players in a replay using its player_data and a given dbms.
+    Performs the classification of one of the players in a replay using its player_data and the n_grams of a dbms.
 
     Can also return extra information for other functions such as for visualization.
 
     @param to_visualize: Whether to create visualizations of the result.
     @param player_data: PlayerData instance.
-    @param dbms: DBMS instance.
+    @param n_grams: NGrams instance, normally dbms.n_grams.
     @return: estimate, non_barcode_estimate.
     """
 
@@ -140,55 +200,85 @@ def n_gram_classify(config, toon_dict, player_data: PlayerData, n_gram_means, to
     n = 4
 
     # Get the normalized n_gram for the test player
-    df = player_data.n_grams[n - 1]
-    ser = df["sparse_n_gram"]
-    test_csr_unnormalized = ser.iloc[0]
+    test_csr_unnormalized = player_data.n_grams[n - 1]
     test_v = normalize(test_csr_unnormalized, norm="l1", axis=1)
 
-    n_gram_dim = test_v.shape[1]
     lowest_prob = 0.001
 
-    # Build up results_df, which will have index toon_race and columns dist and barcode.
-    results_df = pd.DataFrame()
-    db_n_grams = n_gram_means[n - 1]
-    for toon_race, db_v in db_n_grams.items():
-        log_seq_prob = n_gram_log_prob(db_v, test_v, lowest_prob)
-        dist = -log_seq_prob
-
-        # check if barcode
-        toon = toon_race_to_toon(toon_race)
-        names = toon_dict[toon]
-        barcode = True
-        for name in names:
-            if not is_barcode(name):
-                barcode = False
-
-        # set up the addition_df with the data.
-        data = {"barcode": barcode, "dist": dist}
-        addition_df = pd.DataFrame(data, index=[toon_race])
-        results_df = pd.concat([results_df, addition_df])
-
-    # Sort by distance with the lowest distance first.
-    results_df = results_df.sort_values(by=["dist"])
+    race = toon_race_to_race(player_data.toon_race)
+    # In the instance-based mode the barcode is compared to every game instead of to the mean of each player.
+    instance_based = config["options"]["INSTANCE_BASED"]
+    if instance_based:
+        toon_race_ids, game_players, log_prob_matrix = n_grams.race_game_log_prob_matrix(race, n, lowest_prob)
+    else:
+        toon_race_ids, log_prob_matrix = n_grams.race_log_prob_matrix(race, n, lowest_prob)
+    if len(toon_race_ids) == 0:
+        print("WARNING: There are no players of this race in the database, try loading more replays into the database.")
+        return False, False
+    # The vocabulary might have grown (from games of another race) since the matrix was built, no player of the matrix
+    # has those n_grams so they only count towards sum_Y.
+    test_v_columns = n_grams.to_columns(n, test_v)[:, : log_prob_matrix.shape[1]]
+    sum_Y = np.sum(test_v.data)
+    n_non_barcodes = config["options"]["NEIGHBOURS_TO_PRINT"] if to_visualize else 1
+    player_keys = n_grams.player_keys
+
+    # With many players, only score the candidates from the inverted index if that gives the same result.
+    budget = config["options"]["N_GRAM_CANDIDATE_BUDGET"]
+    if instance_based:
+        # Score all games of the race at once, each player gets the mean distance of their closest games.
+        candidates = np.arange(len(toon_race_ids))
+        game_dists = -n_gram_log_probs(log_prob_matrix, test_v_columns, sum_Y, lowest_prob)
+        dists = best_games_mean(game_dists, game_players, len(toon_race_ids), config["options"]["INSTANCE_TOP_K_GAMES"])
+        closest, barcode = _closest_non_barcodes(
+            toon_dir, player_keys.toons, toon_race_ids[candidates], dists, n_non_barcodes
+        )
+    elif 0 < budget < len(toon_race_ids):
+        inverted_index, column_max = n_grams.race_inverted_index(race, n, lowest_prob)
+        n_closest = n_non_barcodes
+        while True:
+            candidates, dists = n_gram_candidates(
+                log_prob_matrix, inverted_index, column_max, test_v_columns, sum_Y, lowest_prob, budget, n_closest
+            )
+            closest, barcode = _closest_non_barcodes(
+                toon_dir, player_keys.toons, toon_race_ids[candidates], dists, n_non_barcodes
+            )
+            # Barcodes among the closest players push the needed non-barcodes further down.
+            needed = np.flatnonzero(~barcode)[:n_non_barcodes]
+            if len(candidates) == len(toon_race_ids) or (len(needed) == n_non_barcodes and needed[-1] < n_closest):
+                break
+            n_closest = needed[-1] + 1 if len(needed) == n_non_barcodes else len(toon_race_ids)
+    else:
+        # Score all players of the race at once.
+        candidates = np.arange(len(toon_race_ids))
+        dists = -n_gram_log_probs(log_prob_matrix, test_v_columns, sum_Y, lowest_prob)
+        closest, barcode = _closest_non_barcodes(
+            toon_dir, player_keys.toons, toon_race_ids[candidates], dists, n_non_barcodes
+        )
 
     # find toon estimate
-    toon_estimate = results_df.iloc[0].name
-    if len(results_df) == 0:
-        print("WARNING: There was only one player of this race in the database, try loading more replays into the database.")
-    toon_estimate_dist = results_df.iloc[0]["dist"]
+    players = toon_race_ids[candidates]
+    toon_estimate = player_keys[players[closest[0]]]
+    toon_estimate_dist = dists[closest[0]]
 
     # sort out barcodes
-    results_df.drop(results_df[results_df["barcode"] == True].index, inplace=True)
-    if len(results_df) == 0:
+    closest = closest[~barcode]
+    if len(closest) == 0:
         print("WARNING: There was no non-barcode players of this race in the database, try loading more replays into the database.")
-    non_barcode_toon_estimate = results_df.iloc[0].name
+        return toon_estimate, False
+    non_barcode_toon_estimate = player_keys[players[closest[0]]]
 
     if to_visualize:
-        results_df['names'] = list(map(lambda x: str(toon_dict[toon_race_to_toon(x)]), results_df.index))
+        # Build up results_df, which will have index toon_race and columns barcode, dist and names.
+        closest = closest[:n_non_barcodes]
+        results_df = pd.DataFrame(
+            {"barcode": False, "dist": dists[closest]},
+            index=[player_keys[players[i]] for i in closest],
+        )
+        results_df['names'] = [str(toon_dir[player_keys.toons[players[i]]]) for i in closest]
 
         print("--------------------")
         print("N-gram classification result:")
-        print(f"closest non-barcode: {toon_dict[toon_race_to_toon(non_barcode_toon_estimate)]}")
+        print(f"closest non-barcode: {toon_dir[player_keys.toons[players[closest[0]]]]}")
         print(f"closest distance INCLUDING other barcodes: {toon_estimate_dist:.6f}")
         print("Table results:")
         print(results_df.head(config["options"]["NEIGHBOURS_TO_PRINT"]))
@@ -1,89 +1,181 @@
-import copy
-
 import numpy as np
 import pandas as pd
 
-from utils.utils import get_toon_dict, is_barcode, toon_race_to_toon, is_toon_barcode
-from features.utils_features import add_name_to_toon_dict
 from features.player_dataclass import PlayerData
+from classifiers.k_nearest import best_games_mean, closest_indices
+
 
+class MeanFeatureIndex:
+    """
+    The mean features of the players of one race, already scaled for mean_feature_classify so that a query only has to
+    scale the barcode's features. Build it once per race and reuse it until the features change, see
+    DBMS.get_feature_index().
+
+    Each feature is scaled to min 0 and max 1 over the players, and then divided by the square root of its relevance to
+    put extra emphasis on the better features. Features with standard deviation 0 over the players (or no relevance)
+    are left out, should typically not happen, but maybe I will e.g. use a rare feature that is almost always 0.
+
+    self.columns: [feature, ...] the features that are used, in column order.
+    self.min_feat / self.range / self.weight: per column, scaled = (value - min_feat) / range * weight where weight
+    is 1 / sqrt(relevance).
+    self.matrix: float32 np.ndarray of the scaled means with a row per player, 0 where the player's mean is NaN.
+    self.has_value: float32 np.ndarray, 1 where the player's mean is a number and 0 where it is NaN. A NaN adds nothing
+    to the distance, like pandas sums that skip NaN.
+    self.toon_race_ids: np.ndarray of the player id of each row, see PlayerKeys.
+    self.toon_races / self.toons: np.ndarray of the toon_race and toon of each row, for showing the results.
+    self.is_barcode: bool np.ndarray, whether each row is a barcode.
+    """
 
-def mean_feature_classify(config, toon_dict, player_data: PlayerData, features_mean: pd.DataFrame, feature_relevances,
+    def __init__(self, features_mean: pd.DataFrame, feature_relevances, player_keys, toon_dir):
+        """
+        @param features_mean: pd.DataFrame with toon_race_id as index and the mean of each feature as columns.
+        @param feature_relevances: pd.Series {feature: relevance}, see get_feature_relevances.
+        @param player_keys: PlayerKeys that the toon_race_ids refer to, normally dbms.player_keys.
+        """
+        min_feat = features_mean.min()
+        max_feat = features_mean.max()
+        std = features_mean.std()
+        relevances = pd.Series(feature_relevances).reindex(features_mean.columns)
+        is_used = (std > 0) & (relevances > 0) & np.isfinite(relevances)
+        self.columns = list(features_mean.columns[is_used])
+        self.min_feat = min_feat[is_used].to_numpy(dtype=np.float64)
+        self.range = (max_feat - min_feat)[is_used].to_numpy(dtype=np.float64)
+        self.weight = 1 / np.sqrt(relevances[is_used].to_numpy(dtype=np.float64))
+        scaled = (features_mean[self.columns].to_numpy(dtype=np.float64) - self.min_feat) / self.range * self.weight
+        self.has_value = (~np.isnan(scaled)).astype(np.float32)
+        self.matrix = np.nan_to_num(scaled).astype(np.float32)
+        self.toon_race_ids = features_mean.index.to_numpy(dtype=np.int64)
+        self.toon_races = np.array([player_keys[toon_race_id] for toon_race_id in self.toon_race_ids], dtype=object)
+        self.toons = np.array([player_keys.toons[toon_race_id] for toon_race_id in self.toon_race_ids], dtype=object)
+        self.is_barcode = np.array([toon_dir.is_barcode(toon) for toon in self.toons], dtype=bool)
+
+    def __len__(self):
+        return len(self.toon_races)
+
+    def scale_features(self, features):
+        """
+        @param features: {feature: value, ...} e.g. PlayerData.features, features that are not in self.columns are
+        ignored.
+        @return: (scaled, has_value) the scaled features in column order, 0 and False where missing.
+        """
+        values = np.array([features.get(column, np.nan) for column in self.columns], dtype=np.float64)
+        scaled = (values - self.min_feat) / self.range
+        # Clipping because we never want 1 extreme value of a feature to completely dominate the classification result.
+        scaled = np.clip(scaled, -0.2, 1.2) * self.weight
+        has_value = ~np.isnan(scaled)
+        return np.nan_to_num(scaled).astype(np.float32), has_value
+
+    def sq_dists(self, features):
+        """@return: np.ndarray with the squared L2-distance from the scaled features to each player's scaled means."""
+        scaled, has_value = self.scale_features(features)
+        matrix = self.matrix[:, has_value]
+        diff = matrix - scaled[has_value]
+        return (diff * diff * self.has_value[:, has_value]).sum(axis=1)
+
+
+class GameFeatureIndex(MeanFeatureIndex):
+    """
+    The features of every game of the players of one race, scaled like a MeanFeatureIndex, for the instance-based mode
+    (options -> INSTANCE_BASED). Instead of comparing the barcode to the mean of each player it is compared to every
+    game, and each player gets the mean distance of their top_k closest games. That way a player with several styles
+    (e.g. different openers) is close to a barcode that plays one of them. sq_dists() still gives a distance per
+    player, so mean_feature_classify can use either index. See DBMS.get_game_feature_index().
+
+    self.matrix / self.has_value: like in MeanFeatureIndex but with a row per game, the games are clipped like the
+    barcode's features.
+    self.sq_matrix: self.matrix squared, so that the distances are matrix-vector products, see sq_dists().
+    self.game_players: np.ndarray, the row of the player of each game in self.toon_races.
+    self.top_k: the number of closest games of each player that are averaged.
+    self.toon_race_ids / self.toon_races / self.toons / self.is_barcode: per player, taken from the MeanFeatureIndex.
+    """
+
+    def __init__(self, mean_index: MeanFeatureIndex, game_players, game_values, top_k):
+        """
+        @param mean_index: MeanFeatureIndex of the same players, its scaling is used for the games.
+        @param game_players / game_values: see ReplayFeatures.race_game_features, with the columns of mean_index.
+        """
+        self.columns = mean_index.columns
+        self.min_feat = mean_index.min_feat
+        self.range = mean_index.range
+        self.weight = mean_index.weight
+        scaled = np.clip((game_values.astype(np.float64) - self.min_feat) / self.range, -0.2, 1.2) * self.weight
+        self.has_value = (~np.isnan(scaled)).astype(np.float32)
+        self.matrix = np.nan_to_num(scaled).astype(np.float32)
+        self.sq_matrix = self.matrix * self.matrix
+        self.game_players = np.asarray(game_players, dtype=np.int64)
+        self.top_k = top_k
+        self.toon_race_ids = mean_index.toon_race_ids
+        self.toon_races = mean_index.toon_races
+        self.toons = mean_index.toons
+        self.is_barcode = mean_index.is_barcode
+
+    def sq_dists(self, features):
+        """@return: np.ndarray with the mean squared L2-distance of each player's top_k closest games."""
+        scaled, has_value = self.scale_features(features)
+        # sum((game - scaled)^2) over the features both have, written out as matrix-vector products so that no
+        # matrix as large as the games has to be made.
+        game_sq_dists = (
+            self.sq_matrix @ has_value.astype(np.float32)
+            - 2 * (self.matrix @ scaled)
+            + self.has_value @ (scaled * scaled)
+        )
+        # Rounding can make a distance of 0 slightly negative.
+        game_sq_dists = np.maximum(game_sq_dists, 0)
+        return best_games_mean(game_sq_dists, self.game_players, len(self), self.top_k)
+
+
+def mean_feature_classify(config, toon_dir, player_data: PlayerData, feature_index: MeanFeatureIndex,
                           to_visualize=True):
     """
     Classifies a barcode by finding the player with mean features closest in L2-space to the barcode's.
     Scales the features to min 0 and max 1. Then re-scale according to square root of feature relevances to put extra emphasis on the better features.
-    
+    The players are already scaled in feature_index, so only the barcode is scaled here.
+
     Only uses a single game from the barcode given by PlayerData.
 
+    @param feature_index: MeanFeatureIndex of the players of the barcode's race, or a GameFeatureIndex to compare to
+    every game of the players instead of to their means.
     @return: toon_estimate, non_barcode_toon_estimate
     """
     # check that there are at least 2 players with feature mean.
-    n_players = len(features_mean)
+    n_players = len(feature_index)
     if n_players < 2:
         print("You're trying to classify between less than 2 players in the database. Load more replays.")
         return False, False
 
-    # Break apart the barcode's player_data into race / toon / numeric features.
-    bc_toon = player_data.features["toon"]
-    bc_race = player_data.features["race"]
-    bc_toon_race = str((bc_toon, bc_race))
-    bc_features = pd.Series(player_data.features)
-    bc_features.drop(["toon", "race"], inplace=True)
-    bc_features = pd.to_numeric(bc_features)
-
-    # Create results_df, a copy of features_mean that will be scaled and get some columns added to help with the result.
-    results_df = copy.copy(features_mean)
-
-    # First scale data to have min 0 and max 1.
-    min_feat = features_mean.min()
-    max_feat = features_mean.max()
-    std = features_mean.std()
-    # Also remove any columns with standard deviation 0, should typically not happen, but maybe I will e.g. use a rare feature that is almost always 0.
-    results_df = features_mean.loc[:, std != 0]
-    min_feat = min_feat.loc[std != 0]
-    max_feat = max_feat.loc[std != 0]
-    bc_features = bc_features.loc[std != 0]
-    std = std[std != 0]
-    results_df = (results_df - min_feat) / (max_feat - min_feat)
-    # Scale the barcode's player_data with the same scaling factors.
-    bc_features = (bc_features - min_feat) / (max_feat - min_feat)
-    bc_features.clip(lower=-0.2, upper=1.2, inplace=True)  # Clipping because we never want 1 extreme value of a feature to completely dominate the classification result.
-
-    # Re-scale according to square root of feature relevances to put extra emphasis on the better features.
-    feature_relevances_sqrt = np.sqrt(feature_relevances)
-    bc_features = bc_features / feature_relevances_sqrt
-    results_df = results_df / feature_relevances_sqrt
-
-    # Add the distance to the barcode as a column to the mean df.
-    dist = results_df - bc_features
-    sq_dist = pd.Series((dist * dist).sum(axis=1), name="sq_dist")
-    results_df = pd.concat([results_df, sq_dist], axis=1)
-
-    # Sort the dataframe.
-    results_df.sort_values("sq_dist", inplace=True)
+    sq_dists = feature_index.sq_dists(player_data.features)
 
     # Get the closest player (could be a barcode).
-    results_df["toon"] = results_df.index.map(toon_race_to_toon)
-    toon_estimate = results_df.index[0]
-    toon_estimate_dist = results_df.iloc[0]["sq_dist"]
-
-    # Remove all barcodes from the df.
-    results_df["is_barcode"] = [is_toon_barcode(toon, toon_dict) for toon in results_df["toon"]]
-    results_df.drop(results_df[results_df["is_barcode"] == True].index, inplace=True)
-    non_barcode_toon_estimate = results_df.index[0]
-
-    # Visualize the top of this df.
-    results_df["names"] = results_df["toon"].map(toon_dict)
+    closest = int(np.argmin(sq_dists))
+    toon_estimate = feature_index.toon_races[closest]
+    toon_estimate_dist = sq_dists[closest]
+
+    # The closest non-barcodes.
+    non_barcodes = np.flatnonzero(~feature_index.is_barcode)
+    if len(non_barcodes) == 0:
+        print("WARNING: There was no non-barcode players of this race in the database, try loading more replays into the "
+              "database.")
+        return toon_estimate, False
+    n_to_print = config["options"]["NEIGHBOURS_TO_PRINT"] if to_visualize else 1
+    closest_non_barcodes = non_barcodes[closest_indices(sq_dists[non_barcodes], n_to_print)]
+    non_barcode_toon_estimate = feature_index.toon_races[closest_non_barcodes[0]]
+
+    # Visualize the top of the results.
     if to_visualize:
+        results_df = pd.DataFrame(
+            {
+                "names": [toon_dir.get_names(toon) for toon in feature_index.toons[closest_non_barcodes]],
+                "sq_dist": sq_dists[closest_non_barcodes],
+            },
+            index=feature_index.toon_races[closest_non_barcodes],
+        )
         print("--------------------")
         print("Simple feature classification result:")
-        print(f"closest non-barcode: {toon_dict[toon_race_to_toon(non_barcode_toon_estimate)]}")
+        print(f"closest non-barcode: {toon_dir[feature_index.toons[closest_non_barcodes[0]]]}")
         print(f"closest distance INCLUDING other barcodes: {toon_estimate_dist:.6f}")
         print("Table results:")
-        print(results_df[["names", "sq_dist"]].head(config["options"]["NEIGHBOURS_TO_PRINT"]))
+        print(results_df)
         print("--------------------")
 
     # Return both the nearest and non-barcode nearest.
     return toon_estimate, non_barcode_toon_estimate
-
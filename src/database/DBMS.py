@@ -1,16 +1,32 @@
 import copy
 import os
-import json
-from collections import defaultdict
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-import pandas as pd
+import sc2reader
+from sc2reader.engine.plugins.apm import APMTracker
 from tqdm.auto import tqdm
 
 from database.replay_features_class import ReplayFeatures
 from database.n_grams_class import NGrams
 from features.player_dataclass import PlayerData
-from utils.utils import get_replays_recursively, replay_is_relevant, try_load_replay
+from features.evaluate_features import get_feature_relevances
+from classifiers.nearest_neighbour import MeanFeatureIndex, GameFeatureIndex
+from utils.utils import (
+    get_replays_recursively,
+    get_replay_folder_paths,
+    long_path_safe,
+    try_load_relevant_replay,
+    open_atomic,
+)
 from database.replay_hash import ReplayHash
+from database.player_keys import PlayerKeys
+from database.toon_directory import ToonDirectory
+from database.replay_scanner import ReplayScanner
+from database.event_digests import EventDigests
 
 
 class DBMS:
@@ -20,20 +36,50 @@ class DBMS:
         self.data_path = os.path.join(self.program_path, "database", "data")
         self.config = config
         # These will be set up when calling self.load_data().
-        self.rep_hash = ReplayHash(self.data_path)
-        self.rep_feats = ReplayFeatures(self.data_path)
-        self.n_grams = NGrams(config, self.data_path)
+        self.rep_hash = ReplayHash(self.data_path, fast_fingerprint=config["options"]["FAST_FINGERPRINT"])
+        # The players are given ids here that are shared by rep_feats and n_grams, so that they can refer to them.
+        self.player_keys = PlayerKeys(os.path.join(self.data_path, "player_keys.txt"))
+        self.rep_feats = ReplayFeatures(self.data_path, self.player_keys)
+        self.n_grams = NGrams(config, self.data_path, self.player_keys)
+        self.toon_dir = ToonDirectory(self.data_path)
+        self.event_digests = EventDigests(self.data_path)
+        self.scanner = ReplayScanner(os.path.join(self.data_path, "replay_manifest.json"))
         self.latest_update_time = None
+        # Cached by get_feature_relevances(), with the rep_feats.n_changes they were calculated at.
+        self._feature_relevances = None
+        self._feature_relevances_n_changes = None
+        # {race: (n_changes of the race, feature_relevances, MeanFeatureIndex), ...} cached by get_feature_index().
+        self._feature_indices = {}
+        # {race: (MeanFeatureIndex, GameFeatureIndex), ...} cached by get_game_feature_index().
+        self._game_feature_indices = {}
+        # Keeps track of when the loaded replays were last saved to file, see _checkpoint_if_due().
+        self.n_replays_since_checkpoint = 0
+        self.last_checkpoint_time = time.time()
+        # Held while changing or reading the database, since replays can be loaded by the GUI's loading thread and by
+        # the ReplayWatcher while a classification is running.
+        self.lock = threading.RLock()
         # Load data from file.
         if reset_before_loading:
             self.reset_database()
         self.load_data()
 
+    def __getstate__(self):
+        """Used by copy.deepcopy, a lock can not be copied so the copy gets a new one."""
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
     def load_data(self):
         """Simply load data from file."""
+        self.player_keys.load_from_file()
         self.rep_feats.load_from_file()
         self.n_grams.load_from_file()
         self.rep_hash.load_from_file()
+        self.toon_dir.load_from_file()
         fn = os.path.join(self.data_path, "latest_update_time.txt")
         with open(fn, "r") as f:
             self.latest_update_time = float(f.read())
@@ -41,23 +87,43 @@ class DBMS:
     def save_to_file(self):
         """
         Updates all means and save everything to file.
-        Replay hashes and toon dict are both updated and saved to file for every replay by the replay loader,
-        so they do not need to be saved again here.
+        The replay hashes are saved after the data, so if the program dies in the middle of saving, the replays whose
+        data did not make it to file are not marked as loaded and will be parsed again next time. The games of those
+        replays that did make it to file are skipped when they are entered again, so resuming does not duplicate them.
         """
         print("saving to file...")
-        self.rep_feats.save_to_file()
-        self.n_grams.save_to_file()
-        self.rep_hash.save_to_file()
-        fn = os.path.join(self.data_path, "latest_update_time.txt")
-        with open(fn, "w") as f:
-            f.write(str(self.latest_update_time))
+        with self.lock:
+            self.rep_feats.save_to_file()
+            self.n_grams.save_to_file()
+            self.toon_dir.save_to_file()
+            self.rep_hash.save_to_file()
+            fn = os.path.join(self.data_path, "latest_update_time.txt")
+            with open_atomic(fn, "w") as f:
+                f.write(str(self.latest_update_time))
+            self.n_replays_since_checkpoint = 0
+            self.last_checkpoint_time = time.time()
         print("Saved to file.")
 
+    def _checkpoint_if_due(self):
+        """
+        Saves the loaded replays to file every options -> CHECKPOINT_N_REPLAYS replays or CHECKPOINT_SECONDS seconds,
+        whichever comes first, so that a crash or closed window only loses the replays since the last checkpoint.
+        latest_update_time is deliberately not moved forward here, it is only set once a whole folder is done;
+        replays that were already saved are instead skipped through their hashes.
+        """
+        self.n_replays_since_checkpoint += 1
+        n_replays_due = self.n_replays_since_checkpoint >= self.config["options"]["CHECKPOINT_N_REPLAYS"]
+        time_due = time.time() - self.last_checkpoint_time >= self.config["options"]["CHECKPOINT_SECONDS"]
+        if n_replays_due or time_due:
+            self.save_to_file()
+
     def reset_database(self):
         """Removes all data from file (except toon_handle_to_names)."""
         self.rep_hash.reset_file()
+        self.player_keys.reset_file()
         self.rep_feats.reset_files()
         self.n_grams.reset_files()
+        self.event_digests.reset_files()
 
     def enter_into_db(self, player_datas):
         """Takes the extracted features + n_grams from the replay and adds to the database variables."""
@@ -66,46 +132,223 @@ class DBMS:
             self.n_grams.enter_replay(player_data)
 
     def enter_all_replays_into_db(self, stop_event, exception_replay):
-        """Find list of replay paths -> parse them -> enter features etc. into database in memory and save to file."""
+        """
+        Find list of replay paths -> parse them -> enter features etc. into database in memory and save to file.
+
+        With options -> N_WORKERS set to more than 1 the replays are parsed in worker processes, see
+        _enter_replays_parallel. Both paths give the same database since results are entered in the same order.
+        """
         list_of_replay_paths, latest_replay_time = get_replays_recursively(
-            config=self.config, filter_update_time=self.latest_update_time
+            self.scanner, config=self.config, filter_update_time=self.latest_update_time
         )
-        for i in tqdm(range(len(list_of_replay_paths)), desc="loading replays"):
-            if stop_event.is_set():
-                # Stop event is set if the user clicks the stop button or closes the GUI.
-                print("Manually stopping loading of replays.")
-                break
-            replay_path = list_of_replay_paths[i]
-            if exception_replay:
-                if replay_path == exception_replay:
+        # list_of_replay_paths only has the new replays, the fingerprints of all replays that are still there are kept.
+        # The folders were just scanned, so scanning them again only checks the modification times.
+        all_replay_paths = self.scanner.scan(get_replay_folder_paths(self.config))
+        self.rep_hash.prune_fingerprints([long_path_safe(replay_path) for replay_path, _ in all_replay_paths])
+        if exception_replay:
+            list_of_replay_paths = [p for p in list_of_replay_paths if p != exception_replay]
+        self.enter_replays_into_db(list_of_replay_paths, stop_event, latest_update_time=latest_replay_time)
+
+    def enter_replays_into_db(self, list_of_replay_paths, stop_event, latest_update_time=None):
+        """
+        Parses the given replays, enters the ones that are not already in the database and saves to file.
+        @param latest_update_time: If given, self.latest_update_time is set to this before saving.
+        """
+        with self.lock:
+            self.n_replays_since_checkpoint = 0
+            self.last_checkpoint_time = time.time()
+        n_workers = get_n_workers(self.config)
+        # Starting worker processes takes a moment, not worth it for a handful of replays.
+        if n_workers > 1 and len(list_of_replay_paths) > n_workers:
+            self._enter_replays_parallel(list_of_replay_paths, stop_event, n_workers)
+        else:
+            self._enter_replays_serial(list_of_replay_paths, stop_event)
+        if latest_update_time is not None:
+            self.latest_update_time = latest_update_time
+        self.save_to_file()
+
+    def _enter_replays_serial(self, list_of_replay_paths, stop_event):
+        for replay_path, replay_hash in self._unloaded_replays(list_of_replay_paths, stop_event):
+            self._enter_parsed_replay(replay_hash, _parse_replay(self.config, replay_path, replay_hash))
+
+    def _enter_replays_parallel(self, list_of_replay_paths, stop_event, n_workers):
+        """
+        Worker processes do the sc2reader parsing and the feature + n_gram extraction, this process only hashes the
+        replays and enters the results into the database. Results are entered in the order the replays were
+        submitted and at most a few replays per worker are in flight at a time, so memory stays bounded.
+        """
+        executor = _make_executor(n_workers)
+        try:
+            calls = (
+                (self.config, replay_path, replay_hash)
+                for replay_path, replay_hash in self._unloaded_replays(list_of_replay_paths, stop_event)
+            )
+            for (_, _, replay_hash), parsed_replay in _map_in_order(executor, _parse_replay, calls, 4 * n_workers):
+                if stop_event.is_set():
+                    break
+                self._enter_parsed_replay(replay_hash, parsed_replay)
+        finally:
+            # Replays that are still in flight when stopping are simply dropped, their hashes were never added.
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _unloaded_replays(self, list_of_replay_paths, stop_event, chunk_size=256):
+        """Yields (replay_path, replay_hash) for every replay that is not already in the database."""
+        seen_hashes = set()  # Catches copies of the same replay within this run.
+        progress_bar = tqdm(total=len(list_of_replay_paths), desc="loading replays")
+        # Hash in chunks so that the hashing can use a thread pool while the stop button still works.
+        for chunk_start in range(0, len(list_of_replay_paths), chunk_size):
+            chunk = list_of_replay_paths[chunk_start : chunk_start + chunk_size]
+            for replay_path, replay_hash in zip(chunk, self.rep_hash.get_hashes(chunk)):
+                if stop_event.is_set():
+                    # Stop event is set if the user clicks the stop button or closes the GUI.
+                    print("Manually stopping loading of replays.")
+                    progress_bar.close()
+                    return
+                progress_bar.update()
+                if replay_hash is None or self.rep_hash.in_db(replay_hash) or replay_hash in seen_hashes:
                     continue
-            replay_hash = self.rep_hash.hash_replay(replay_path)
+                seen_hashes.add(replay_hash)
+                yield replay_path, replay_hash
+        progress_bar.close()
+
+    def _enter_parsed_replay(self, replay_hash, parsed_replay):
+        """
+        Enters the output of _parse_replay into the database. The hash is added even if the replay could not be
+        parsed or is irrelevant, to prevent parsing it again.
+        """
+        with self.lock:
+            # Checked again since the same replay might have been loaded by another thread in the meantime.
             if self.rep_hash.in_db(replay_hash):
-                continue
+                return
             self.rep_hash.add_hash(replay_hash)
-            replay = try_load_replay(replay_path)
-            if replay is False:
-                continue
-            if not replay_is_relevant(replay):
-                continue
-            _update_toon_dict(replay, self.program_path)
-            player_datas = []
-            for player in replay.players:
-                player_datas.append(PlayerData(self.config, player=player, replay_id=replay_hash))
-            self.enter_into_db(player_datas)
-        self.latest_update_time = latest_replay_time
-        self.save_to_file()
+            if parsed_replay is not False:
+                player_names, player_datas = parsed_replay
+                self.event_digests.save_replay(replay_hash, [player_data.digest for player_data in player_datas])
+                self.toon_dir.add_names(player_names)
+                self.enter_into_db(player_datas)
+            self._checkpoint_if_due()
+
+    def refeaturize_from_digests(self, stop_event):
+        """
+        Extracts the features and n_grams of all loaded replays again from their stored event digests, which is much
+        faster than parsing the replays. Use this after changing the hyperparams or the feature extraction.
+        Replays that were loaded before the digests were stored have no digest, they are removed from the database so
+        that they are parsed again the next time replays are loaded.
+        """
+        replay_hashes = self.event_digests.get_replay_hashes()
+        # Built up next to the current data, which is still used by classifications in the meantime.
+        # The player keys are shared with the current data, so new players are only added while holding the lock.
+        rep_feats = ReplayFeatures(self.data_path, self.player_keys)
+        n_grams = NGrams(self.config, self.data_path, self.player_keys)
+        n_workers = get_n_workers(self.config)
+        progress_bar = tqdm(total=len(replay_hashes), desc="extracting features")
+        for player_datas in self._featurize_replays(replay_hashes, n_workers, stop_event):
+            with self.lock:
+                for player_data in player_datas:
+                    rep_feats.enter_replay(player_data)
+                    n_grams.enter_replay(player_data)
+            progress_bar.update()
+        progress_bar.close()
+        if stop_event.is_set():
+            print("Manually stopping extraction of features, the database is unchanged.")
+            return
+
+        with self.lock:
+            # Replays that were loaded (e.g. by the ReplayWatcher) while extracting.
+            replays_with_digest = set(replay_hashes)
+            new_replay_hashes = [h for h in self.event_digests.get_replay_hashes() if h not in replays_with_digest]
+            for player_datas in self._featurize_replays(new_replay_hashes, 1, stop_event):
+                for player_data in player_datas:
+                    rep_feats.enter_replay(player_data)
+                    n_grams.enter_replay(player_data)
+            replays_with_digest.update(new_replay_hashes)
+            replays_without_digest = self.rep_feats.get_replay_ids() - replays_with_digest
+            for replay_id in replays_without_digest:
+                self.rep_hash.remove_replay(replay_id)
+            if len(replays_without_digest) > 0:
+                self.latest_update_time = 0.0
+                print(
+                    f"{len(replays_without_digest)} replays were loaded before event digests were stored, they will be"
+                    f" parsed again the next time replays are loaded."
+                )
+            self.rep_feats = rep_feats
+            self.n_grams = n_grams
+            self._feature_relevances = None
+            self._feature_indices = {}
+            self._game_feature_indices = {}
+            self.save_to_file()
+
+    def _featurize_replays(self, replay_hashes, n_workers, stop_event):
+        """Yields the [PlayerData, ...] of each replay from its stored event digests, in order."""
+        calls = ((self.config, self.event_digests.get_path(replay_hash), replay_hash) for replay_hash in replay_hashes)
+        if n_workers <= 1 or len(replay_hashes) <= n_workers:
+            for call in calls:
+                if stop_event.is_set():
+                    return
+                yield _featurize_digests(*call)
+            return
+        executor = _make_executor(n_workers)
+        try:
+            for _, player_datas in _map_in_order(executor, _featurize_digests, calls, 4 * n_workers):
+                if stop_event.is_set():
+                    return
+                yield player_datas
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
     def get_replay_features_copy(self):
-        return copy.deepcopy(self.rep_feats.features)
+        return self.rep_feats.get_features_by_toon_race()
 
-    def update_means(self, toon_races_to_update, max_games_to_use=1000000):
+    def get_feature_relevances(self):
+        """
+        @return: the feature relevances, see features.evaluate_features.get_feature_relevances. They are cached and
+        only calculated again when the features have changed.
+        """
+        with self.lock:
+            if self._feature_relevances is None or self._feature_relevances_n_changes != self.rep_feats.n_changes:
+                self._feature_relevances = get_feature_relevances(self.rep_feats)
+                self._feature_relevances_n_changes = self.rep_feats.n_changes
+            return self._feature_relevances
+
+    def get_feature_index(self, race, feature_relevances=None):
+        """
+        @param feature_relevances: the relevances to scale the features with, get_feature_relevances() if None.
+        @return: MeanFeatureIndex of the players of the race, which is cached until the features of a player of the
+        race or the relevances change. It is built from the race's partition only, see ReplayFeatures.partitions.
+        """
+        with self.lock:
+            if feature_relevances is None:
+                feature_relevances = self.get_feature_relevances()
+            n_changes = self.rep_feats.partitions.n_changes.get(race, 0)
+            cached = self._feature_indices.get(race)
+            if cached is None or cached[0] != n_changes or cached[1] is not feature_relevances:
+                features_mean = self.rep_feats.race_filter_stats(race)["mean"]
+                feature_index = MeanFeatureIndex(features_mean, feature_relevances, self.player_keys, self.toon_dir)
+                self._feature_indices[race] = (n_changes, feature_relevances, feature_index)
+            return self._feature_indices[race][2]
+
+    def get_game_feature_index(self, race, feature_relevances=None):
+        """
+        @return: GameFeatureIndex of every game of the players of the race for the instance-based mode, scaled like
+        get_feature_index(race, feature_relevances) and cached until that one changes.
+        """
+        with self.lock:
+            # The MeanFeatureIndex is built again whenever the games of the race change.
+            feature_index = self.get_feature_index(race, feature_relevances=feature_relevances)
+            top_k = self.config["options"]["INSTANCE_TOP_K_GAMES"]
+            cached = self._game_feature_indices.get(race)
+            if cached is None or cached[0] is not feature_index or cached[1].top_k != top_k:
+                _, game_players, game_values = self.rep_feats.race_game_features(race, feature_index.columns)
+                game_index = GameFeatureIndex(feature_index, game_players, game_values, top_k)
+                self._game_feature_indices[race] = (feature_index, game_index)
+            return self._game_feature_indices[race][1]
+
+    def update_means(self, toon_races_to_update, max_games_to_use=None):
         self.n_grams.update_means(toon_races_to_update, max_games_to_use=max_games_to_use)
         self.rep_feats.update_stats()
 
     def get_race_filter_stats(self, filter_race):
         return_dict = dict()
-        return_dict["n_gram"] = self.n_grams.race_filter_mean(filter_race)
         return_dict["features"] = self.rep_feats.race_filter_stats(filter_race)
         return return_dict
 
@@ -133,7 +376,7 @@ class DBMS:
         @return yields tuples of the replay's PlayerData and a copy of the dbms with this specific replay's data removed.
         """
         self.update_means("changed")
-        for toon_race, df in self.rep_feats.features.items():
+        for toon_race, df in self.rep_feats.get_features_by_toon_race().items():
             # Verify that this player has enough games in database.
             if len(df) < max(n_sample_games, 2):
                 continue
@@ -147,14 +390,8 @@ class DBMS:
                 player_data_dict = dict()
                 player_data_dict["replay_id"] = replay_id
                 player_data_dict["toon_race"] = toon_race
-                player_n_grams = []
-                for i in range(self.n_grams.HIGHEST_N):
-                    n_gram_df = self.n_grams.n_grams[i]
-                    n_gram_df = n_gram_df[(n_gram_df["replay_id"] == replay_id) & (n_gram_df["toon_race"] == toon_race)]
-                    player_n_grams.append(n_gram_df[n_gram_df["replay_id"] == replay_id])
-                player_data_dict["n_grams"] = player_n_grams
-                feat_series = self.rep_feats.features[toon_race].loc[replay_id]
-                player_data_dict["features"] = feat_series.to_dict()
+                player_data_dict["n_grams"] = self.n_grams.get_replay_n_grams(toon_race, replay_id)
+                player_data_dict["features"] = self.rep_feats.get_replay_features(toon_race, replay_id)
                 player_data = PlayerData(self.config, complete_data=player_data_dict)
 
                 # Create a copy of the dbms and remove the current player's data.
@@ -165,19 +402,63 @@ class DBMS:
                 yield player_data, copy_dbms
 
 
-def _update_toon_dict(replay, program_path):
-    """simply adds the toons from the replay to the toon dict, also reads and saves to file."""
-    # load toon_dict from file
-    dict_path = os.path.join(program_path, "database", "data", "toon_handle_to_names.txt")
-    with open(dict_path, "r") as infile:
-        toon_dict = json.load(infile)
-    toon_dict = defaultdict(list, toon_dict)
-    # update the variable
-    for player in replay.players:
-        if player.name in toon_dict[player.toon_handle]:
-            continue
-        else:
-            toon_dict[player.toon_handle].append(player.name)
-    # update the file
-    with open(dict_path, "w") as outfile:
-        json.dump(toon_dict, outfile)
+def get_n_workers(config):
+    """Number of processes used to parse replays, 0 in the config means one per cpu core."""
+    n_workers = config["options"]["N_WORKERS"]
+    if n_workers == 0:
+        n_workers = os.cpu_count() or 1
+    return n_workers
+
+
+def _make_executor(n_workers):
+    # Spawn (which is the only option on Windows) so that workers start without the parent's sc2reader plugins.
+    return ProcessPoolExecutor(
+        max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+    )
+
+
+def _map_in_order(executor, function, calls, max_in_flight):
+    """
+    Like executor.map, but only submits up to max_in_flight calls ahead of the results that have been used, so that
+    memory stays bounded for long iterables.
+    @param calls: iterable of argument tuples for function.
+    @return: yields (arguments, result) in the same order as calls.
+    """
+    in_flight = deque()
+    for call in calls:
+        in_flight.append((call, executor.submit(function, *call)))
+        if len(in_flight) >= max_in_flight:
+            call, future = in_flight.popleft()
+            yield call, future.result()
+    while len(in_flight) > 0:
+        call, future = in_flight.popleft()
+        yield call, future.result()
+
+
+def _init_worker():
+    """Worker processes do not run main.py, so the apm plugin has to be registered in each of them."""
+    sc2reader.engine.register_plugin(APMTracker())
+
+
+def _parse_replay(config, replay_path, replay_hash):
+    """
+    Loads a replay and extracts the PlayerData of both players. Runs in the worker processes when loading in parallel,
+    so everything returned has to be picklable.
+    @return: False if the replay can not be parsed or is irrelevant, otherwise
+    ([(toon_handle, name), ...], [PlayerData, ...]).
+    """
+    replay, is_relevant = try_load_relevant_replay(replay_path)
+    if not is_relevant:
+        return False
+    player_names = [(player.toon_handle, player.name) for player in replay.players]
+    player_datas = [PlayerData(config, player=player, replay_id=replay_hash) for player in replay.players]
+    return player_names, player_datas
+
+
+def _featurize_digests(config, digest_path, replay_hash):
+    """
+    Extracts the PlayerData of all players in a replay from its stored event digests, see
+    DBMS.refeaturize_from_digests. Runs in the worker processes when there are several.
+    """
+    digests = EventDigests.load_file(digest_path)
+    return [PlayerData(config, digest=digest, replay_id=replay_hash) for digest in digests]
@@ -0,0 +1,61 @@
+import os
+import shutil
+
+import numpy as np
+
+from features.event_digest import EventDigest
+from utils.utils import open_atomic
+
+
+class EventDigests:
+    """
+    Stores the EventDigest of each player in each loaded replay, so that all features can be extracted again without
+    parsing the replays (see DBMS.refeaturize_from_digests).
+
+    There is one file per replay, data_path/event_digests/{replay_hash}.npz, holding the digests of all its players.
+    Only relevant replays have a file.
+
+    The order the replays were saved in is kept in replay_order.txt in the same folder, one hash per line. A hash is
+    appended before its file is written, so a hash without a file (the program died in between) is simply skipped.
+    """
+
+    def __init__(self, data_path):
+        self.folder_path = os.path.join(data_path, "event_digests")
+        self.order_path = os.path.join(self.folder_path, "replay_order.txt")
+
+    def reset_files(self):
+        shutil.rmtree(self.folder_path, ignore_errors=True)
+
+    def get_path(self, replay_hash):
+        return os.path.join(self.folder_path, f"{replay_hash}.npz")
+
+    def save_replay(self, replay_hash, digests):
+        """@param digests: [EventDigest, ...] of the players in the replay."""
+        os.makedirs(self.folder_path, exist_ok=True)
+        with open(self.order_path, "a") as outfile:
+            # The newline goes first, so a hash that was cut off by a crash is not joined with the next one.
+            outfile.write(f"\n{replay_hash}")
+        arrays = dict()
+        for i, digest in enumerate(digests):
+            arrays.update(digest.to_arrays(prefix=f"player_{i}_"))
+        with open_atomic(self.get_path(replay_hash), "wb") as f:
+            np.savez_compressed(f, n_players=len(digests), **arrays)
+
+    @staticmethod
+    def load_file(file_path):
+        """@return: [EventDigest, ...] of the players in the replay."""
+        with np.load(file_path) as arrays:
+            return [EventDigest.from_arrays(arrays, prefix=f"player_{i}_") for i in range(int(arrays["n_players"]))]
+
+    def load_replay(self, replay_hash):
+        return self.load_file(self.get_path(replay_hash))
+
+    def get_replay_hashes(self):
+        """@return: the hashes of all replays with stored digests, in the order they were saved."""
+        if not os.path.exists(self.order_path):
+            return []
+        with open(self.order_path, "r") as infile:
+            replay_hashes = infile.read().split()
+        # A replay that was saved again (e.g. removed from the database and loaded again) is where it was saved last.
+        replay_hashes = list(dict.fromkeys(reversed(replay_hashes)))[::-1]
+        return [replay_hash for replay_hash in replay_hashes if os.path.exists(self.get_path(replay_hash))]
@@ -0,0 +1,126 @@
+import numpy as np
+from scipy import sparse
+
+
+class GrowableArray:
+    """
+    A 1-d numpy array that can be appended to in amortized constant time, the buffer doubles in size when it is full.
+    self.array is a view of the used part of the buffer.
+    """
+
+    def __init__(self, dtype, values=()):
+        values = np.asarray(values, dtype=dtype)
+        self._buffer = np.empty(max(len(values), 16), dtype=dtype)
+        self._buffer[: len(values)] = values
+        self._size = len(values)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def array(self):
+        return self._buffer[: self._size]
+
+    def append(self, value):
+        self.extend((value,))
+
+    def extend(self, values):
+        values = np.asarray(values, dtype=self._buffer.dtype)
+        new_size = self._size + len(values)
+        if new_size > len(self._buffer):
+            new_buffer = np.empty(max(new_size, 2 * len(self._buffer)), dtype=self._buffer.dtype)
+            new_buffer[: self._size] = self.array
+            self._buffer = new_buffer
+        self._buffer[self._size : new_size] = values
+        self._size = new_size
+
+
+class GrowableCSR:
+    """
+    A sparse matrix in CSR format that rows can be appended to, in amortized time proportional to the number of
+    non-zero values of the new row. The number of columns grows if a row with more columns is appended.
+    """
+
+    def __init__(self, n_cols, dtype=np.float32):
+        self.n_cols = n_cols
+        # indices and indptr have the same dtype so that scipy does not have to convert them in to_csr().
+        index_dtype = np.int32 if n_cols <= np.iinfo(np.int32).max else np.int64
+        self.data = GrowableArray(dtype)
+        self.indices = GrowableArray(index_dtype)
+        self.indptr = GrowableArray(index_dtype, [0])
+
+    @property
+    def n_rows(self):
+        return len(self.indptr) - 1
+
+    def append_rows(self, csr):
+        """@param csr: scipy sparse matrix with at least n_cols columns, its rows are added at the end."""
+        csr = sparse.csr_array(csr)
+        assert csr.shape[1] >= self.n_cols
+        self.n_cols = csr.shape[1]
+        csr.sum_duplicates()  # Also sorts the indices.
+        index_max = np.iinfo(self.indptr.array.dtype).max
+        if self.indptr.array[-1] + csr.nnz > index_max or self.n_cols > index_max:
+            self.indices = GrowableArray(np.int64, self.indices.array)
+            self.indptr = GrowableArray(np.int64, self.indptr.array)
+        self.indptr.extend(csr.indptr[1:] + self.indptr.array[-1])
+        self.indices.extend(csr.indices)
+        self.data.extend(csr.data)
+
+    def to_csr(self):
+        """@return: csr_array of all rows, it shares memory with this object so it should not be changed."""
+        return sparse.csr_array(
+            (self.data.array, self.indices.array, self.indptr.array), shape=(self.n_rows, self.n_cols), copy=False
+        )
+
+    def get_rows(self, rows):
+        """@return: csr_array of the given rows, in the given order."""
+        return self.to_csr()[np.asarray(rows, dtype=np.int64)]
+
+
+class GrowableMatrix:
+    """
+    A 2-d numpy array that rows can be appended to in amortized constant time per row, like GrowableArray. Columns can
+    be added too, the existing rows then get fill_value in them. self.array is a view of the used rows of the buffer.
+    """
+
+    def __init__(self, dtype, values=None, n_cols=0, fill_value=np.nan):
+        values = np.empty((0, n_cols), dtype=dtype) if values is None else np.asarray(values, dtype=dtype)
+        self.fill_value = fill_value
+        self._buffer = np.empty((max(len(values), 16), values.shape[1]), dtype=dtype)
+        self._buffer[: len(values)] = values
+        self._size = len(values)
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def n_cols(self):
+        return self._buffer.shape[1]
+
+    @property
+    def array(self):
+        return self._buffer[: self._size]
+
+    def append(self, row):
+        self.extend(np.asarray(row)[np.newaxis])
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self._buffer.dtype)
+        new_size = self._size + len(rows)
+        if new_size > len(self._buffer):
+            new_buffer = np.empty((max(new_size, 2 * len(self._buffer)), self.n_cols), dtype=self._buffer.dtype)
+            new_buffer[: self._size] = self.array
+            self._buffer = new_buffer
+        self._buffer[self._size : new_size] = rows
+        self._size = new_size
+
+    def add_columns(self, n_new_cols):
+        """Adds n_new_cols columns at the end, filled with fill_value."""
+        new_buffer = np.full((len(self._buffer), self.n_cols + n_new_cols), self.fill_value, dtype=self._buffer.dtype)
+        new_buffer[: self._size, : self.n_cols] = self.array
+        self._buffer = new_buffer
+
+    def keep(self, rows=slice(None), cols=slice(None)):
+        """Removes all rows and columns except the given ones (boolean masks or lists), which are renumbered."""
+        self.__init__(self._buffer.dtype, self.array[rows][:, cols], fill_value=self.fill_value)
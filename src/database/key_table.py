@@ -0,0 +1,83 @@
+import os
+
+from utils.utils import open_atomic
+
+
+class KeyTable:
+    """
+    Gives every key (e.g. a toon_race or a replay hash) a small integer id so that numpy arrays can refer to it. Ids are
+    handed out in the order the keys are first added and are never reused, even if all data of a key is removed.
+
+    The keys are stored one per line, in id order, and new keys are appended to the file on save.
+
+    self.keys: [key0, key1, ...] so that self.keys[id] is the key.
+    self.ids: {key: id, ...} the reverse of self.keys.
+    self.n_saved: how many of the keys are already in the file.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.keys = []
+        self.ids = {}
+        self.n_saved = 0
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.ids
+
+    def __getitem__(self, key_id):
+        return self.keys[key_id]
+
+    def get_id(self, key):
+        """@return: the id of the key, None if it has never been added."""
+        return self.ids.get(key)
+
+    def add(self, key):
+        """@return: the id of the key, which is given a new id if it is not already in the table."""
+        key_id = self.ids.get(key)
+        if key_id is None:
+            key_id = len(self.keys)
+            self.keys.append(key)
+            self.ids[key] = key_id
+        return key_id
+
+    def load_from_file(self):
+        self.keys = []
+        self.ids = {}
+        self.n_saved = 0
+        if not os.path.exists(self.file_path):
+            return
+        with open(self.file_path, "r", encoding="utf-8", newline="\n") as infile:
+            data = infile.read()
+        lines = data.split("\n")
+        # The last element is "" after a complete last line, anything else was cut off while appending.
+        if lines[-1] != "":
+            print(f"Removing an incomplete key from the end of {self.file_path}.")
+            os.truncate(self.file_path, len(data.encode()) - len(lines[-1].encode()))
+        for key in lines[:-1]:
+            self.add(key)
+        self.n_saved = len(self.keys)
+
+    def save_to_file(self, rewrite=False):
+        """@param rewrite: Whether to replace the file with all keys, instead of appending the unsaved keys."""
+        if rewrite:
+            with open_atomic(self.file_path, "wb") as outfile:
+                outfile.write("".join(key + "\n" for key in self.keys).encode("utf-8"))
+            self.n_saved = len(self.keys)
+            return
+        if self.n_saved == len(self.keys):
+            return
+        with open(self.file_path, "a", encoding="utf-8", newline="\n") as outfile:
+            outfile.write("".join(key + "\n" for key in self.keys[self.n_saved :]))
+            outfile.flush()
+            os.fsync(outfile.fileno())
+        self.n_saved = len(self.keys)
+
+    def reset_file(self):
+        with open(self.file_path, "w"):
+            pass
+        self.keys = []
+        self.ids = {}
+        self.n_saved = 0
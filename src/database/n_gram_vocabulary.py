@@ -0,0 +1,70 @@
+import numpy as np
+from scipy import sparse
+
+from database.growable_arrays import GrowableArray
+
+
+class NGramVocabulary:
+    """
+    Gives every n_gram code that has been seen (the column in the output of extract_n_grams, which ranges up to
+    base**N) a dense column id, so that the n_gram matrices only have as many columns as there are different n_grams
+    in the database. The column ids are handed out in the order the codes are first seen and are never reused.
+
+    self.codes: GrowableArray so that self.codes.array[column] is the code of the column.
+    self.columns: {code: column, ...} the reverse of self.codes.
+    self.n_codes: the number of columns of the n_gram vectors in code space (base**N), 0 until the first code is added.
+    self.n_saved: how many of the codes are already saved, see NGrams.save_to_file.
+    """
+
+    def __init__(self):
+        self.codes = GrowableArray(np.int64)
+        self.columns = {}
+        self.n_codes = 0
+        self.n_saved = 0
+
+    def __len__(self):
+        return len(self.codes)
+
+    def to_columns(self, csr, add=False):
+        """
+        @param csr: sparse matrix in code space, e.g. an n_gram vector from extract_n_grams.
+        @param add: Whether to give new codes a column. Otherwise n_grams that have never been seen are left out.
+        @return: csr_array with the same rows and len(self) columns.
+        """
+        csr = sparse.csr_array(csr)
+        if add:
+            self.n_codes = max(self.n_codes, csr.shape[1])
+            new_codes = [code for code in dict.fromkeys(csr.indices.tolist()) if code not in self.columns]
+            for column, code in enumerate(new_codes, start=len(self.codes)):
+                self.columns[code] = column
+            self.codes.extend(new_codes)
+        columns = np.array([self.columns.get(code, -1) for code in csr.indices.tolist()], dtype=np.int64)
+        known = columns >= 0
+        row_of_value = np.repeat(np.arange(csr.shape[0]), np.diff(csr.indptr))
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(row_of_value[known], minlength=csr.shape[0]))])
+        csr = sparse.csr_array((csr.data[known], columns[known], indptr), shape=(csr.shape[0], len(self)))
+        csr.sort_indices()
+        return csr
+
+    def to_codes(self, csr):
+        """@return: csr_array in code space from one in column space, the inverse of to_columns."""
+        csr = sparse.csr_array(csr)
+        codes = self.codes.array[csr.indices]
+        csr = sparse.csr_array((csr.data.copy(), codes, csr.indptr.copy()), shape=(csr.shape[0], self.n_codes))
+        csr.sort_indices()
+        return csr
+
+    def get_unsaved_codes(self):
+        """@return: the codes given a column since the last call to mark_saved, in column order."""
+        return self.codes.array[self.n_saved :]
+
+    def mark_saved(self):
+        self.n_saved = len(self.codes)
+
+    def add_saved_codes(self, codes, n_codes):
+        """Gives the next columns to codes that were saved with get_unsaved_codes, when loading."""
+        for column, code in enumerate(np.asarray(codes).tolist(), start=len(self.codes)):
+            self.columns[code] = column
+        self.codes.extend(codes)
+        self.n_codes = max(self.n_codes, n_codes)
+        self.n_saved = len(self.codes)
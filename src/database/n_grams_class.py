@@ -1,138 +1,619 @@
+import json
 import os
-import pickle
-import copy
-from collections import defaultdict
+import threading
 
 import pandas as pd
 import numpy as np
+from scipy import sparse
 from sklearn.preprocessing import normalize
 
-from utils.utils import toon_race_to_race
+from utils.utils import open_atomic
+from database.key_table import KeyTable
+from database.growable_arrays import GrowableArray
+from database.segmented_csr import SegmentedCSR
+from database.n_gram_vocabulary import NGramVocabulary
+from database.race_partitions import RacePartitions
+from database.segments import save_array, new_segment, remove_unused_segments, run_compaction
 
 
 class NGrams:
     """
     Holds and manipulates the n_gram data. This docstring will explain the format of the key variables.
 
-    self.n_grams: [pd.DataFrame, ...] where pd_DataFrame has columns "replay_id", "toon_race", "sparse_n_gram" where
-    "sparse_n_gram" is a SciPy sparse csr_array. In this array the index is coded for the type of
-    n_gram (e.g. [camera action, selection event] and the value is the number of occurrences.
+    self.matrices: [SegmentedCSR, ...] where the first element is 1_gram, 2_gram etc. Each matrix has one row per game of
+    a player, and all matrices have the same rows. In a row the column is coded for the type of n_gram (e.g.
+    [camera action, selection event]) and the value is the number of occurrences. None until the first game is entered.
+    self.vocabularies: [NGramVocabulary, ...] one per matrix, they map the n_gram codes of extract_n_grams to the
+    columns of the matrices, which only has columns for the n_grams that have been seen. Everything in this class is
+    in column space, except for the input of enter_replay and the output of get_replay_n_grams.
 
-    self._means: list of {toon_race: sparse csr_array}, where the first element of the list is 1_gram, 2_gram etc.
-    In this case the array comes from the sum of each one of this player's n_gram vectors which has then been
-    normalized to sum 1.
+    self.player_keys: PlayerKeys shared with the rest of the database that gives every toon_race an integer id.
+    self.replay_ids: KeyTable that gives every replay hash an integer id.
+    self.row_toon_race, self.row_replay: GrowableArray with the toon_race id and replay id of each row.
+    self.rows: {(toon_race_id, replay_id): row, ...} for every row that has not been removed.
+    self.rows_by_toon_race: {toon_race_id: [row, ...], ...} the rows of each player in the order they were entered,
+    without removed rows.
+    self.partitions: RacePartitions with the toon_race_ids of the players of each race, so that the race matrices are
+    built from only the players of that race.
+    self.removed_rows: [row, ...] removed rows are only dropped from the matrices when the segments are compacted,
+    until then they are just not referred to by self.rows and self.rows_by_toon_race.
 
-    self._means_not_up_to_date_toon_races: This variable states which players (toon_races) has had their data changed
+    On disk, the rows are stored in segments: folders in self.segments_path which each hold the rows that were added
+    between two saves, as raw .npy arrays that are opened with np.memmap (see SegmentedCSR). The manifest
+    (n_gram_manifest.json) lists the segments that make up the database in order, as well as self.removed_rows, and is
+    replaced last when saving so that a crash leaves the previous state. When there are more than
+    SEGMENTS_TO_COMPACT segments, or more removed rows than rows, they are merged into one in a background thread.
+    Each segment also holds how much the rows added and removed since the previous segment changed the sums of the
+    players (see self.sums), so that loading adds up those changes instead of summing up all games again.
+    self.segment_names: the segments of the manifest.
+    self.n_saved_rows: the number of rows in the segments, the others are only in memory.
+    self.n_saved_removed_rows: the number of self.removed_rows whose change to the sums is in the segments.
+    self._compaction: the compaction that is running in the background, see _start_compaction(), None if there is none.
+    self._matches_files: False for an NGrams that was built without loading the files, e.g. while extracting features
+    again, it replaces all of the saved data the first time it is saved.
+
+    self.sums: list of {toon_race_id: sparse csr_array}, where the first element of the list is 1_gram, 2_gram etc. The
+    array is the sum of each one of this player's n_gram vectors, kept up to date when games are entered or removed.
+    self.totals: list of {toon_race_id: float}, the total number of n_grams in self.sums.
+
+    self._means: list of {toon_race_id: sparse csr_array}, where the first element of the list is 1_gram, 2_gram etc.
+    In this case the array comes from self.sums normalized to sum 1.
+
+    self.means_not_up_to_date_toon_races: This variable states which players (toon_race_ids) has had their data changed
     without the means of their data having been updated.
     The purpose is to allow changing the data multiple times without updating the mean, but we also
     guarantee than whenever the "get_means()" method is called then the means will first be updated if necessary.
     This is why direct access to the "_means" variable should be considered private, since it might not be up to date.
+
+    self._log_prob_matrices: {(race, n, lowest_prob): (toon_race_ids, csr_array), ...} built by race_log_prob_matrix()
+    from the means and dropped when the mean of a player of that race changes.
+    self._inverted_indices: {(race, n, lowest_prob): (csc_array, column_max), ...} the same matrices by column, built by
+    race_inverted_index() and dropped together with self._log_prob_matrices.
+    self._game_log_prob_matrices: {(race, n, lowest_prob): (toon_race_ids, game_players, csr_array), ...} the same as
+    self._log_prob_matrices but with a row per game, built by race_game_log_prob_matrix() and dropped together with it.
     """
 
-    def __init__(self, config, data_path):
+    SEGMENTS_TO_COMPACT = 8
+
+    def __init__(self, config, data_path, player_keys):
         self.data_path = data_path
+        self.player_keys = player_keys
+        self.folder_path = os.path.join(data_path, "n_gram", "earlygame")
+        self.segments_path = os.path.join(self.folder_path, "segments")
+        self.manifest_path = os.path.join(self.folder_path, "n_gram_manifest.json")
         self.HIGHEST_N = config["hyperparams"]["HIGHEST_N"]
-        self.n_grams = []
-        self._means = []
+        # Empty until loaded with load_from_file().
+        self._clear()
+
+    def __getstate__(self):
+        """Used by copy.deepcopy, a compaction that is running in the background stays with the original."""
+        state = self.__dict__.copy()
+        state["_compaction"] = None
+        return state
+
+    def _clear(self):
+        self.matrices = [None] * self.HIGHEST_N
+        self.vocabularies = [NGramVocabulary() for _ in range(self.HIGHEST_N)]
+        self.replay_ids = KeyTable(os.path.join(self.folder_path, "replay_ids.txt"))
+        self.row_toon_race = GrowableArray(np.int32)
+        self.row_replay = GrowableArray(np.int32)
+        self.rows = {}
+        self.rows_by_toon_race = {}
+        self.partitions = RacePartitions(self.player_keys)
+        self.removed_rows = []
+        self.segment_names = []
+        self.n_saved_rows = 0
+        self.n_saved_removed_rows = 0
+        self._compaction = None
+        self._matches_files = False
+        self.sums = [{} for _ in range(self.HIGHEST_N)]
+        self.totals = [{} for _ in range(self.HIGHEST_N)]
+        self._means = [{} for _ in range(self.HIGHEST_N)]
         self.means_not_up_to_date_toon_races = set()
+        self._log_prob_matrices = {}
+        self._inverted_indices = {}
+        self._game_log_prob_matrices = {}
+
+    def _legacy_path(self, n):
+        return os.path.join(self.folder_path, f"sparse_{n}_gram.pkl")
 
     def reset_files(self):
-        for n in range(1, self.HIGHEST_N + 1):
-            pd.DataFrame().to_pickle(os.path.join(self.data_path, "n_gram", "earlygame", f"sparse_{n}_gram.pkl"))
-            with open(
-                os.path.join(self.data_path, "n_gram", "earlygame", f"sparse_{n}_gram_mean.pkl"), "wb"
-            ) as outfile:
-                pickle.dump({}, outfile)
+        self._clear()
+        os.makedirs(self.folder_path, exist_ok=True)
+        self.replay_ids.reset_file()
+        self._save_manifest()
+        self._remove_unused_segments()
+        self._matches_files = True
 
     def save_to_file(self):
-        self.update_means("changed")
-        n_gram_folder_path = os.path.join(self.data_path, "n_gram", "earlygame")
+        """
+        Only the rows added since the last save are written, as a new segment. When there are too many segments they
+        are compacted in the background, see _start_compaction().
+        """
+        if not self._matches_files:
+            # Everything in the folder is replaced, the keys are rewritten since the ids might differ.
+            self.replay_ids.save_to_file(rewrite=True)
+            self._matches_files = True
+        # The keys are saved first since the rows refer to them.
+        self.player_keys.save_to_file()
+        self.replay_ids.save_to_file()
+        self._finish_compaction()
+        if len(self.row_toon_race) > self.n_saved_rows or len(self.removed_rows) > self.n_saved_removed_rows:
+            self._save_segment()
+        too_many_segments = len(self.segment_names) > self.SEGMENTS_TO_COMPACT
+        if self._compaction is None and (too_many_segments or len(self.removed_rows) > len(self.rows)):
+            self._start_compaction()
+        self._save_manifest()
+        self._remove_unused_segments()
+
+    def _save_segment(self):
+        """
+        Writes the rows that are only in memory to a new segment, the matrices then memory map them. The segment also
+        gets the change to the sums from these rows and from the rows removed since the last save.
+        """
+        name, segment_path = new_segment(self.segments_path)
+        row_arrays = np.stack([self.row_toon_race.array, self.row_replay.array])[:, self.n_saved_rows :]
+        save_array(segment_path, "rows.npy", row_arrays)
+        added_rows = np.arange(self.n_saved_rows, len(self.row_toon_race))
+        removed_rows = np.array(self.removed_rows[self.n_saved_removed_rows :], dtype=np.int64)
+        sum_rows = np.concatenate([added_rows, removed_rows])
+        # Adds the added rows and subtracts the removed rows of each player.
+        players, picker = _player_picker(
+            self.row_toon_race.array[sum_rows], np.concatenate([np.ones(len(added_rows)), -np.ones(len(removed_rows))])
+        )
+        save_array(segment_path, "sums_players.npy", players)
         for n in range(1, self.HIGHEST_N + 1):
-            self.n_grams[n - 1].to_pickle(os.path.join(n_gram_folder_path, f"sparse_{n}_gram.pkl"))
-            with open(os.path.join(n_gram_folder_path, f"sparse_{n}_gram_mean.pkl"), "wb") as outfile:
-                pickle.dump(self._means[n - 1], outfile)
+            if self.matrices[n - 1] is not None:
+                sums_change = _player_sums(picker, self.matrices[n - 1].get_rows(sum_rows))
+                SegmentedCSR.save_part(segment_path, f"{n}_gram_sums", sums_change)
+                save_array(segment_path, f"{n}_gram_codes.npy", self.vocabularies[n - 1].get_unsaved_codes())
+                self.vocabularies[n - 1].mark_saved()
+                self.matrices[n - 1].save_tail(segment_path, f"{n}_gram")
+        self.segment_names.append(name)
+        self.n_saved_rows = len(self.row_toon_race)
+        self.n_saved_removed_rows = len(self.removed_rows)
+
+    def _save_manifest(self):
+        os.makedirs(self.folder_path, exist_ok=True)
+        manifest = {
+            "segments": self.segment_names,
+            "removed_rows": self.removed_rows,
+            "n_codes": [vocabulary.n_codes for vocabulary in self.vocabularies],
+        }
+        with open_atomic(self.manifest_path, "w") as outfile:
+            json.dump(manifest, outfile)
+
+    def _remove_unused_segments(self):
+        """Removes the segments that are not in the manifest, except for the one that is being compacted into."""
+        segment_names = set(self.segment_names)
+        if self._compaction is not None:
+            segment_names.add(self._compaction["name"])
+        remove_unused_segments(self.segments_path, segment_names)
+
+    def _start_compaction(self):
+        """
+        Merges the segments into one new segment without the removed rows. This reads and writes all rows, so it is
+        done in a background thread instead of while saving (and holding the database lock). Games can be entered and
+        removed in the meantime; the merged segment replaces the segments it was made from at the first save after it
+        is done, see _finish_compaction(). Until then, and if the program is closed before that, the segments stay as
+        they are.
+        """
+        compaction = self._prepare_compaction()
+        compaction["thread"] = threading.Thread(
+            target=run_compaction, args=(_build_compacted_segment, compaction), daemon=True
+        )
+        self._compaction = compaction
+        compaction["thread"].start()
+
+    def _prepare_compaction(self):
+        """
+        Only allowed right after saving, when all rows are in the segments.
+        @return: dict with everything that _build_compacted_segment needs, so that it does not have to use self.
+        """
+        rows_to_keep = np.sort(np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows)))
+        name, segment_path = new_segment(self.segments_path)
+        return {
+            "name": name,
+            "segment_path": segment_path,
+            "segment_names": list(self.segment_names),
+            "n_rows": self.n_saved_rows,
+            "n_removed_rows": len(self.removed_rows),
+            "rows_to_keep": rows_to_keep,
+            "row_arrays": np.stack([self.row_toon_race.array, self.row_replay.array])[:, rows_to_keep],
+            # The parts are read-only and the codes are copied, so they stay the same while the rows change.
+            "parts": [None if matrix is None else list(matrix.parts) for matrix in self.matrices],
+            "codes": [vocabulary.codes.array.copy() for vocabulary in self.vocabularies],
+            "store": "n_gram segments",
+            "failed": False,
+        }
+
+    def _finish_compaction(self):
+        """Swaps in the segment of the compaction that is running in the background, if it is done."""
+        compaction = self._compaction
+        if compaction is None or compaction["thread"].is_alive():
+            return
+        self._compaction = None
+        if not compaction["failed"]:
+            self._swap_in_compaction(compaction)
+
+    def _swap_in_compaction(self, compaction):
+        """
+        Replaces the segments that were merged with the merged segment, both in the manifest and in the matrices. The
+        rows that were added or removed after the compaction started are kept, and all rows are renumbered.
+        """
+        rows_to_keep = compaction["rows_to_keep"]
+        n_rows, n_kept = compaction["n_rows"], len(compaction["rows_to_keep"])
+        new_row = np.full(len(self.row_toon_race), -1, dtype=np.int64)
+        new_row[rows_to_keep] = np.arange(n_kept)
+        new_row[n_rows:] = np.arange(n_kept, n_kept + len(self.row_toon_race) - n_rows)
+        for n, matrix in enumerate(self.matrices, start=1):
+            if matrix is None:
+                continue
+            if compaction["parts"][n - 1] is not None:
+                n_cols = len(compaction["codes"][n - 1])
+                part = SegmentedCSR.load_part(compaction["segment_path"], f"{n}_gram", n_cols)
+            else:
+                # The matrix was made after the compaction started, the merged rows have no n_grams of this n.
+                part = sparse.csr_array((n_kept, matrix.n_cols), dtype=np.float32)
+            matrix.replace_rows(n_rows, part)
+        row_arrays = compaction["row_arrays"]
+        self.row_toon_race = GrowableArray(np.int32, np.concatenate([row_arrays[0], self.row_toon_race.array[n_rows:]]))
+        self.row_replay = GrowableArray(np.int32, np.concatenate([row_arrays[1], self.row_replay.array[n_rows:]]))
+        self.rows = {key: int(new_row[row]) for key, row in self.rows.items()}
+        self.rows_by_toon_race = {
+            toon_race_id: [int(new_row[row]) for row in rows] for toon_race_id, rows in self.rows_by_toon_race.items()
+        }
+        # The rows that were removed before the compaction started are not in the merged segment.
+        self.removed_rows = [int(new_row[row]) for row in self.removed_rows[compaction["n_removed_rows"] :]]
+        self.n_saved_removed_rows -= compaction["n_removed_rows"]
+        self.n_saved_rows += n_kept - n_rows
+        self.segment_names = [compaction["name"]] + self.segment_names[len(compaction["segment_names"]) :]
 
     def load_from_file(self):
-        folder_path = os.path.join(self.data_path, "n_gram", "earlygame")
-        self.n_grams = []
-        self._means = []
+        self._clear()
+        if not os.path.exists(self.manifest_path):
+            if os.path.exists(self._legacy_path(1)):
+                self._convert_legacy_files()
+            return
+        self.replay_ids.load_from_file()
+        with open(self.manifest_path, "r") as infile:
+            manifest = json.load(infile)
+        self.segment_names = manifest["segments"]
+        self.removed_rows = manifest["removed_rows"]
+        self.n_saved_removed_rows = len(self.removed_rows)
+        segment_paths = [os.path.join(self.segments_path, name) for name in self.segment_names]
+        segment_rows = [np.load(os.path.join(segment_path, "rows.npy")) for segment_path in segment_paths]
+        row_arrays = np.concatenate(segment_rows, axis=1) if len(segment_rows) > 0 else np.zeros((2, 0), np.int32)
+        self.row_toon_race = GrowableArray(np.int32, row_arrays[0])
+        self.row_replay = GrowableArray(np.int32, row_arrays[1])
+        self.n_saved_rows = len(self.row_toon_race)
         for n in range(1, self.HIGHEST_N + 1):
-            n_gram = pd.read_pickle(os.path.join(folder_path, f"sparse_{n}_gram.pkl"))
-            self.n_grams.append(n_gram)
-            with open(os.path.join(folder_path, f"sparse_{n}_gram_mean.pkl"), "rb") as infile:
-                self._means.append(pickle.load(infile))
+            prefix = f"{n}_gram"
+            if not any(SegmentedCSR.part_exists(segment_path, prefix) for segment_path in segment_paths):
+                if self.n_saved_rows > 0:
+                    print(
+                        f"WARNING: There are no {n}_grams in the database, probably since HIGHEST_N was changed. Press"
+                        f" \"Extract features again\" to extract them."
+                    )
+                continue
+            vocabulary = self.vocabularies[n - 1]
+            n_codes = manifest["n_codes"][n - 1] if n <= len(manifest["n_codes"]) else 0
+            for segment_path in segment_paths:
+                if SegmentedCSR.part_exists(segment_path, prefix):
+                    vocabulary.add_saved_codes(np.load(os.path.join(segment_path, f"{prefix}_codes.npy")), n_codes)
+            self.matrices[n - 1] = SegmentedCSR()
+            for segment_path, rows in zip(segment_paths, segment_rows):
+                if SegmentedCSR.part_exists(segment_path, prefix):
+                    part = SegmentedCSR.load_part(segment_path, prefix, len(vocabulary))
+                else:
+                    # The segment was saved when HIGHEST_N was lower, its games get empty n_grams.
+                    part = sparse.csr_array((rows.shape[1], len(vocabulary)), dtype=np.float32)
+                self.matrices[n - 1].add_part(part)
+        removed_rows = set(self.removed_rows)
+        for row, (toon_race_id, replay_id) in enumerate(zip(self.row_toon_race.array, self.row_replay.array)):
+            if row in removed_rows:
+                continue
+            self.rows[(int(toon_race_id), int(replay_id))] = row
+            self.rows_by_toon_race.setdefault(int(toon_race_id), []).append(row)
+        for toon_race_id in self.rows_by_toon_race:
+            self.partitions.add_player(toon_race_id)
+        self._matches_files = True
+        self._load_sums(segment_paths)
+
+    def _load_sums(self, segment_paths):
+        """
+        Sets self.sums, self.totals and the means by adding up the changes to the sums saved in the segments (see
+        _save_segment), which are much smaller than the games.
+        """
+        toon_race_ids = list(self.rows_by_toon_race)
+        for i, matrix in enumerate(self.matrices):
+            self.sums[i], self.totals[i], self._means[i] = {}, {}, {}
+            if matrix is None:
+                continue
+            prefix = f"{i + 1}_gram_sums"
+            players, sums_changes = [], []
+            for segment_path in segment_paths:
+                if SegmentedCSR.part_exists(segment_path, prefix):
+                    players.append(np.load(os.path.join(segment_path, "sums_players.npy")))
+                    sums_changes.append(SegmentedCSR.load_part(segment_path, prefix, matrix.n_cols).tocoo())
+            # The duplicates of a player and column (from different segments) are summed up by the conversion to csr.
+            player_sums = sparse.csr_array(
+                (
+                    np.concatenate([change.data for change in sums_changes]),
+                    (
+                        np.concatenate([player[change.row] for player, change in zip(players, sums_changes)]),
+                        np.concatenate([change.col for change in sums_changes]),
+                    ),
+                ),
+                shape=(len(self.player_keys), matrix.n_cols),
+            )[toon_race_ids]
+            player_sums.eliminate_zeros()
+            self._set_sums(i, toon_race_ids, player_sums, normalize(player_sums, norm="l1", axis=1))
+        self.means_not_up_to_date_toon_races = set()
+
+    def _convert_legacy_files(self):
+        """Older versions pickled a pd.DataFrame per N with one row (and one csr_array) per game."""
+        dfs = [pd.read_pickle(self._legacy_path(n)) for n in range(1, self.HIGHEST_N + 1)]
+        for i in range(len(dfs[0])):
+            self._add_row(
+                self.player_keys.add(dfs[0]["toon_race"].iloc[i]),
+                dfs[0]["replay_id"].iloc[i],
+                [df["sparse_n_gram"].iloc[i] for df in dfs],
+            )
+        self.update_means("all")
+        self.save_to_file()
+        for n in range(1, self.HIGHEST_N + 1):
+            os.remove(self._legacy_path(n))
+            # The means are no longer saved, they are calculated from the n_grams when loading.
+            legacy_mean_path = os.path.join(self.folder_path, f"sparse_{n}_gram_mean.pkl")
+            if os.path.exists(legacy_mean_path):
+                os.remove(legacy_mean_path)
+        print("Converted the n_grams to the new file format.")
 
     def enter_replay(self, player_data):
-        self.means_not_up_to_date_toon_races.add(player_data.toon_race)
+        # A game that is already in the database was saved before a crash that happened before its hash was saved.
+        if self._get_row(player_data.toon_race, player_data.replay_id) is not None:
+            return
+        toon_race_id = self.player_keys.add(player_data.toon_race)
+        self.means_not_up_to_date_toon_races.add(toon_race_id)
+        n_gram_vectors = self._add_row(toon_race_id, player_data.replay_id, player_data.n_grams)
+        for i, n_gram_vector in enumerate(n_gram_vectors):
+            self._add_to_sum(i, toon_race_id, n_gram_vector)
+
+    def _add_to_sum(self, i, toon_race_id, n_gram_vector, sign=1):
+        """Adds (or subtracts with sign=-1) a game's n_gram_vector to self.sums, in time proportional to its size."""
+        n_gram_vector = sparse.csr_array(n_gram_vector, dtype=np.float64)
+        if toon_race_id in self.sums[i]:
+            vector_sum = self.sums[i][toon_race_id]
+            # The vocabulary might have grown since the sum was last changed.
+            n_cols = max(vector_sum.shape[1], n_gram_vector.shape[1])
+            vector_sum.resize((1, n_cols))
+            n_gram_vector.resize((1, n_cols))
+            vector_sum = vector_sum + sign * n_gram_vector
+            vector_sum.eliminate_zeros()
+        else:
+            vector_sum = sign * n_gram_vector
+        self.sums[i][toon_race_id] = vector_sum
+        # .data.sum() since .sum() multiplies with a dense vector of ones as long as the row.
+        self.totals[i][toon_race_id] = self.totals[i].get(toon_race_id, 0) + sign * n_gram_vector.data.sum()
+
+    def _add_row(self, toon_race_id, replay_id, n_gram_vectors):
+        """
+        @param n_gram_vectors: [csr_array of shape (1, base**N), ...] for N = 1, ..., HIGHEST_N, in code space.
+        @return: the n_gram_vectors in column space.
+        """
+        replay_id = self.replay_ids.add(replay_id)
+        row = len(self.row_toon_race)
+        n_gram_vectors = [
+            vocabulary.to_columns(vector, add=True) for vocabulary, vector in zip(self.vocabularies, n_gram_vectors)
+        ]
         for n in range(1, self.HIGHEST_N + 1):  # n as in n_gram.
-            self.n_grams[n - 1] = pd.concat([self.n_grams[n - 1], player_data.n_grams[n - 1]], ignore_index=True)
+            if self.matrices[n - 1] is None:
+                n_cols = n_gram_vectors[n - 1].shape[1]
+                self.matrices[n - 1] = SegmentedCSR()
+                # Only happens if there are rows already when HIGHEST_N was increased, they get empty n_grams.
+                if self.n_saved_rows > 0:
+                    self.matrices[n - 1].add_part(sparse.csr_array((self.n_saved_rows, n_cols), dtype=np.float32))
+                self.matrices[n - 1].append_rows(
+                    sparse.csr_array((row - self.n_saved_rows, n_cols), dtype=np.float32)
+                )
+            self.matrices[n - 1].append_rows(n_gram_vectors[n - 1])
+        self.row_toon_race.append(toon_race_id)
+        self.row_replay.append(replay_id)
+        self.rows[(toon_race_id, replay_id)] = row
+        if toon_race_id not in self.rows_by_toon_race:
+            self.rows_by_toon_race[toon_race_id] = []
+            self.partitions.add_player(toon_race_id)
+        self.rows_by_toon_race[toon_race_id].append(row)
+        return n_gram_vectors
+
+    def _get_row(self, toon_race, replay_id):
+        """@return: the row of this game, None if it is not in the database."""
+        toon_race_id = self.player_keys.get_id(toon_race)
+        replay_id = self.replay_ids.get_id(replay_id)
+        return self.rows.get((toon_race_id, replay_id))
+
+    def get_replay_n_grams(self, toon_race, replay_id):
+        """@return: [csr_array of shape (1, base**N), ...] for N = 1, ..., HIGHEST_N, like PlayerData.n_grams."""
+        row = self._get_row(toon_race, replay_id)
+        return [
+            vocabulary.to_codes(matrix.get_rows([row])) for vocabulary, matrix in zip(self.vocabularies, self.matrices)
+        ]
+
+    def to_columns(self, n, n_gram_vector):
+        """@return: an n_gram_vector of extract_n_grams in column space, without the n_grams that were never seen."""
+        return self.vocabularies[n - 1].to_columns(n_gram_vector)
 
     def remove_replay(self, toon_race, replay_id):
         """Removes the single row from the database with the given toon_race and replay_id."""
-        self.means_not_up_to_date_toon_races.add(toon_race)
-        for n in range(1, self.HIGHEST_N + 1):
-            df = self.n_grams[n - 1]
-            bool_rows_to_keep = (df["replay_id"] != replay_id) | (df["toon_race"] != toon_race)
-            self.n_grams[n - 1] = df[bool_rows_to_keep]
-            self.n_grams[n - 1].index = np.arange(len(self.n_grams[n - 1]))  # Reset index to 0, 1, 2,... manually.
-            assert len(self.n_grams[n - 1]) == len(df) - 1
+        row = self._get_row(toon_race, replay_id)
+        assert row is not None
+        toon_race_id, replay_id = int(self.row_toon_race.array[row]), int(self.row_replay.array[row])
+        self.means_not_up_to_date_toon_races.add(toon_race_id)
+        del self.rows[(toon_race_id, replay_id)]
+        self.rows_by_toon_race[toon_race_id].remove(row)
+        if len(self.rows_by_toon_race[toon_race_id]) == 0:
+            del self.rows_by_toon_race[toon_race_id]
+            self.partitions.remove_player(toon_race_id)
+            for i in range(self.HIGHEST_N):
+                self.sums[i].pop(toon_race_id, None)
+                self.totals[i].pop(toon_race_id, None)
+        else:
+            for i, matrix in enumerate(self.matrices):
+                self._add_to_sum(i, toon_race_id, matrix.get_rows([row]), sign=-1)
+        self.removed_rows.append(row)
 
-    def update_means(self, toon_races_to_update: set, max_games_to_use=1000000):
+    def update_means(self, toon_races_to_update, max_games_to_use=None):
         """
         @param max_games_to_use: Only take this many games to build up the mean. Only used in testing either to speed
         up or to limit the amount of training data used in a quick and easy way.
         @param toon_races_to_update: Either specify a set of toon_races to update and ignore others, or set to "all" or
-        "changed" to update all or the ones that were changed since last update.
+        "changed" to update all or the ones that were changed since last update. "all" also sums up all games again.
         """
         if len(self.means_not_up_to_date_toon_races) == 0 and toon_races_to_update != "all":
             return
 
         # If we only want to update the changed values then use the self variable.
         if toon_races_to_update == "changed":
-            toon_races_to_update = copy.copy(self.means_not_up_to_date_toon_races)
-
-        # Create a mapping from toon_race to a list of rows where this player has data.
-        toon_race_to_rows = defaultdict(list)
-        for i in range(len(self.n_grams[0])):
-            t_r = self.n_grams[0].loc[i, "toon_race"]
-            toon_race_to_rows[t_r].append(i)
+            toon_race_ids_to_update = set(self.means_not_up_to_date_toon_races)
+        elif toon_races_to_update != "all":
+            toon_race_ids_to_update = {self.player_keys.get_id(toon_race) for toon_race in toon_races_to_update}
+            # Players that were never in the database have no means to update.
+            toon_race_ids_to_update.discard(None)
 
-        # Begin by resetting sparse_n_grams_mean if we want to update all of it.
         if toon_races_to_update == "all":
-            for i in range(self.HIGHEST_N):
-                self._means[i] = {}
-        # Check if the toon_race_to_update still exists in the database. If not, then remove this player from _means.
-        # Also remove this player from toon_races_to_update since it has already been updated.
-        else:
-            for toon_race in toon_races_to_update:
-                if toon_race not in toon_race_to_rows:
-                    for d in self._means:
-                        if toon_race in d:
-                            d.remove(toon_race)
-                        toon_races_to_update.remove(toon_race)
-                        self.means_not_up_to_date_toon_races.discard(toon_race)
+            toon_race_ids = list(self.rows_by_toon_race)
+            for i, matrix in enumerate(self.matrices):
+                self.sums[i], self.totals[i], self._means[i] = {}, {}, {}
+                if matrix is None:
+                    continue
+                player_sums = self._sum_games(matrix, toon_race_ids)
+                if max_games_to_use is not None:
+                    player_sums_limited = self._sum_games(matrix, toon_race_ids, max_games_to_use)
+                    player_means = normalize(player_sums_limited, norm="l1", axis=1)
+                else:
+                    player_means = normalize(player_sums, norm="l1", axis=1)
+                self._set_sums(i, toon_race_ids, player_sums, player_means)
+            self.means_not_up_to_date_toon_races = set()
+            self._log_prob_matrices = {}
+            self._inverted_indices = {}
+            self._game_log_prob_matrices = {}
+            return
+
+        changed_races = {self.partitions.race_of(toon_race_id) for toon_race_id in toon_race_ids_to_update}
+        for key in [key for key in self._log_prob_matrices if key[0] in changed_races]:
+            del self._log_prob_matrices[key]
+            self._inverted_indices.pop(key, None)
+        for key in [key for key in self._game_log_prob_matrices if key[0] in changed_races]:
+            del self._game_log_prob_matrices[key]
 
         # Update means
-        for i, df in enumerate(self.n_grams):
-            for toon_race in toon_race_to_rows:
-                if toon_race in toon_races_to_update or toon_races_to_update == "all":
-                    rows = toon_race_to_rows[toon_race]
-                    vectors = list(df.loc[rows, "sparse_n_gram"])
-                    vectors = vectors[:max_games_to_use]
-                    for vectors_i, v in enumerate(vectors):
-                        vectors[vectors_i] = v.tocoo()
-                    vector_sum = np.sum(vectors)
-                    for vectors_i, v in enumerate(vectors):
-                        vectors[vectors_i] = v.tocsr()
-                    norm_vector = normalize(vector_sum, norm="l1", axis=1)
-                    self._means[i][toon_race] = norm_vector
-
-        # Update the self.means_not_up_to_date_toon_races variable
-        if toon_races_to_update == "all":
-            self.means_not_up_to_date_toon_races = set()
-        else:
-            for toon_race in toon_races_to_update:
-                self.means_not_up_to_date_toon_races.discard(toon_race)
+        for toon_race_id in toon_race_ids_to_update:
+            for i, matrix in enumerate(self.matrices):
+                # If this player no longer has any games in the database, remove it from _means.
+                if toon_race_id not in self.rows_by_toon_race:
+                    self._means[i].pop(toon_race_id, None)
+                elif max_games_to_use is not None and len(self.rows_by_toon_race[toon_race_id]) > max_games_to_use:
+                    vector_sum = self._sum_games(matrix, [toon_race_id], max_games_to_use)
+                    self._means[i][toon_race_id] = normalize(vector_sum, norm="l1", axis=1)
+                else:
+                    self._means[i][toon_race_id] = self.sums[i][toon_race_id] / self.totals[i][toon_race_id]
+            self.means_not_up_to_date_toon_races.discard(toon_race_id)
+
+    def _set_sums(self, i, toon_race_ids, player_sums, player_means):
+        """Sets the sums, totals and means of many players at once, from csr_arrays with one row per toon_race_id."""
+        totals = player_sums.sum(axis=1)
+        player_sums, player_means = _split_rows(player_sums), _split_rows(player_means)
+        for k, toon_race_id in enumerate(toon_race_ids):
+            self.sums[i][toon_race_id] = player_sums[k]
+            self.totals[i][toon_race_id] = totals[k]
+            self._means[i][toon_race_id] = player_means[k]
+
+    def _sum_games(self, matrix, toon_race_ids, max_games_to_use=None):
+        """
+        Sums up the games of many players at once, as the product of the matrix with a 0/1 matrix that picks the rows
+        of each player.
+        @return: csr_array with one row per toon_race_id, the sum of the n_gram vectors of the player's games (or of
+        their first max_games_to_use games).
+        """
+        player_rows = [self.rows_by_toon_race[toon_race_id][:max_games_to_use] for toon_race_id in toon_race_ids]
+        n_games = [len(rows) for rows in player_rows]
+        game_rows = np.concatenate(player_rows) if len(player_rows) > 0 else np.zeros(0, dtype=np.int64)
+        picker = sparse.csr_array(
+            (np.ones(len(game_rows)), (np.repeat(np.arange(len(player_rows)), n_games), game_rows)),
+            shape=(len(player_rows), matrix.n_rows),
+        )
+        return matrix.left_multiply(picker)
+
+    def race_log_prob_matrix(self, filter_race, n, lowest_prob):
+        """
+        The means of all players of a race stacked as the rows of one matrix, with the values transformed to
+        log(X + c) - log(c) where X is the mean and c is lowest_prob. The transformed value is 0 wherever the mean is 0,
+        so the matrix is as sparse as the means, see classifiers.n_gram_classifier.n_gram_log_probs for how it is used.
+        The matrix is kept until the mean of a player of this race changes.
+        @return: (toon_race_ids, csr_array) where row k of the matrix belongs to the player toon_race_ids[k], see
+        self.player_keys.
+        """
+        self.update_means("changed")
+        key = (filter_race, n, lowest_prob)
+        if key not in self._log_prob_matrices:
+            toon_race_ids = [
+                toon_race_id
+                for toon_race_id in self.partitions.get_players(filter_race)
+                if toon_race_id in self._means[n - 1]
+            ]
+            means = [self._means[n - 1][toon_race_id] for toon_race_id in toon_race_ids]
+            n_cols = len(self.vocabularies[n - 1])
+            data = np.concatenate([mean.data for mean in means]) if len(means) > 0 else np.zeros(0)
+            indices = np.concatenate([mean.indices for mean in means]) if len(means) > 0 else np.zeros(0, np.int64)
+            indptr = np.concatenate([[0], np.cumsum([mean.nnz for mean in means], dtype=np.int64)])
+            matrix = sparse.csr_array(
+                (np.log1p(data / lowest_prob), indices, indptr), shape=(len(toon_race_ids), n_cols)
+            )
+            self._log_prob_matrices[key] = (np.array(toon_race_ids, dtype=np.int64), matrix)
+        return self._log_prob_matrices[key]
+
+    def race_game_log_prob_matrix(self, filter_race, n, lowest_prob):
+        """
+        Like race_log_prob_matrix but with the n_grams of every game of the players of the race instead of their
+        means, each normalized to sum 1, for the instance-based mode (options -> INSTANCE_BASED). Scoring a barcode
+        against all games is then a single matrix-vector product, see classifiers.n_gram_classifier.n_gram_classify.
+        The matrix is kept until a game of a player of this race is entered or removed.
+        @return: (toon_race_ids, game_players, csr_array) where row k of the matrix is a game of the player
+        toon_race_ids[game_players[k]].
+        """
+        self.update_means("changed")
+        key = (filter_race, n, lowest_prob)
+        if key not in self._game_log_prob_matrices:
+            toon_race_ids = self.partitions.get_players(filter_race)
+            player_rows = [self.rows_by_toon_race[toon_race_id] for toon_race_id in toon_race_ids]
+            n_games = np.array([len(rows) for rows in player_rows], dtype=np.int64)
+            rows = np.concatenate(player_rows) if len(player_rows) > 0 else np.zeros(0, dtype=np.int64)
+            if self.matrices[n - 1] is None:
+                matrix = sparse.csr_array((len(rows), len(self.vocabularies[n - 1])), dtype=np.float64)
+            else:
+                matrix = sparse.csr_array(normalize(self.matrices[n - 1].get_rows(rows), norm="l1", axis=1))
+                matrix.data = np.log1p(matrix.data / lowest_prob)
+            game_players = np.repeat(np.arange(len(toon_race_ids)), n_games)
+            self._game_log_prob_matrices[key] = (np.array(toon_race_ids, dtype=np.int64), game_players, matrix)
+        return self._game_log_prob_matrices[key]
+
+    def race_inverted_index(self, filter_race, n, lowest_prob):
+        """
+        Inverted index of race_log_prob_matrix: for every n_gram (column) the players that have it, weighted by
+        log(X + c) - log(c) which grows with the player's probability mass of the n_gram.
+        @return: (csc_array, column_max) where the rows are in the same order as race_log_prob_matrix and column_max is
+        the largest weight of each column (0 for n_grams no player of the race has).
+        """
+        _, matrix = self.race_log_prob_matrix(filter_race, n, lowest_prob)
+        key = (filter_race, n, lowest_prob)
+        if key not in self._inverted_indices:
+            inverted_index = matrix.tocsc()
+            column_max = np.zeros(matrix.shape[1])
+            if matrix.shape[0] > 0:
+                column_max = inverted_index.max(axis=0).toarray().ravel()
+            self._inverted_indices[key] = (inverted_index, column_max)
+        return self._inverted_indices[key]
 
     def get_mean(self):
         if len(self.means_not_up_to_date_toon_races) == 0:
@@ -143,8 +624,64 @@ class NGrams:
 
     def race_filter_mean(self, filter_race):
         self.update_means("changed")
+        toon_race_ids = self.partitions.get_players(filter_race)
         race_only_n_gram_means = []
         for d in self._means:
-            race_only_dict = {k: v for k, v in d.items() if toon_race_to_race(k) == filter_race}
+            race_only_dict = {toon_race_id: d[toon_race_id] for toon_race_id in toon_race_ids if toon_race_id in d}
             race_only_n_gram_means.append(race_only_dict)
         return race_only_n_gram_means
+
+
+def _split_rows(csr):
+    """@return: [csr_array of shape (1, n_columns), ...] one per row, faster than indexing the rows one by one."""
+    csr = sparse.csr_array(csr)
+    rows = []
+    for start, end in zip(csr.indptr[:-1], csr.indptr[1:]):
+        rows.append(
+            sparse.csr_array((csr.data[start:end], csr.indices[start:end], [0, end - start]), shape=(1, csr.shape[1]))
+        )
+    return rows
+
+
+def _player_picker(row_players, weights):
+    """
+    @param row_players: np.ndarray with the toon_race_id of each row.
+    @param weights: np.ndarray with what each row is multiplied with, e.g. -1 for rows that are subtracted.
+    @return: (players, picker) the different toon_race_ids, and a csr_array so that picker @ rows has one row per
+    player with the weighted sum of its rows.
+    """
+    players, player_of_row = np.unique(row_players, return_inverse=True)
+    picker = sparse.csr_array(
+        (weights, (player_of_row.ravel(), np.arange(len(row_players)))), shape=(len(players), len(row_players))
+    )
+    return players, picker
+
+
+def _player_sums(picker, rows):
+    """@return: csr_array picker @ rows without explicit zeros, see _player_picker."""
+    player_sums = sparse.csr_array(picker @ rows)
+    player_sums.eliminate_zeros()
+    return player_sums
+
+
+def _build_compacted_segment(compaction):
+    """
+    Writes the rows that are kept to the new segment of compaction (see NGrams._prepare_compaction), with all their
+    codes and the sums of their players.
+    """
+    segment_path = compaction["segment_path"]
+    rows_to_keep = compaction["rows_to_keep"]
+    save_array(segment_path, "rows.npy", compaction["row_arrays"])
+    players, picker = _player_picker(compaction["row_arrays"][0], np.ones(len(rows_to_keep)))
+    save_array(segment_path, "sums_players.npy", players)
+    for n, (parts, codes) in enumerate(zip(compaction["parts"], compaction["codes"]), start=1):
+        if parts is None:
+            continue
+        matrix = SegmentedCSR()
+        for part in parts:
+            matrix.add_part(part)
+        rows = matrix.get_rows(rows_to_keep)
+        rows = sparse.csr_array((rows.data, rows.indices, rows.indptr), shape=(len(rows_to_keep), len(codes)))
+        SegmentedCSR.save_part(segment_path, f"{n}_gram", rows)
+        SegmentedCSR.save_part(segment_path, f"{n}_gram_sums", _player_sums(picker, rows))
+        save_array(segment_path, f"{n}_gram_codes.npy", codes)
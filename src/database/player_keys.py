@@ -0,0 +1,53 @@
+from utils.utils import toon_race_to_race, toon_race_to_toon
+from database.key_table import KeyTable
+
+
+class PlayerKeys(KeyTable):
+    """
+    Gives every player, a (toon, race) pair, a small integer id that is shared by all parts of the database. The
+    toon_race string of a player (e.g. "('2-S2-1-788178', 'Zerg')") is only parsed once, when it is first seen, and
+    the race is normalized so that the same player in a client of another language (e.g. 'Зерги') gets the same id.
+    Everything else refers to players by their id, the toon_race strings are only used when showing results.
+
+    self.keys: [toon_race, ...] the toon_race with the normalized race of each id, this is what is stored in the file.
+    self.ids: {toon_race: id, ...} also holds the other spellings of a toon_race that have been seen.
+    self.toons / self.races: [toon, ...] / [race, ...] the toon and the normalized race of each id.
+    """
+
+    def __init__(self, file_path):
+        super().__init__(file_path)
+        self.toons = []
+        self.races = []
+
+    def get_id(self, toon_race):
+        """@return: the id of the player, None if it has never been added."""
+        key_id = self.ids.get(toon_race)
+        if key_id is None:
+            key_id = self.ids.get(str((toon_race_to_toon(toon_race), toon_race_to_race(toon_race))))
+            if key_id is not None:
+                self.ids[toon_race] = key_id
+        return key_id
+
+    def add(self, toon_race):
+        """@return: the id of the player, which is given a new id if it is not already in the table."""
+        key_id = self.ids.get(toon_race)
+        if key_id is None:
+            toon, race = toon_race_to_toon(toon_race), toon_race_to_race(toon_race)
+            key = str((toon, race))
+            key_id = self.ids.get(key)
+            if key_id is None:
+                key_id = super().add(key)
+                self.toons.append(toon)
+                self.races.append(race)
+            self.ids[toon_race] = key_id
+        return key_id
+
+    def load_from_file(self):
+        self.toons = []
+        self.races = []
+        super().load_from_file()
+
+    def reset_file(self):
+        super().reset_file()
+        self.toons = []
+        self.races = []
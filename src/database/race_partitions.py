@@ -0,0 +1,40 @@
+class RacePartitions:
+    """
+    Keeps the players of each race apart, so that work that only needs one race (e.g. classifying a Zerg) only goes
+    through the players of that race. The race of a player is looked up in the PlayerKeys, where it was parsed once
+    when the player was first seen.
+
+    self.players: {race: {toon_race_id: None, ...}, ...} the players that have data, in the order they were added (a
+    dict is used as an ordered set).
+    self.n_changes: {race: int, ...} increases whenever a player of the race is added, removed or changed, so that
+    results calculated for a race can tell whether they are out of date.
+    """
+
+    def __init__(self, player_keys):
+        self.player_keys = player_keys
+        self.players = {}
+        self.n_changes = {}
+
+    def race_of(self, toon_race_id):
+        return self.player_keys.races[toon_race_id]
+
+    def add_player(self, toon_race_id):
+        race = self.race_of(toon_race_id)
+        self.players.setdefault(race, {})[toon_race_id] = None
+        self.mark_changed(race)
+
+    def remove_player(self, toon_race_id):
+        race = self.race_of(toon_race_id)
+        self.players[race].pop(toon_race_id, None)
+        self.mark_changed(race)
+
+    def mark_changed(self, race):
+        self.n_changes[race] = self.n_changes.get(race, 0) + 1
+
+    def mark_all_changed(self):
+        for race in self.players:
+            self.mark_changed(race)
+
+    def get_players(self, race):
+        """@return: [toon_race_id, ...] the players of the race that have data."""
+        return list(self.players.get(race, {}))
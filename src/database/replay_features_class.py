@@ -1,29 +1,66 @@
 import json
 import os
-import copy
+import threading
 
 import pandas as pd
 import numpy as np
 
-from utils.utils import toon_race_to_race
+from utils.utils import open_atomic
+from database.key_table import KeyTable
+from database.growable_arrays import GrowableArray, GrowableMatrix
+from database.race_partitions import RacePartitions
+from database.segments import save_array, new_segment, remove_unused_segments, run_compaction
 
 
 class ReplayFeatures:
     """Holds data structure for replay features. This is mostly database related, the many big functions for extracting
     features are located in the imported extract_features function.
 
-    self.features: A dictionary where the keys are toon_race and the values are pandas DataFrames with all the
-    features as columns and index is the replay_hash. visually, {toon_race: pd.DataFrame, ...} with pd.Dataframe being:
-    index,        feature1,     feature2, ...
-    ---------------------------------------
-    replay_id1,    value11,      value12, ...
-    replay_id2,    value21,      value22, ...
+    The features of all games are kept in one long table with one row per game of a player:
+    row,    toon_race_id,   replay_id,    feature1,     feature2, ...
+    ---------------------------------------------------------------
+    0,      toon_race_id0,  replay_id0,   value01,      value02, ...
+    1,      toon_race_id1,  replay_id1,   value11,      value12, ...
     .
     .
     .
-    for each player_toon.
+    self.columns: [feature, ...] the names of the features, in column order. toon and race are not columns since they
+    are already given by the toon_race of the row.
+    self.values: GrowableMatrix of float32 with the feature columns. A feature that was added after some games were
+    entered (e.g. a new extractor) is NaN for those games.
+    self.player_keys: PlayerKeys shared with the rest of the database that gives every toon_race an id, so that
+    self.player_keys[toon_race_id] is the toon_race.
+    self.replay_ids: KeyTable that gives every replay hash an id.
+    self.row_toon_race: GrowableArray so that self.row_toon_race.array[row] is the toon_race_id of the row.
+    self.row_replay: GrowableArray so that self.row_replay.array[row] is the replay_id of the row.
+    self.rows: {(toon_race_id, replay_id): row, ...} for every row that has not been removed.
+    self.rows_by_toon_race: {toon_race_id: [row, ...], ...} the rows of each player in the order they were entered,
+    without removed rows. This is the index behind the per-player views, see get_player_features().
+    self.partitions: RacePartitions with the toon_race_ids of the players of each race.
+    self.removed_rows: [row, ...] removed rows are only dropped from the table when the segments are compacted, until
+    then they are just not referred to by self.rows and self.rows_by_toon_race.
 
-    self._stats: dict with keys "mean", "std", "general" that each have the value of a pd.DataFrame with toon_race as index and
+    On disk, the table is stored in segments like the n_grams (see NGrams): folders in self.segments_path which each
+    hold the rows that were added between two saves, as raw .npy arrays. The manifest (replay_features_manifest.json)
+    lists the segments in order, as well as self.removed_rows and self.columns, and is replaced last when saving. A
+    segment has the columns there were when it was saved, the columns that were added later are NaN for its rows. When
+    there are more than SEGMENTS_TO_COMPACT segments, or more removed rows than rows, they are merged into one in a
+    background thread.
+    self.segment_names: the segments of the manifest.
+    self.n_saved_rows: the number of rows in the segments, the others are only in memory.
+    self._compaction: the compaction that is running in the background, see _start_compaction(), None if there is none.
+    The stats are not saved, they are calculated from the table when loading.
+
+    The stats are kept up to date with running (Welford) accumulators, so that entering or removing a game takes time
+    proportional to the number of features, however many games the player has. They have one row per toon_race_id and
+    one column per feature:
+    self._counts: the number of games of the player with a value (not NaN) for the feature.
+    self._means: the mean of those values, 0 if there are none.
+    self._m2s: the sum of squared differences from the mean, so that the variance is self._m2s / (self._counts - 1).
+    self._mean_sums / self._mean_counts / self._std_sums: per feature, the sum of the means (over the players that
+    have a value), how many players that is, and the sum of the stds of all players. These make up self._overall_stats.
+
+    self._stats: dict with keys "mean", "std", "general" that each have the value of a pd.DataFrame with toon_race_id as index and
     features as columns. "std" takes the standard deviation. If there is only 1 game std will be 0. "generaL" holds the
     columns toon / race / n_games where n_games is the number of games from this player which helps Bayesian type
     classifier know accurate the mean and std are.
@@ -31,186 +68,521 @@ class ReplayFeatures:
     self._overall_stats: {average_mean: value, average_std: value} where average refers to the mean of the stat for
     each player.
 
-    self.stats_not_up_to_date_toon_races: This variable states which toon_races have un-updated mean data.
-    The purpose is to allow changing the data multiple times without updating the mean, but we also
-    guarantee than whenever the "get_means()" method is called then the means will first be updated if necessary.
-    This is why direct access to the "_means" variable should be considered private, since it might not be up to date.
+    self._race_stats: {race: (n_changes, stats), ...} the stats of the players of a race, built by race_filter_stats()
+    from only that race's running stats and kept until self.partitions.n_changes[race] changes.
+    self._stats_up_to_date: self._stats and self._overall_stats are built from the accumulators when they are asked for,
+    this states whether the data has changed since they were last built. This is why direct access to the "_stats"
+    variable should be considered private, since it might not be up to date.
+    self.n_changes: increases whenever the data changes, so that results calculated from it can tell whether they are
+    out of date, see DBMS.get_feature_relevances().
+    self._matches_files: False for a ReplayFeatures that was built without loading the files, e.g. while extracting
+    features again, the replay_ids file is then rewritten the first time it is saved.
     """
 
-    def __init__(self, data_path):
+    # Entries of PlayerData.features that are not columns, they are given by the toon_race.
+    KEY_FEATURES = ("toon", "race")
+    SEGMENTS_TO_COMPACT = 8
+
+    def __init__(self, data_path, player_keys):
         self.data_path = data_path
-        self.features = {}
+        self.player_keys = player_keys
+        self.folder_path = os.path.join(data_path, "features")
+        self.segments_path = os.path.join(self.folder_path, "segments")
+        self.manifest_path = os.path.join(self.folder_path, "replay_features_manifest.json")
+        self.n_changes = 0
+        self._clear()
+
+    def __getstate__(self):
+        """Used by copy.deepcopy, a compaction that is running in the background stays with the original."""
+        state = self.__dict__.copy()
+        state["_compaction"] = None
+        return state
+
+    def _clear(self):
+        self.columns = []
+        self._column_ids = {}
+        self.values = GrowableMatrix(np.float32)
+        self.replay_ids = KeyTable(os.path.join(self.folder_path, "replay_ids.txt"))
+        self.row_toon_race = GrowableArray(np.int32)
+        self.row_replay = GrowableArray(np.int32)
+        self.rows = {}
+        self.rows_by_toon_race = {}
+        self.partitions = RacePartitions(self.player_keys)
+        self.removed_rows = []
+        self.segment_names = []
+        self.n_saved_rows = 0
+        self._compaction = None
+        self._counts = GrowableMatrix(np.float64, fill_value=0)
+        self._means = GrowableMatrix(np.float64, fill_value=0)
+        self._m2s = GrowableMatrix(np.float64, fill_value=0)
+        self._mean_sums = np.zeros(0)
+        self._mean_counts = np.zeros(0)
+        self._std_sums = np.zeros(0)
         self._stats = {"mean": pd.DataFrame(), "std": pd.DataFrame(), "general": pd.DataFrame()}
         self._overall_stats = {"average_mean": {}, "average_std": {}}
-        self.stats_not_up_to_date_toon_races = set()
+        self._race_stats = {}
+        self._stats_up_to_date = False
+        self._matches_files = False
+        self.n_changes += 1
 
     def update_stats(self):
-        """Updates the stats of the features for all players that are not already up to date."""
-        if len(self.stats_not_up_to_date_toon_races) == 0:
+        """Builds self._stats and self._overall_stats from the running stats, if the data has changed since last time."""
+        if self._stats_up_to_date:
             return
+        toon_race_ids = list(self.rows_by_toon_race)
+        mean, std = self._player_stats(toon_race_ids)
+        self._stats["mean"] = pd.DataFrame(mean, index=toon_race_ids, columns=self.columns)
+        self._stats["std"] = pd.DataFrame(std, index=toon_race_ids, columns=self.columns)
 
-        toon_races_to_update = copy.copy(self.stats_not_up_to_date_toon_races)
-
-        toons = []
-        races = []
-        n_games_list = []
-        for toon_race_to_update in toon_races_to_update:
-            # If this player no longer exist in the database.
-            if toon_race_to_update not in self.features:
-                if toon_race_to_update in self._stats["mean"].index:
-                    self._stats["mean"].drop(toon_race_to_update, inplace=True)
-                    self._stats["std"].drop(toon_race_to_update, inplace=True)
-                self.stats_not_up_to_date_toon_races.discard(toon_race_to_update)
-                continue
+        # Add general stats: race + toon + n_games
+        self._stats["general"] = self._general_stats(toon_race_ids)
 
-            data = self.features[toon_race_to_update]
-            n_games = len(data)
-            # If this player has features from 0 games (if all added were removed), remove from the mean df.
-            if n_games == 0:
-                if toon_race_to_update in self._stats["mean"].index:
-                    self._stats["mean"].drop(toon_race_to_update, inplace=True)
-                    self._stats["std"].drop(toon_race_to_update, inplace=True)
-                self.stats_not_up_to_date_toon_races.discard(toon_race_to_update)
-                continue
+        # Update self._overall_stats, the mean over the players like pd.DataFrame.mean() which leaves out NaN.
+        with np.errstate(invalid="ignore", divide="ignore"):
+            average_mean = self._mean_sums / self._mean_counts
+            average_std = self._std_sums / len(toon_race_ids)
+        self._overall_stats["average_mean"] = dict(zip(self.columns, average_mean.tolist()))
+        self._overall_stats["average_std"] = dict(zip(self.columns, average_std.tolist()))
+        self._stats_up_to_date = True
 
-            # Calculate stats for this player
-            n_games_list.append(n_games)
-            toons.append(data["toon"].iloc[0])  # The 0 is arbitrary, is the same for every game.
-            races.append(data["race"].iloc[0])
-
-            number_data = data.select_dtypes(include=[np.number])
-            number_data_mean = pd.Series(number_data.mean(axis=0), name=toon_race_to_update)
-            number_data_std = pd.Series(number_data.std(axis=0), name=toon_race_to_update)
-            number_data_std.fillna(0, inplace=True)  # If there were only 1 game std becomes NaN, swap to 0.
-
-            # Update self._stats.
-            if toon_race_to_update in self._stats["mean"].index:
-                self._stats["mean"].loc[toon_race_to_update] = number_data_mean
-            else:
-                self._stats["mean"] = pd.concat([self._stats["mean"], pd.DataFrame(number_data_mean).T])
-            if toon_race_to_update in self._stats["std"].index:
-                self._stats["std"].loc[toon_race_to_update] = number_data_std
-            else:
-                self._stats["std"] = pd.concat([self._stats["std"], pd.DataFrame(number_data_std).T])
-            self.stats_not_up_to_date_toon_races.discard(toon_race_to_update)
-        assert self.stats_not_up_to_date_toon_races == set()
+    def _general_stats(self, toon_race_ids):
+        """@return: pd.DataFrame with the columns race / toon / n_games of the players and toon_race_id as index."""
+        return pd.DataFrame(
+            {
+                "race": [self.player_keys.races[toon_race_id] for toon_race_id in toon_race_ids],
+                "toon": [self.player_keys.toons[toon_race_id] for toon_race_id in toon_race_ids],
+                "n_games": [len(self.rows_by_toon_race[toon_race_id]) for toon_race_id in toon_race_ids],
+            },
+            index=toon_race_ids,
+        )
 
-        # Add general stats: race + toon + n_games
-        self._stats["general"] = pd.DataFrame({"race": races, "toon": toons, "n_games": n_games_list},
-                                              index=[str(toon_race) for toon_race in zip(toons, races)])
+    def _player_stats(self, toon_race_ids):
+        """
+        @param toon_race_ids: an id or a list of ids.
+        @return: (mean, std) of the features of the players, mean is NaN for features without values and std is 0 if
+        there are fewer than 2 values.
+        """
+        counts = self._counts.array[toon_race_ids]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(counts > 0, self._means.array[toon_race_ids], np.nan)
+            std = np.where(counts > 1, np.sqrt(np.maximum(self._m2s.array[toon_race_ids], 0) / (counts - 1)), 0)
+        return mean, std
+
+    def _add_to_overall_stats(self, toon_race_id, sign=1):
+        """Adds (or subtracts with sign=-1) the player's stats to the sums behind self._overall_stats."""
+        if toon_race_id not in self.rows_by_toon_race:
+            return
+        mean, std = self._player_stats(toon_race_id)
+        has_mean = ~np.isnan(mean)
+        self._mean_sums += sign * np.where(has_mean, mean, 0)
+        self._mean_counts += sign * has_mean
+        self._std_sums += sign * std
+
+    def _add_to_running_stats(self, toon_race_id, values, sign=1):
+        """Adds (or removes with sign=-1) a game's feature values to the player's running stats."""
+        is_value = ~np.isnan(values)
+        values = np.where(is_value, values, 0).astype(np.float64)
+        # Views of the player's row, so they are changed in place.
+        counts = self._counts.array[toon_race_id]
+        means = self._means.array[toon_race_id]
+        m2s = self._m2s.array[toon_race_id]
+        counts += sign * is_value
+        deltas = values - means
+        means += sign * np.where(is_value, deltas / np.maximum(counts, 1), 0)
+        m2s += sign * np.where(is_value, deltas * (values - means), 0)
+        # Features without values left start again from 0, which also drops any rounding errors.
+        means[counts == 0] = 0
+        m2s[counts == 0] = 0
 
-        # Update self._overall_stats.
-        number_data = self._stats["mean"].select_dtypes(include=[np.number])
-        self._overall_stats["average_mean"] = number_data.mean().to_dict()
-        number_data = self._stats["std"].select_dtypes(include=[np.number])
-        self._overall_stats["average_std"] = number_data.mean().to_dict()
+    def _calculate_running_stats(self):
+        """Calculates the running stats from the table, e.g. after loading."""
+        n_cols = len(self.columns)
+        counts = np.zeros((len(self.player_keys), n_cols))
+        means = np.zeros((len(self.player_keys), n_cols))
+        m2s = np.zeros((len(self.player_keys), n_cols))
+        toon_race_ids = list(self.rows_by_toon_race)
+        if len(toon_race_ids) > 0:
+            player_rows = list(self.rows_by_toon_race.values())
+            n_games = np.array([len(rows) for rows in player_rows])
+            starts = np.concatenate([[0], np.cumsum(n_games)[:-1]])
+            values = self.values.array[np.concatenate(player_rows)].astype(np.float64)
+            is_value = ~np.isnan(values)
+            counts[toon_race_ids] = np.add.reduceat(is_value, starts, axis=0)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                player_means = np.add.reduceat(np.where(is_value, values, 0), starts, axis=0) / counts[toon_race_ids]
+            means[toon_race_ids] = np.nan_to_num(player_means)
+            deviations = np.where(is_value, values - np.repeat(means[toon_race_ids], n_games, axis=0), 0)
+            m2s[toon_race_ids] = np.add.reduceat(deviations**2, starts, axis=0)
+        self._counts = GrowableMatrix(np.float64, counts, fill_value=0)
+        self._means = GrowableMatrix(np.float64, means, fill_value=0)
+        self._m2s = GrowableMatrix(np.float64, m2s, fill_value=0)
+        self._mean_sums = np.zeros(n_cols)
+        self._mean_counts = np.zeros(n_cols)
+        self._std_sums = np.zeros(n_cols)
+        if len(toon_race_ids) > 0:
+            mean, std = self._player_stats(toon_race_ids)
+            self._mean_sums = np.nansum(mean, axis=0)
+            self._mean_counts = (~np.isnan(mean)).sum(axis=0).astype(np.float64)
+            self._std_sums = std.sum(axis=0)
+        self._stats_up_to_date = False
+
+    def _legacy_path(self, filename="replay_features.json"):
+        """Older versions saved the features and stats as JSON files directly in data_path."""
+        return os.path.join(self.data_path, filename)
 
     def reset_files(self):
-        for filename in ["replay_features.json", "player_mean_features.json", "player_std_features.json", "player_general_features.json"]:
-            file_path = os.path.join(self.data_path, filename)
-            with open(file_path, "w") as f:
-                f.write("{}")
-        with open(os.path.join(self.data_path, "overall_stats.json"), 'w') as f:
-            json.dump({"average_mean": {}, "average_std": {}}, f)
+        self._clear()
+        os.makedirs(self.folder_path, exist_ok=True)
+        self.replay_ids.reset_file()
+        self._matches_files = True
+        self.save_to_file()
+        self._remove_legacy_files()
 
     def save_to_file(self):
-        self.update_stats()
-        # Save features.
-        with open(os.path.join(self.data_path, "replay_features.json"), "w") as outfile:
-            rep_f = {}
-            for key in self.features:
-                rep_f[key] = json.loads(self.features[key].to_json())  # to_json() makes a string, I want dict.
-            json.dump(rep_f, outfile)
-        # Save player stats.
-        with open(os.path.join(self.data_path, "player_mean_features.json"), "w") as outfile:
-            json.dump(self._stats["mean"].to_json(), outfile)
-        with open(os.path.join(self.data_path, "player_std_features.json"), "w") as outfile:
-            json.dump(self._stats["std"].to_json(), outfile)
-        with open(os.path.join(self.data_path, "player_general_features.json"), "w") as outfile:
-            json.dump(self._stats["general"].to_json(), outfile)
-        # Save overall stats.
-        with open(os.path.join(self.data_path, "overall_stats.json"), "w") as outfile:
-            json.dump(self._overall_stats, outfile)
+        """Only the rows added since the last save are written, as a new segment."""
+        os.makedirs(self.folder_path, exist_ok=True)
+        # The keys are saved first since the table refers to them.
+        self.player_keys.save_to_file()
+        self.replay_ids.save_to_file(rewrite=not self._matches_files)
+        self._matches_files = True
+        self._finish_compaction()
+        if len(self.row_toon_race) > self.n_saved_rows:
+            self._save_segment()
+        too_many_segments = len(self.segment_names) > self.SEGMENTS_TO_COMPACT
+        if self._compaction is None and (too_many_segments or len(self.removed_rows) > len(self.rows)):
+            self._start_compaction()
+        self._save_manifest()
+        segment_names = set(self.segment_names)
+        if self._compaction is not None:
+            segment_names.add(self._compaction["name"])
+        remove_unused_segments(self.segments_path, segment_names)
+
+    def _save_segment(self):
+        """Writes the rows that are only in memory to a new segment."""
+        name, segment_path = new_segment(self.segments_path)
+        row_arrays = np.stack([self.row_toon_race.array, self.row_replay.array])[:, self.n_saved_rows :]
+        save_array(segment_path, "rows.npy", row_arrays)
+        save_array(segment_path, "values.npy", self.values.array[self.n_saved_rows :])
+        self.segment_names.append(name)
+        self.n_saved_rows = len(self.row_toon_race)
+
+    def _save_manifest(self):
+        manifest = {"segments": self.segment_names, "removed_rows": self.removed_rows, "columns": self.columns}
+        with open_atomic(self.manifest_path, "w") as outfile:
+            json.dump(manifest, outfile)
+
+    def _start_compaction(self):
+        """
+        Merges the segments into one new segment without the removed rows, in a background thread so that saving does
+        not wait for the whole table to be written again. The merged segment replaces the segments it was made from at
+        the first save after it is done, see _finish_compaction().
+        """
+        rows_to_keep = np.sort(np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows)))
+        name, segment_path = new_segment(self.segments_path)
+        compaction = {
+            "name": name,
+            "segment_path": segment_path,
+            "segment_names": list(self.segment_names),
+            "n_rows": self.n_saved_rows,
+            "n_removed_rows": len(self.removed_rows),
+            "rows_to_keep": rows_to_keep,
+            # Copies, so that the table can be changed while they are written.
+            "row_arrays": np.stack([self.row_toon_race.array, self.row_replay.array])[:, rows_to_keep],
+            "values": self.values.array[rows_to_keep],
+            "store": "replay feature segments",
+            "failed": False,
+        }
+        compaction["thread"] = threading.Thread(
+            target=run_compaction, args=(_build_compacted_segment, compaction), daemon=True
+        )
+        self._compaction = compaction
+        compaction["thread"].start()
+
+    def _finish_compaction(self):
+        """
+        Swaps in the segment of the compaction that is running in the background, if it is done. The rows that were
+        added or removed after the compaction started are kept, and all rows are renumbered.
+        """
+        compaction = self._compaction
+        if compaction is None or compaction["thread"].is_alive():
+            return
+        self._compaction = None
+        if compaction["failed"]:
+            return
+        n_rows = compaction["n_rows"]
+        rows_to_keep = np.concatenate([compaction["rows_to_keep"], np.arange(n_rows, len(self.row_toon_race))])
+        new_row = np.full(len(self.row_toon_race), -1, dtype=np.int64)
+        new_row[rows_to_keep] = np.arange(len(rows_to_keep))
+        self.values.keep(rows=rows_to_keep)
+        self.row_toon_race = GrowableArray(np.int32, self.row_toon_race.array[rows_to_keep])
+        self.row_replay = GrowableArray(np.int32, self.row_replay.array[rows_to_keep])
+        self.rows = {key: int(new_row[row]) for key, row in self.rows.items()}
+        self.rows_by_toon_race = {
+            toon_race_id: [int(new_row[row]) for row in rows] for toon_race_id, rows in self.rows_by_toon_race.items()
+        }
+        # The rows that were removed before the compaction started are not in the merged segment.
+        self.removed_rows = [int(new_row[row]) for row in self.removed_rows[compaction["n_removed_rows"] :]]
+        self.n_saved_rows += len(compaction["rows_to_keep"]) - n_rows
+        self.segment_names = [compaction["name"]] + self.segment_names[len(compaction["segment_names"]) :]
 
     def load_from_file(self):
-        # Load features.
-        file_path = os.path.join(self.data_path, "replay_features.json")
-        with open(file_path, "r") as infile:
-            self.features = json.load(infile)
-        for key, data in self.features.items():
-            self.features[key] = pd.DataFrame(data)
-            self.features[key].index.name = "replay_hash"
-        # Load mean.
-        with open(os.path.join(self.data_path, "player_mean_features.json"), "r") as f:
-            json_object = json.load(f)
-        if json_object == {}:  # Separate empty case since for some reason this crashes the read_json.
-            self._stats["mean"] = pd.DataFrame(json_object)
-        else:
-            self._stats["mean"] = pd.read_json(json_object)
-        # Load std.
-        with open(os.path.join(self.data_path, "player_std_features.json"), "r") as f:
-            json_object = json.load(f)
-        if json_object == {}:  # Separate empty case since for some reason this crashes the read_json.
-            self._stats["std"] = pd.DataFrame(json_object)
-        else:
-            self._stats["std"] = pd.read_json(json_object)
-        # Load general.
-        with open(os.path.join(self.data_path, "player_general_features.json"), "r") as f:
-            json_object = json.load(f)
-        if json_object == {}:  # Separate empty case since for some reason this crashes the read_json.
-            self._stats["general"] = pd.DataFrame(json_object)
-        else:
-            self._stats["general"] = pd.read_json(json_object)
-        # Load overall stats.
-        with open(os.path.join(self.data_path, "overall_stats.json"), 'r') as f:
-            self._overall_stats = json.load(f)
+        self._clear()
+        if not os.path.exists(self.manifest_path):
+            if os.path.exists(self._legacy_path()):
+                self._convert_legacy_files()
+            return
+        self.replay_ids.load_from_file()
+        with open(self.manifest_path, "r") as infile:
+            manifest = json.load(infile)
+        self.segment_names = manifest["segments"]
+        self.removed_rows = manifest["removed_rows"]
+        self.columns = manifest["columns"]
+        segment_paths = [os.path.join(self.segments_path, name) for name in self.segment_names]
+        row_arrays = [np.load(os.path.join(segment_path, "rows.npy")) for segment_path in segment_paths]
+        row_arrays = np.concatenate(row_arrays, axis=1) if len(row_arrays) > 0 else np.zeros((2, 0), np.int32)
+        values = np.full((row_arrays.shape[1], len(self.columns)), np.nan, dtype=np.float32)
+        start = 0
+        for segment_path in segment_paths:
+            # Columns that were added after the segment was saved stay NaN.
+            segment_values = np.load(os.path.join(segment_path, "values.npy"))
+            values[start : start + len(segment_values), : segment_values.shape[1]] = segment_values
+            start += len(segment_values)
+        self.values = GrowableMatrix(np.float32, values)
+        self.row_toon_race = GrowableArray(np.int32, row_arrays[0])
+        self.row_replay = GrowableArray(np.int32, row_arrays[1])
+        self.n_saved_rows = len(self.row_toon_race)
+        self._column_ids = {column: i for i, column in enumerate(self.columns)}
+        removed_rows = set(self.removed_rows)
+        for row, (toon_race_id, replay_id) in enumerate(zip(self.row_toon_race.array, self.row_replay.array)):
+            if row in removed_rows:
+                continue
+            self.rows[(int(toon_race_id), int(replay_id))] = row
+            self.rows_by_toon_race.setdefault(int(toon_race_id), []).append(row)
+        for toon_race_id in self.rows_by_toon_race:
+            self.partitions.add_player(toon_race_id)
+        self._calculate_running_stats()
+        self._matches_files = True
+
+    def _convert_legacy_files(self):
+        """Older versions saved a JSON dict with one pd.DataFrame per toon_race, and the stats as JSON."""
+        with open(self._legacy_path(), "r") as infile:
+            replay_features = json.load(infile)
+        for toon_race, data in replay_features.items():
+            for replay_id, features in pd.DataFrame(data).iterrows():
+                self._add_row(self.player_keys.add(toon_race), replay_id, features.to_dict())
+        self.save_to_file()
+        self._remove_legacy_files()
+        print("Converted the replay features to the new file format.")
+
+    def _remove_legacy_files(self):
+        for filename in [
+            "replay_features.json",
+            "player_mean_features.json",
+            "player_std_features.json",
+            "player_general_features.json",
+            "overall_stats.json",
+        ]:
+            if os.path.exists(self._legacy_path(filename)):
+                os.remove(self._legacy_path(filename))
 
     def enter_replay(self, player_data):
-        self.stats_not_up_to_date_toon_races.add(player_data.toon_race)
-        features = player_data.features
-        toon_race = player_data.toon_race
-        replay_id = player_data.replay_id
-
-        if toon_race in self.features:
-            self.features[toon_race] = pd.concat(
-                [self.features[toon_race], pd.DataFrame([features], index=[replay_id])]
-            )
+        # A game that is already in the table was saved before a crash that happened before its hash was saved.
+        if self._get_row(player_data.toon_race, player_data.replay_id) is not None:
+            return
+        self._add_row(self.player_keys.add(player_data.toon_race), player_data.replay_id, player_data.features)
+
+    def _add_row(self, toon_race_id, replay_id, features):
+        """@param features: {feature: value, ...} e.g. PlayerData.features, KEY_FEATURES are left out."""
+        features = {feature: value for feature, value in features.items() if feature not in self.KEY_FEATURES}
+        new_columns = [feature for feature in features if feature not in self._column_ids]
+        if len(new_columns) > 0:
+            for matrix in [self.values, self._counts, self._means, self._m2s]:
+                matrix.add_columns(len(new_columns))
+            self._mean_sums = np.concatenate([self._mean_sums, np.zeros(len(new_columns))])
+            self._mean_counts = np.concatenate([self._mean_counts, np.zeros(len(new_columns))])
+            self._std_sums = np.concatenate([self._std_sums, np.zeros(len(new_columns))])
+            for feature in new_columns:
+                self._column_ids[feature] = len(self.columns)
+                self.columns.append(feature)
+        row_values = np.full(len(self.columns), np.nan, dtype=np.float32)
+        row_values[[self._column_ids[feature] for feature in features]] = list(features.values())
+
+        replay_id = self.replay_ids.add(replay_id)
+        row = len(self.row_toon_race)
+        self.values.append(row_values)
+        self.row_toon_race.append(toon_race_id)
+        self.row_replay.append(replay_id)
+        self.rows[(toon_race_id, replay_id)] = row
+
+        # The player's old stats are taken out of the overall stats and put back in when updated.
+        self._add_to_overall_stats(toon_race_id, sign=-1)
+        for matrix in [self._counts, self._means, self._m2s]:
+            while len(matrix) <= toon_race_id:
+                matrix.append(np.zeros(len(self.columns)))
+        self._add_to_running_stats(toon_race_id, row_values)
+        if toon_race_id not in self.rows_by_toon_race:
+            self.rows_by_toon_race[toon_race_id] = []
+            self.partitions.add_player(toon_race_id)
         else:
-            self.features[toon_race] = pd.DataFrame([features], index=[replay_id])
-        self.features[toon_race].index.name = "replay_hash"
+            self.partitions.mark_changed(self.partitions.race_of(toon_race_id))
+        self.rows_by_toon_race[toon_race_id].append(row)
+        self._add_to_overall_stats(toon_race_id)
+        self._stats_up_to_date = False
+        self.n_changes += 1
+
+    def _get_row(self, toon_race, replay_id):
+        """@return: the row of the game, None if it is not in the table."""
+        return self.rows.get((self.player_keys.get_id(toon_race), self.replay_ids.get_id(replay_id)))
 
     def remove_replay(self, toon_race, replay_id):
-        self.stats_not_up_to_date_toon_races.add(toon_race)
-        assert replay_id in self.features[toon_race].index
-        self.features[toon_race] = self.features[toon_race].drop(replay_id)
+        row = self._get_row(toon_race, replay_id)
+        assert row is not None
+        toon_race_id, replay_id = int(self.row_toon_race.array[row]), int(self.row_replay.array[row])
+        self._add_to_overall_stats(toon_race_id, sign=-1)
+        self._add_to_running_stats(toon_race_id, self.values.array[row], sign=-1)
+        del self.rows[(toon_race_id, replay_id)]
+        self.rows_by_toon_race[toon_race_id].remove(row)
+        if len(self.rows_by_toon_race[toon_race_id]) == 0:
+            del self.rows_by_toon_race[toon_race_id]
+            self.partitions.remove_player(toon_race_id)
+        else:
+            self.partitions.mark_changed(self.partitions.race_of(toon_race_id))
+        self._add_to_overall_stats(toon_race_id)
+        self.removed_rows.append(row)
+        self._stats_up_to_date = False
+        self.n_changes += 1
+
+    def get_player_features(self, toon_race):
+        """
+        @return: pd.DataFrame with the features of each game of the player as columns and the replay hash as index,
+        None if the player has no games. It is a copy, changing it does not change the table.
+        """
+        return self._player_features(self.player_keys.get_id(toon_race))
+
+    def _player_features(self, toon_race_id):
+        rows = self.rows_by_toon_race.get(toon_race_id)
+        if rows is None:
+            return None
+        replay_ids = [self.replay_ids[replay_id] for replay_id in self.row_replay.array[rows]]
+        return pd.DataFrame(
+            self.values.array[rows], columns=self.columns, index=pd.Index(replay_ids, name="replay_hash")
+        )
+
+    def get_features_by_toon_race(self):
+        """@return: {toon_race: pd.DataFrame, ...} with the features of every player, see get_player_features()."""
+        return {
+            self.player_keys[toon_race_id]: self._player_features(toon_race_id)
+            for toon_race_id in self.rows_by_toon_race
+        }
+
+    def get_replay_features(self, toon_race, replay_id):
+        """@return: {feature: value, ...} of a single game, like PlayerData.features."""
+        row = self._get_row(toon_race, replay_id)
+        assert row is not None
+        toon_race_id = int(self.row_toon_race.array[row])
+        toon, race = self.player_keys.toons[toon_race_id], self.player_keys.races[toon_race_id]
+        return {"toon": toon, "race": race, **dict(zip(self.columns, self.values.array[row].tolist()))}
+
+    def get_player_variances(self):
+        """
+        @return: (variances, n_games) with a row per player in self.rows_by_toon_race. variances[i, j] is the variance
+        of feature j over the games of player i (NaN if fewer than 2 of them have a value) and n_games[i] is the number
+        of games of player i. Taken from the running stats, so it does not read the table.
+        """
+        toon_race_ids = list(self.rows_by_toon_race)
+        counts = self._counts.array[toon_race_ids]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variances = np.where(counts > 1, np.maximum(self._m2s.array[toon_race_ids], 0) / (counts - 1), np.nan)
+        n_games = np.array([len(rows) for rows in self.rows_by_toon_race.values()], dtype=np.int64)
+        return variances, n_games
+
+    def sample_player_games(self, max_games, rng, min_games=1):
+        """
+        @param max_games: the most games to take from each player.
+        @param rng: np.random.Generator that picks the games, seed it to get the same sample every time.
+        @param min_games: players with fewer games are left out.
+        @return: np.ndarray with the feature values of up to max_games random games of each player.
+        """
+        player_rows = [rows for rows in self.rows_by_toon_race.values() if len(rows) >= min_games]
+        if len(player_rows) == 0:
+            return np.empty((0, len(self.columns)), dtype=np.float32)
+        n_games = np.array([len(rows) for rows in player_rows])
+        rows = np.concatenate(player_rows)
+        players = np.repeat(np.arange(len(player_rows)), n_games)
+        # Shuffles the games within each player, the players stay in order so each one starts where it did.
+        order = np.lexsort((rng.random(len(rows)), players))
+        rank_in_player = np.arange(len(rows)) - np.repeat(np.cumsum(n_games) - n_games, n_games)
+        return self.values.array[np.sort(rows[order][rank_in_player < max_games])]
+
+    def get_replay_ids(self):
+        """@return: set of the replay hashes of all games in the table."""
+        return {self.replay_ids[replay_id] for _, replay_id in self.rows}
 
     def get_stats(self):
-        if len(self.stats_not_up_to_date_toon_races) == 0:
-            return self._stats
-        else:
-            self.update_stats()
-            return self._stats
+        self.update_stats()
+        return self._stats
 
     def get_overall_stats(self):
-        if len(self.stats_not_up_to_date_toon_races) == 0:
-            return self._overall_stats
-        else:
-            self.update_stats()
-            return self._overall_stats
+        self.update_stats()
+        return self._overall_stats
 
     def drop_columns(self, columns_to_drop):
-        for stat in ["mean", "std"]:
-            self._stats[stat] = self._stats[stat].drop(columns_to_drop, axis=1)
-        for toon_race in self.features:
-            self.features[toon_race] = self.features[toon_race].drop(columns_to_drop, axis=1)
-        for d in self._overall_stats.values():
-            for col in columns_to_drop:
-                d.pop(col)
+        columns_to_keep = np.array([column not in columns_to_drop for column in self.columns], dtype=bool)
+        for matrix in [self.values, self._counts, self._means, self._m2s]:
+            matrix.keep(cols=columns_to_keep)
+        self._mean_sums = self._mean_sums[columns_to_keep]
+        self._mean_counts = self._mean_counts[columns_to_keep]
+        self._std_sums = self._std_sums[columns_to_keep]
+        self.columns = [column for column in self.columns if column not in columns_to_drop]
+        self._column_ids = {column: i for i, column in enumerate(self.columns)}
+        # The segments still have the dropped columns, so the whole table is written again at the next save.
+        if self._compaction is not None:
+            self._compaction["thread"].join()
+            self._compaction = None
+        self.segment_names = []
+        self.n_saved_rows = 0
+        self.partitions.mark_all_changed()
+        self._stats_up_to_date = False
+        self.n_changes += 1
 
     def race_filter_stats(self, filter_race):
-        self.update_stats()
-        filtered = dict()
-        for stat in self._stats:
-            filtered[stat] = self._stats[stat][
-                [toon_race_to_race(toon_race) == filter_race for toon_race in self._stats[stat].index]]
-        return filtered
+        """
+        @return: {"mean": pd.DataFrame, "std": pd.DataFrame, "general": pd.DataFrame} like get_stats() but with only the
+        players of filter_race. Built from the running stats of those players only and kept until one of them changes,
+        so it should not be changed.
+        """
+        n_changes = self.partitions.n_changes.get(filter_race, 0)
+        cached = self._race_stats.get(filter_race)
+        if cached is None or cached[0] != n_changes:
+            toon_race_ids = self.partitions.get_players(filter_race)
+            mean, std = self._player_stats(toon_race_ids)
+            stats = {
+                "mean": pd.DataFrame(mean, index=toon_race_ids, columns=self.columns),
+                "std": pd.DataFrame(std, index=toon_race_ids, columns=self.columns),
+                "general": self._general_stats(toon_race_ids),
+            }
+            self._race_stats[filter_race] = (n_changes, stats)
+        return self._race_stats[filter_race][1]
+
+    def race_game_features(self, filter_race, columns):
+        """
+        The games of all players of a race stacked as the rows of one matrix, for comparing a barcode to every game
+        instead of to the means of the players.
+        @param columns: [feature, ...] the columns to take, in this order.
+        @return: (toon_race_ids, game_players, values) where the players are in the same order as race_filter_stats(),
+        values is a float32 np.ndarray with a row per game and game_players[row] is the index into toon_race_ids of the
+        player of the game.
+        """
+        toon_race_ids = self.partitions.get_players(filter_race)
+        player_rows = [self.rows_by_toon_race[toon_race_id] for toon_race_id in toon_race_ids]
+        n_games = np.array([len(rows) for rows in player_rows], dtype=np.int64)
+        rows = np.concatenate(player_rows) if len(player_rows) > 0 else np.zeros(0, dtype=np.int64)
+        column_ids = [self._column_ids[column] for column in columns]
+        values = self.values.array[np.ix_(rows, column_ids)]
+        return toon_race_ids, np.repeat(np.arange(len(toon_race_ids)), n_games), values
+
+
+def _build_compacted_segment(compaction):
+    """Writes the segment of a compaction, runs in the background, see ReplayFeatures._start_compaction()."""
+    save_array(compaction["segment_path"], "rows.npy", compaction["row_arrays"])
+    save_array(compaction["segment_path"], "values.npy", compaction["values"])
@@ -1,6 +1,15 @@
 import ast
 import hashlib
+import json
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import mpyq
+
+from utils.utils import open_atomic
+
+DIGEST_SIZE = 16  # Bytes in an md5 digest.
 
 
 class ReplayHash:
@@ -11,42 +20,225 @@ class ReplayHash:
     Note that replays that are considered irrelevant (eg too short or AI players) will be in the replay_hahes list
     to prevent repeated parsing; in other words not all replays in the replay hashes list have data in the database.
 
-    Could probably be made faster by only hashing part(s) of the replay file,
-    although currently it only takes a few seconds for a thousand replays.
-    self.hashes is a set with the replay hashes (strings)
+    The hashes are used as hex strings everywhere else in the program, but stored as raw 16 byte md5 digests, both in
+    memory and in replay_hashes.bin which is simply all digests one after the other. New hashes are appended to the end
+    of the file, so saving only writes the hashes added since the last save, and loading is a single read.
+    If the program dies in the middle of an append, the incomplete digest at the end is cut off when loading.
+
+    self.hashes: set of the replay hashes as 16 byte digests.
+
+    self.unsaved_digests: digests added since the last save, in the order they were added.
+
+    self.needs_rewrite: True if a hash has been removed, since then the whole file has to be rewritten on save.
 
-    self.hashes: set of the replay hashes.
+    self.fingerprints: {replay_path: [size, mtime_ns, inode, replay_hash], ...}. A replay file whose size, modification
+    time and inode are unchanged since it was last hashed gets its hash from here instead of being read again, which
+    makes checking thousands of already loaded replays almost free. The file also states which of hash_replay() and
+    fast_fingerprint() made the hashes, the cache is dropped when loading with the other one. The file is only written
+    when the fingerprints changed, and the replays that were not found by the last scan of the replay folders are
+    dropped from it, see prune_fingerprints().
+
+    self.fingerprints_changed: whether self.fingerprints changed since it was last saved.
+
+    self.lock: the replays are hashed from several threads (loading, classifying and the ReplayWatcher) while a
+    checkpoint may be saving, so self.fingerprints is only used while holding this lock.
+
+    self.fast_fingerprint: If True, replays are hashed with fast_fingerprint() instead of hash_replay(). This only
+    reads a small part of each replay, which helps for very large replay packs. The two give different hashes for the
+    same replay, so changing this setting means that all replays will be loaded again unless the database is reset.
     """
 
-    def __init__(self, data_path):
+    def __init__(self, data_path, fast_fingerprint=False):
         self.data_path = data_path
-        self.file_path = os.path.join(data_path, "replay_hashes.txt")
+        self.file_path = os.path.join(data_path, "replay_hashes.bin")
+        self.legacy_file_path = os.path.join(data_path, "replay_hashes.txt")
+        self.fingerprints_file_path = os.path.join(data_path, "replay_fingerprints.json")
         self.hashes = set()
+        self.unsaved_digests = []
+        self.needs_rewrite = False
+        self.fingerprints = {}
+        self.fingerprints_changed = False
+        self.fast_fingerprint = fast_fingerprint
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        """Used by copy.deepcopy, a lock can not be copied so the copy gets a new one."""
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
 
     def save_to_file(self):
-        with open(self.file_path, "w") as outfile:
-            outfile.write(str(self.hashes))
+        if self.needs_rewrite:
+            self._rewrite_file()
+        elif len(self.unsaved_digests) > 0:
+            with open(self.file_path, "ab") as outfile:
+                outfile.write(b"".join(self.unsaved_digests))
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        self.unsaved_digests = []
+        # A snapshot is written, so that replays can be hashed in the meantime.
+        with self.lock:
+            if not self.fingerprints_changed:
+                return
+            fingerprints = dict(self.fingerprints)
+            self.fingerprints_changed = False
+        try:
+            with open_atomic(self.fingerprints_file_path, "w") as outfile:
+                json.dump({"fast_fingerprint": self.fast_fingerprint, "fingerprints": fingerprints}, outfile)
+        except BaseException:
+            with self.lock:
+                self.fingerprints_changed = True
+            raise
 
     def load_from_file(self):
-        with open(self.file_path, "r") as infile:
-            self.hashes = ast.literal_eval(infile.read())
+        if not os.path.exists(self.file_path) and os.path.exists(self.legacy_file_path):
+            self._convert_legacy_file()
+        with open(self.file_path, "rb") as infile:
+            data = infile.read()
+        n_complete_bytes = len(data) - len(data) % DIGEST_SIZE
+        self.hashes = {data[i : i + DIGEST_SIZE] for i in range(0, n_complete_bytes, DIGEST_SIZE)}
+        if n_complete_bytes != len(data):
+            print(f"Removing an incomplete replay hash from the end of {self.file_path}.")
+            os.truncate(self.file_path, n_complete_bytes)
+        self.unsaved_digests = []
+        self.needs_rewrite = False
+        # The fingerprints are only a cache, so a missing file simply means that everything gets hashed again.
+        fingerprints = {}
+        if os.path.exists(self.fingerprints_file_path):
+            with open(self.fingerprints_file_path, "r") as infile:
+                cache = json.load(infile)
+            # Older versions saved only the fingerprints, without stating how they were hashed.
+            if cache.get("fast_fingerprint") == self.fast_fingerprint and "fingerprints" in cache:
+                fingerprints = cache["fingerprints"]
+        with self.lock:
+            self.fingerprints = fingerprints
+            self.fingerprints_changed = False
+
+    def prune_fingerprints(self, replay_paths):
+        """
+        Drops the fingerprints of the replays that are not in replay_paths, e.g. deleted or moved replays.
+        @param replay_paths: all replays found by a scan of the replay folders.
+        """
+        keys = {str(replay_path) for replay_path in replay_paths}
+        with self.lock:
+            to_drop = [key for key in self.fingerprints if key not in keys]
+            for key in to_drop:
+                del self.fingerprints[key]
+            if len(to_drop) > 0:
+                self.fingerprints_changed = True
 
     def reset_file(self):
-        with open(self.file_path, "w") as outfile:
-            outfile.write(str(set()))
+        with open_atomic(self.file_path, "wb"):
+            pass
+
+    def _rewrite_file(self):
+        with open_atomic(self.file_path, "wb") as outfile:
+            outfile.write(b"".join(self.hashes))
+        self.needs_rewrite = False
+
+    def _convert_legacy_file(self):
+        """Older versions saved the hashes as str(set of hex strings) in replay_hashes.txt."""
+        with open(self.legacy_file_path, "r") as infile:
+            self.hashes = {bytes.fromhex(replay_hash) for replay_hash in ast.literal_eval(infile.read())}
+        self._rewrite_file()
+        os.remove(self.legacy_file_path)
 
     def in_db(self, replay_hash):
-        return replay_hash in self.hashes
+        return bytes.fromhex(replay_hash) in self.hashes
 
     def add_hash(self, replay_hash):
-        self.hashes.add(replay_hash)
+        digest = bytes.fromhex(replay_hash)
+        if digest not in self.hashes:
+            self.hashes.add(digest)
+            self.unsaved_digests.append(digest)
 
     def remove_replay(self, replay_hash):
-        assert replay_hash in self.hashes
-        self.hashes.remove(replay_hash)
+        digest = bytes.fromhex(replay_hash)
+        assert digest in self.hashes
+        self.hashes.remove(digest)
+        self.needs_rewrite = True
+
+    def get_hash(self, replay_path):
+        """Hash of a single replay, using the cached fingerprint if the file has not changed, see get_hashes()."""
+        return self.get_hashes([replay_path])[0]
+
+    def get_hashes(self, replay_paths):
+        """
+        Hashes of the given replays in the same order. Replays that are unchanged since they were last hashed are
+        looked up in self.fingerprints, the rest are hashed in a thread pool since reading the files is most of the work.
+        The hash of a replay that can not be read (e.g. it was deleted in the meantime) is None, see _hash_file().
+        """
+        replay_hashes = [None] * len(replay_paths)
+        to_hash = []  # [(index in replay_paths, path key, file stats), ...]
+        for i, replay_path in enumerate(replay_paths):
+            key = str(replay_path)
+            try:
+                stat = os.stat(replay_path)
+            except OSError as e:
+                print(f"Skipping replay {replay_path} since it can not be read: {e}")
+                continue
+            file_stats = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+            with self.lock:
+                cached = self.fingerprints.get(key)
+            if cached is not None and cached[:3] == file_stats:
+                replay_hashes[i] = cached[3]
+            else:
+                to_hash.append((i, key, file_stats))
+        if len(to_hash) == 0:
+            return replay_hashes
+
+        if len(to_hash) == 1:
+            new_hashes = [self._hash_file(replay_paths[to_hash[0][0]])]
+        else:
+            with ThreadPoolExecutor() as executor:
+                new_hashes = list(executor.map(self._hash_file, [replay_paths[i] for i, _, _ in to_hash]))
+        with self.lock:
+            for (i, key, file_stats), replay_hash in zip(to_hash, new_hashes):
+                replay_hashes[i] = replay_hash
+                if replay_hash is not None:
+                    self.fingerprints[key] = file_stats + [replay_hash]
+                    self.fingerprints_changed = True
+        return replay_hashes
+
+    def _hash_file(self, replay_path):
+        """
+        Hashes a replay with fast_fingerprint() or hash_replay(), see self.fast_fingerprint. A replay that is not a
+        valid MPQ archive (e.g. it is still being written) can not be fingerprinted, so it is hashed as a whole instead.
+        @return: the hash, None with a warning if the file can not be read.
+        """
+        try:
+            if self.fast_fingerprint:
+                try:
+                    return ReplayHash.fast_fingerprint(replay_path)
+                except OSError:
+                    raise
+                except Exception:
+                    pass
+            return ReplayHash.hash_replay(replay_path)
+        except OSError as e:
+            print(f"Skipping replay {replay_path} since it can not be read: {e}")
+            return None
 
     @staticmethod
     def hash_replay(replay_path):
         with open(replay_path, "rb") as infile:
             data = infile.read()
         return hashlib.md5(data).hexdigest()
+
+    @staticmethod
+    def fast_fingerprint(replay_path):
+        """
+        md5 of the replay header (game version + game length) and the replay.details file inside the replay (players,
+        map and the time the game was played), without reading the rest of the replay.
+        """
+        archive = mpyq.MPQArchive(replay_path, listfile=False)
+        try:
+            md5 = hashlib.md5(archive.header["user_data_header"]["content"])
+            md5.update(archive.read_file("replay.details"))
+        finally:
+            archive.file.close()
+        return md5.hexdigest()
@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+import time
+
+from utils.utils import open_atomic
+
+
+class ReplayScanner:
+    """
+    Finds the .SC2Replay files under one or more replay folders (including sub-folders) without listing every folder
+    on every call.
+
+    A folder's modification time changes when a file or sub-folder is added, removed or renamed directly in it, so a
+    folder whose modification time is the same as in the manifest is not listed again; its replays and sub-folders are
+    taken from the manifest, and only its sub-folders are checked. Scanning a large, unchanged replay folder is then one
+    os.stat per folder instead of one per replay.
+
+    self.manifest: {folder_path: {"mtime_ns": int, "scanned_at": float, "subdirs": [name, ...],
+    "replays": {replay_name: mtime, ...}, "newest": [replay_name, mtime] or None}, ...}
+    where the replay mtimes are in seconds like os.path.getmtime.
+
+    self.manifest_path: where the manifest is saved after every scan that changed it, None to only keep it in memory.
+
+    self.lock: scans can come from several threads (loading, classifying and the ReplayWatcher), one at a time.
+    """
+
+    # A folder modified this close to the time it was listed might have changed again within the same timestamp tick,
+    # or hold a replay that was still being written, so it is listed again next time.
+    RECENT_CHANGE_SECONDS = 60
+
+    def __init__(self, manifest_path=None):
+        self.manifest_path = manifest_path
+        self.manifest = {}
+        self.lock = threading.Lock()
+        if manifest_path is not None and os.path.exists(manifest_path):
+            with open(manifest_path, "r") as infile:
+                self.manifest = json.load(infile)
+
+    def __getstate__(self):
+        """Used by copy.deepcopy, a lock can not be copied so the copy gets a new one."""
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def save_to_file(self):
+        if self.manifest_path is None:
+            return
+        with open_atomic(self.manifest_path, "w") as outfile:
+            json.dump(self.manifest, outfile)
+
+    def scan(self, folder_paths):
+        """
+        @param folder_paths: list of replay folders.
+        @return: list of (replay_path, mtime) for all replays in these folders and their sub-folders, in no particular
+        order.
+        """
+        replays = []
+        for folder_path, entry in self._scan_folders(folder_paths):
+            for name, mtime in entry["replays"].items():
+                replays.append((os.path.join(folder_path, name), mtime))
+        return replays
+
+    def get_most_recent_replay(self, folder_paths):
+        """@return: (replay_path, mtime) of the most recently modified replay, or (None, None) if there are none."""
+        most_recent = (None, None)
+        for folder_path, entry in self._scan_folders(folder_paths):
+            if entry["newest"] is None:
+                continue
+            name, mtime = entry["newest"]
+            if most_recent[1] is None or mtime > most_recent[1]:
+                most_recent = (os.path.join(folder_path, name), mtime)
+        return most_recent
+
+    def _scan_folders(self, folder_paths):
+        """Returns [(folder_path, manifest entry), ...] for every folder under folder_paths, updating the manifest."""
+        with self.lock:
+            return self._scan_folders_locked(folder_paths)
+
+    def _scan_folders_locked(self, folder_paths):
+        visited = []
+        new_manifest = {}
+        changed = False
+        stack = list(reversed(folder_paths))
+        while len(stack) > 0:
+            folder_path = stack.pop()
+            if folder_path in new_manifest:  # The same folder given twice, or one root inside another.
+                continue
+            try:
+                mtime_ns = os.stat(folder_path).st_mtime_ns
+            except OSError:
+                continue  # Removed since the parent was listed, or a root that does not exist.
+            entry = self.manifest.get(folder_path)
+            if entry is None or entry["mtime_ns"] != mtime_ns or self._changed_recently(entry):
+                entry = self._list_folder(folder_path, mtime_ns)
+                changed = True
+            new_manifest[folder_path] = entry
+            visited.append((folder_path, entry))
+            for subdir in reversed(entry["subdirs"]):
+                stack.append(os.path.join(folder_path, subdir))
+        if changed or len(new_manifest) != len(self.manifest):
+            self.manifest = new_manifest
+            self.save_to_file()
+        return visited
+
+    def _changed_recently(self, entry):
+        return entry["mtime_ns"] / 1e9 > entry["scanned_at"] - self.RECENT_CHANGE_SECONDS
+
+    @staticmethod
+    def _list_folder(folder_path, mtime_ns):
+        subdirs = []
+        replays = {}
+        newest = None
+        with os.scandir(folder_path) as it:
+            for dir_entry in it:
+                if dir_entry.is_dir():
+                    subdirs.append(dir_entry.name)
+                elif dir_entry.name.endswith(".SC2Replay"):
+                    mtime = dir_entry.stat().st_mtime
+                    replays[dir_entry.name] = mtime
+                    if newest is None or mtime > newest[1]:
+                        newest = [dir_entry.name, mtime]
+        subdirs.sort()
+        return {"mtime_ns": mtime_ns, "scanned_at": time.time(), "subdirs": subdirs, "replays": replays,
+                "newest": newest}
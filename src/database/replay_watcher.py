@@ -0,0 +1,102 @@
+import os
+import threading
+import time
+import traceback
+
+from utils.utils import get_replay_folder_paths, long_path_safe
+
+
+class ReplayWatcher:
+    """
+    Loads new replays into the database in the background, shortly after StarCraft has written them, so that the
+    database is already up to date when a game is classified.
+
+    The replay folders are polled with the DBMS's ReplayScanner every poll_seconds instead of relying on file system
+    notifications, which works the same on every OS and on network drives. A new replay is loaded once its size and
+    modification time have stayed the same for debounce_seconds, so files that are still being written are left alone.
+    Replays that already existed when the watcher started are not loaded by it, that is what the
+    "Load all unloaded replays" button is for.
+
+    self.known_paths: replays that existed at the start or have already been passed on to the database.
+
+    self.pending: {replay_path: ((size, mtime_ns), time this size and mtime was first seen), ...} for new replays that
+    are waiting for the debounce time.
+    """
+
+    def __init__(self, dbms, poll_seconds, debounce_seconds):
+        self.dbms = dbms
+        self.poll_seconds = poll_seconds
+        self.debounce_seconds = debounce_seconds
+        self.stop_event = threading.Event()
+        self.known_paths = set()
+        self.pending = {}
+        self.thread = None
+
+    def start(self):
+        self.stop_event.clear()
+        self.known_paths = set()
+        self.pending = {}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        print(f"Watching for new replays in {', '.join(get_replay_folder_paths(self.dbms.config))}")
+
+    def stop(self):
+        self.stop_event.set()
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive() and not self.stop_event.is_set()
+
+    def _run(self):
+        # Listing the replays that already exist takes a while for large replay folders, so it is done here instead of
+        # in start(), which is called from the GUI.
+        while not self._call_safely(self._list_known_replays):
+            if self.stop_event.wait(self.poll_seconds):
+                return
+        while not self.stop_event.wait(self.poll_seconds):
+            self._call_safely(self.poll)
+
+    def _call_safely(self, function):
+        """
+        An error (e.g. a replay folder on a drive that was disconnected) should not stop the watching for good.
+        @return: whether function() ran without an error.
+        """
+        try:
+            function()
+            return True
+        except Exception:
+            print("The replay watcher failed to check for new replays, it will try again:")
+            traceback.print_exc()
+            return False
+
+    def _list_known_replays(self):
+        self.known_paths = self._list_replays()
+
+    def _list_replays(self):
+        return {replay_path for replay_path, _ in self.dbms.scanner.scan(get_replay_folder_paths(self.dbms.config))}
+
+    def poll(self):
+        """Checks for new replays once and loads the ones that have finished being written."""
+        now = time.time()
+        new_paths = self._list_replays() - self.known_paths
+        ready = []
+        for replay_path in new_paths:
+            try:
+                stat = os.stat(replay_path)
+            except OSError:
+                continue  # Removed again.
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if replay_path not in self.pending or self.pending[replay_path][0] != signature:
+                self.pending[replay_path] = (signature, now)
+            elif now - self.pending[replay_path][1] >= self.debounce_seconds:
+                ready.append((stat.st_mtime, replay_path))
+        # Forget pending replays that disappeared before they were loaded.
+        self.pending = {p: v for p, v in self.pending.items() if p in new_paths}
+        if len(ready) == 0:
+            return
+
+        ready_paths = [replay_path for _, replay_path in sorted(ready)]
+        for replay_path in ready_paths:
+            self.known_paths.add(replay_path)
+            self.pending.pop(replay_path)
+        print(f"Loading {len(ready_paths)} new replay(s) into the database.")
+        self.dbms.enter_replays_into_db([long_path_safe(p) for p in ready_paths], self.stop_event)
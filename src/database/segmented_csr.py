@@ -0,0 +1,141 @@
+import os
+
+import numpy as np
+from scipy import sparse
+
+from utils.utils import open_atomic
+from database.growable_arrays import GrowableCSR
+
+
+class SegmentedCSR:
+    """
+    A sparse matrix in CSR format made of read-only parts followed by rows that can still be appended to. The parts are
+    the segments saved on disk, opened with np.memmap (see load_part), so loading does not read the matrix and several
+    processes share the same pages. Appended rows are kept in memory until they are saved as a new part.
+
+    The number of columns can grow, older parts then just have zeros in the new columns.
+
+    self.parts: [csr_array, ...] the saved rows, in order.
+    self.tail: GrowableCSR with the rows after the parts, which have not been saved.
+    """
+
+    def __init__(self, n_cols=0, dtype=np.float32):
+        self.parts = []
+        self._part_starts = [0]
+        self.tail = GrowableCSR(n_cols, dtype=dtype)
+
+    @property
+    def n_cols(self):
+        return max([self.tail.n_cols] + [part.shape[1] for part in self.parts])
+
+    @property
+    def n_saved_rows(self):
+        return self._part_starts[-1]
+
+    @property
+    def n_rows(self):
+        return self.n_saved_rows + self.tail.n_rows
+
+    def add_part(self, csr):
+        """Adds a read-only part after the other parts, only allowed while there are no unsaved rows."""
+        assert self.tail.n_rows == 0
+        self.parts.append(csr)
+        self._part_starts.append(self._part_starts[-1] + csr.shape[0])
+
+    def replace_rows(self, n_rows, part):
+        """
+        Replaces the first n_rows rows, which have to be saved, with the rows of a read-only part, e.g. the same rows
+        without the removed ones. The rows after them are moved to follow the part.
+        """
+        parts = [part]
+        for start, old_part in zip(self._part_starts[:-1], self.parts):
+            if start >= n_rows:
+                parts.append(old_part)
+            elif start + old_part.shape[0] > n_rows:
+                parts.append(sparse.csr_array(old_part[n_rows - start :]))
+        self.parts = parts
+        self._part_starts = [0]
+        for new_part in parts:
+            self._part_starts.append(self._part_starts[-1] + new_part.shape[0])
+
+    def append_rows(self, csr):
+        """@param csr: scipy sparse matrix, its rows are added at the end."""
+        if csr.shape[1] < self.n_cols:
+            csr = sparse.csr_array(csr)
+            csr.resize((csr.shape[0], self.n_cols))
+        self.tail.append_rows(csr)
+
+    def _get_parts(self):
+        """@return: [csr_array, ...] all parts and the unsaved rows, with n_cols columns each, without copying."""
+        n_cols = self.n_cols
+        parts = self.parts + ([self.tail.to_csr()] if self.tail.n_rows > 0 else [])
+        return [
+            part if part.shape[1] == n_cols else
+            sparse.csr_array((part.data, part.indices, part.indptr), shape=(part.shape[0], n_cols), copy=False)
+            for part in parts
+        ]
+
+    def to_csr(self):
+        """@return: csr_array of all rows, it shares memory with this object unless there are several parts."""
+        parts = self._get_parts()
+        if len(parts) == 1:
+            return parts[0]
+        if len(parts) == 0:
+            return sparse.csr_array((0, self.n_cols), dtype=self.tail.data.array.dtype)
+        return sparse.csr_array(sparse.vstack(parts, format="csr"))
+
+    def get_rows(self, rows):
+        """@return: csr_array of the given rows, in the given order."""
+        rows = np.asarray(rows, dtype=np.int64)
+        part_starts = np.array(self._part_starts + [self.n_rows], dtype=np.int64)
+        part_of_row = np.searchsorted(part_starts, rows, side="right") - 1
+        parts = self._get_parts()
+        if len(rows) == 1:
+            return parts[part_of_row[0]][rows - part_starts[part_of_row[0]]]
+        order = np.argsort(part_of_row, kind="stable")
+        blocks = [
+            parts[k][rows[order][part_of_row[order] == k] - part_starts[k]] for k in np.unique(part_of_row)
+        ]
+        if len(blocks) == 0:
+            return sparse.csr_array((0, self.n_cols), dtype=self.tail.data.array.dtype)
+        selected = sparse.csr_array(sparse.vstack(blocks, format="csr"))
+        return selected[np.argsort(order, kind="stable")]
+
+    def left_multiply(self, matrix):
+        """@return: matrix @ self, as the sum over the parts so that they are not copied into one matrix."""
+        result = None
+        for start, part in zip(self._part_starts[:-1] + [self.n_saved_rows], self._get_parts()):
+            product = matrix[:, start : start + part.shape[0]] @ part
+            result = product if result is None else result + product
+        if result is None:
+            return sparse.csr_array((matrix.shape[0], self.n_cols))
+        return sparse.csr_array(result)
+
+    def save_tail(self, folder_path, prefix):
+        """
+        Writes the unsaved rows as a part to folder_path, which then replaces them.
+        @param prefix: the start of the file names, e.g. "3_gram".
+        """
+        tail = self.tail.to_csr()
+        self.save_part(folder_path, prefix, tail)
+        n_cols = self.n_cols
+        self.tail = GrowableCSR(n_cols, dtype=tail.dtype)
+        self.add_part(self.load_part(folder_path, prefix, n_cols))
+
+    @staticmethod
+    def save_part(folder_path, prefix, csr):
+        """Writes csr (a csr_array) to folder_path in the format of load_part."""
+        for name in ("data", "indices", "indptr"):
+            with open_atomic(os.path.join(folder_path, f"{prefix}_{name}.npy"), "wb") as outfile:
+                np.save(outfile, getattr(csr, name))
+
+    @staticmethod
+    def load_part(folder_path, prefix, n_cols):
+        """@return: csr_array of a part written by save_part, memory mapped read-only."""
+        arrays = [np.load(os.path.join(folder_path, f"{prefix}_{name}.npy"), mmap_mode="r") for name in
+                  ("data", "indices", "indptr")]
+        return sparse.csr_array(tuple(arrays), shape=(len(arrays[2]) - 1, n_cols), copy=False)
+
+    @staticmethod
+    def part_exists(folder_path, prefix):
+        return os.path.exists(os.path.join(folder_path, f"{prefix}_indptr.npy"))
@@ -0,0 +1,48 @@
+import os
+import shutil
+
+import numpy as np
+
+from utils.utils import open_atomic
+
+
+# Helpers for the parts of the database that are saved as segments: folders that each hold the rows that were added
+# between two saves, listed in order by a manifest, see NGrams and ReplayFeatures.
+
+
+def save_array(folder_path, filename, array):
+    with open_atomic(os.path.join(folder_path, filename), "wb") as outfile:
+        np.save(outfile, array)
+
+
+def new_segment(segments_path):
+    """@return: (name, path) of a new, empty segment folder in segments_path."""
+    existing = os.listdir(segments_path) if os.path.isdir(segments_path) else []
+    name = f"{max([int(name) for name in existing if name.isdigit()], default=0) + 1:06d}"
+    segment_path = os.path.join(segments_path, name)
+    os.makedirs(segment_path)
+    return name, segment_path
+
+
+def remove_unused_segments(segments_path, segment_names):
+    """
+    Removes the segments that are not in segment_names, e.g. after compacting. On Windows, a segment that is still
+    memory mapped (e.g. by another process) can not be removed, it is then tried again the next time.
+    """
+    if not os.path.isdir(segments_path):
+        return
+    for name in os.listdir(segments_path):
+        if name not in segment_names:
+            shutil.rmtree(os.path.join(segments_path, name), ignore_errors=True)
+
+
+def run_compaction(build_compacted_segment, compaction):
+    """
+    Runs build_compacted_segment(compaction) in the background thread of a compaction, if it fails the segments just
+    stay as they are.
+    """
+    try:
+        build_compacted_segment(compaction)
+    except Exception as e:
+        print(f"Compacting the {compaction['store']} failed, it is tried again when the database is saved next: {e}")
+        compaction["failed"] = True
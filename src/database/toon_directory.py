@@ -0,0 +1,80 @@
+import json
+import os
+
+from utils.utils import is_barcode, open_atomic
+
+
+class ToonDirectory:
+    """
+    Holds the name history of every toon (account) that has been seen in a loaded replay. It is loaded from
+    toon_handle_to_names.txt once, updated in memory while loading replays and written back to file together with the
+    rest of the database, see DBMS.save_to_file().
+
+    self.toon_to_names: {toon: [name1, name2, ...], ...} in the order the names were first seen.
+
+    self.toon_is_barcode: {toon: bool, ...}, True if all names of the toon are barcodes. Kept up to date when names are
+    added so that the classifiers only have to look it up.
+
+    self.name_to_toons: {name: {toon1, toon2, ...}, ...} the reverse of toon_to_names.
+
+    self.unsaved_changes: True if names have been added since the last save.
+    """
+
+    def __init__(self, data_path):
+        self.file_path = os.path.join(data_path, "toon_handle_to_names.txt")
+        self.toon_to_names = {}
+        self.toon_is_barcode = {}
+        self.name_to_toons = {}
+        self.unsaved_changes = False
+
+    def load_from_file(self):
+        with open(self.file_path, "r") as infile:
+            toon_to_names = json.load(infile)
+        self.toon_to_names = {}
+        self.toon_is_barcode = {}
+        self.name_to_toons = {}
+        for toon, names in toon_to_names.items():
+            self.toon_to_names[toon] = []
+            self.toon_is_barcode[toon] = True
+            for name in names:
+                self.add_name(toon, name)
+        self.unsaved_changes = False
+
+    def save_to_file(self):
+        if not self.unsaved_changes:
+            return
+        with open_atomic(self.file_path, "w") as outfile:
+            json.dump(self.toon_to_names, outfile)
+        self.unsaved_changes = False
+
+    def add_name(self, toon, name):
+        names = self.toon_to_names.setdefault(toon, [])
+        if name in names:
+            return
+        names.append(name)
+        self.toon_is_barcode[toon] = self.toon_is_barcode.get(toon, True) and is_barcode(name)
+        self.name_to_toons.setdefault(name, set()).add(toon)
+        self.unsaved_changes = True
+
+    def add_names(self, player_names):
+        """@param player_names: [(toon, name), ...]"""
+        for toon, name in player_names:
+            self.add_name(toon, name)
+
+    def get_names(self, toon):
+        """The name history of the toon, empty if the toon is unknown."""
+        return self.toon_to_names.get(toon, [])
+
+    def is_barcode(self, toon):
+        """True if every known name of this toon is a barcode."""
+        return self.toon_is_barcode[toon]
+
+    def get_toons(self, name):
+        """All toons that have used this name."""
+        return self.name_to_toons.get(name, set())
+
+    def __getitem__(self, toon):
+        return self.toon_to_names[toon]
+
+    def __contains__(self, toon):
+        return toon in self.toon_to_names
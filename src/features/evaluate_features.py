@@ -2,40 +2,29 @@ import pandas as pd
 import numpy as np
 
 
-def get_feature_relevances(replay_features):
+def get_feature_relevances(rep_feats, seed=0):
     """
     Takes mean variance of each feature within each player divided by the overall variance for all players. Could be more
     statistically advanced, but I just want a rough estimate of the spread within a player divided by spread overall.
-    - extract the variance and add it to the within_player_variances N-1 times, but max 4 times to avoid
-        over-representation of common players like myself.
+    - weight the variance of each player with N-1, but max 4 to avoid over-representation of common players like
+        myself.
         This scaling of 1-4 is motivated by the fact that a variance taken from a big sample set more accurately
         represents an average variance, it would require assumptions of the distributions priors to do anything
         more advanced.
     - To avoid the overall variance to be heavily impacted by players with a large number of replays each player only
-    sends features from 4 random games for the calculation of the total variance.
+    sends features from 4 random games for the calculation of the total variance. The games are picked with a seeded
+    random generator so that the result is the same every time for the same data.
+    Players with a single game are left out of both.
     Will return NaN value if total variance is 0, shows that the feature always has the same value (or at least with the randomized 4 games of each person).
-    @param replay_features: dict with keys being (toon, race) and values being a pandas DataFrame with the features
-    from each of their games.
-    @return: {feature: within_player_variances.mean() / total_variance}.
+    @param rep_feats: ReplayFeatures, the variances within the players are taken from its running stats.
+    @param seed: seed of the random generator that picks the 4 games.
+    @return: pd.Series {feature: within_player_variances.mean() / total_variance}.
     """
-    within_player_variances = pd.DataFrame()
-    max_four_of_each_df = pd.DataFrame()
-    for toon_race in replay_features:
-        # first find variance for this player
-        df_player = replay_features[toon_race]
-        n_replays = len(df_player.index)
-        if n_replays == 1:
-            continue
-        df_player = df_player.select_dtypes(include=np.number)
-        within_player_var = df_player.var()
-        for i in range(min(n_replays - 1, 4)):
-            within_player_variances = pd.concat(
-                [within_player_variances, within_player_var.to_frame().T], ignore_index=True
-            )
-
-        # add first 4 games to df that will later calculate total_variance.
-        df_player = df_player.sample(frac=1).reset_index(drop=True)  # shuffle
-        df_player = df_player.iloc[:4]
-        max_four_of_each_df = pd.concat([max_four_of_each_df, df_player], ignore_index=True)
-    total_variance = max_four_of_each_df.var()
-    return within_player_variances.mean() / total_variance
+    variances, n_games = rep_feats.get_player_variances()
+    weights = np.where(np.isnan(variances), 0, np.minimum(n_games - 1, 4)[:, np.newaxis])
+    with np.errstate(invalid="ignore", divide="ignore"):
+        within_player_variance = (weights * np.nan_to_num(variances)).sum(axis=0) / weights.sum(axis=0)
+    sample = rep_feats.sample_player_games(4, np.random.default_rng(seed), min_games=2).astype(np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        total_variance = pd.DataFrame(sample).var().to_numpy()
+        return pd.Series(within_player_variance / total_variance, index=rep_feats.columns)
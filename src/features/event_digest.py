@@ -0,0 +1,156 @@
+# Compact columnar summary of a player's events, everything the feature extractors need from the sc2reader replay.
+import numpy as np
+import sc2reader
+
+FRAMES_PER_SECOND = 22.4
+
+# Event kind codes, stored in EventDigest.kind.
+OTHER = 0
+STARTUP = 1  # Chat, progress and user options events, they are not actions by the player.
+SELECTION = 2
+COMMAND_MANAGER = 3  # CommandManagerStateEvent, a repeated command.
+COMMAND = 4
+RETURN_CARGO = 5  # A CommandEvent with the ReturnCargo ability.
+CONTROL_GROUP = 6
+CAMERA = 7
+KIND_CODES = (OTHER, STARTUP, SELECTION, COMMAND_MANAGER, COMMAND, RETURN_CARGO, CONTROL_GROUP, CAMERA)
+
+# Selection codes, stored in EventDigest.value for SELECTION events.
+SELECTION_BASE = 0  # A single building. Only a building with more than 200 minerals gets its location stored though.
+SELECTION_WORKER = 1
+SELECTION_WORKERS = 2  # Only workers, more than one (or nothing at all).
+SELECTION_OTHER = 3
+
+COLUMNS = {"frame": np.int32, "kind": np.int8, "value": np.int8, "x": np.float32, "y": np.float32}
+
+
+class EventDigest:
+    """
+    One row per event of a player, stored column by column as numpy arrays:
+    frame: the frame of the event.
+    kind: the event kind code (OTHER, SELECTION, CAMERA, ...).
+    value: the selection code for SELECTION events and the update_type for CONTROL_GROUP events, otherwise 0.
+    x, y: the camera location for CAMERA events and the base location for SELECTION events that select a base,
+    otherwise NaN.
+    As well as toon, race and apm of the player.
+
+    Replays are slow to parse, so the digests are stored (see database.event_digests) to allow re-extracting all
+    features without the replays, e.g. after changing the hyperparams.
+    """
+
+    def __init__(self, toon, race, apm, frame, kind, value, x, y):
+        self.toon = toon
+        self.race = race
+        self.apm = apm
+        self.frame = frame
+        self.kind = kind
+        self.value = value
+        self.x = x
+        self.y = y
+
+    def __len__(self):
+        return len(self.frame)
+
+    @classmethod
+    def from_player(cls, player):
+        """
+        @param player: the player object from the sc2reader replay object.
+        """
+        n = len(player.events)
+        frame = np.zeros(n, dtype=np.int32)
+        kind = np.zeros(n, dtype=np.int8)
+        value = np.zeros(n, dtype=np.int8)
+        x = np.full(n, np.nan, dtype=np.float32)
+        y = np.full(n, np.nan, dtype=np.float32)
+        for i, event in enumerate(player.events):
+            frame[i] = event.frame
+            kind[i] = event_kind = _get_kind(type(event))
+            if event_kind == SELECTION:
+                value[i], base_location = _summarize_selection(event.objects)
+                if base_location is not False:
+                    x[i], y[i] = base_location
+            elif event_kind == COMMAND:
+                if event.ability_name == "ReturnCargo":
+                    kind[i] = RETURN_CARGO
+            elif event_kind == CONTROL_GROUP:
+                value[i] = event.update_type
+            elif event_kind == CAMERA:
+                x[i], y[i] = event.x, event.y
+        return cls(player.toon_handle, player.play_race, player.avg_apm, frame, kind, value, x, y)
+
+    def cut(self, cutting_time):
+        """
+        Same as features.utils_features.get_cut_events with game_part="start": the events before the first event that
+        is at least cutting_time seconds into the game. The arrays of the returned digest are views into this one.
+        """
+        if cutting_time is None:
+            return self
+        late = np.flatnonzero(self.frame >= FRAMES_PER_SECOND * cutting_time)
+        end = late[0] if len(late) > 0 else len(self)
+        columns = {column: getattr(self, column)[:end] for column in COLUMNS}
+        return EventDigest(self.toon, self.race, self.apm, **columns)
+
+    def to_arrays(self, prefix=""):
+        """@return: {name: numpy array} for np.savez, the inverse of from_arrays."""
+        arrays = {prefix + column: getattr(self, column) for column in COLUMNS}
+        arrays[prefix + "toon"] = np.array(self.toon)
+        arrays[prefix + "race"] = np.array(self.race)
+        arrays[prefix + "apm"] = np.array(self.apm, dtype=np.float64)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix=""):
+        columns = {column: arrays[prefix + column].astype(dtype, copy=False) for column, dtype in COLUMNS.items()}
+        return cls(
+            str(arrays[prefix + "toon"]), str(arrays[prefix + "race"]), float(arrays[prefix + "apm"]), **columns
+        )
+
+
+def _summarize_selection(selection):
+    """
+    @param selection: the objects of a SelectionEvent.
+    @return: (selection code, base location) where the base location is False unless a base was selected.
+    """
+    if len(selection) == 1:
+        if selection[0].is_worker:
+            return SELECTION_WORKER, False
+        elif selection[0].is_building:
+            if selection[0].minerals > 200:
+                return SELECTION_BASE, selection[0].location
+            return SELECTION_BASE, False
+        return SELECTION_OTHER, False
+    for obj in selection:
+        if not obj.is_worker:
+            return SELECTION_OTHER, False
+    return SELECTION_WORKERS, False
+
+
+_STARTUP_EVENT_CLASSES = (
+    sc2reader.events.message.ChatEvent,
+    sc2reader.events.message.ProgressEvent,
+    sc2reader.events.game.UserOptionsEvent,
+)
+# {event class: kind code}, filled in by _get_kind the first time each event class is seen.
+_KIND_BY_EVENT_CLASS = dict()
+
+
+def _get_kind(event_class):
+    """The event kind code of the exact event class, looked up once per class with the isinstance chain."""
+    kind = _KIND_BY_EVENT_CLASS.get(event_class)
+    if kind is None:
+        if issubclass(event_class, _STARTUP_EVENT_CLASSES):
+            kind = STARTUP
+        elif issubclass(event_class, sc2reader.events.game.SelectionEvent):
+            kind = SELECTION
+        elif issubclass(event_class, sc2reader.events.game.CommandManagerStateEvent):
+            kind = COMMAND_MANAGER
+        elif issubclass(event_class, sc2reader.events.game.CommandEvent):
+            kind = COMMAND  # Or RETURN_CARGO, which depends on the event and not only the class.
+        elif issubclass(event_class, sc2reader.events.game.ControlGroupEvent):
+            kind = CONTROL_GROUP
+        elif issubclass(event_class, sc2reader.events.game.CameraEvent):
+            kind = CAMERA
+        else:
+            kind = OTHER
+        _KIND_BY_EVENT_CLASS[event_class] = kind
+    return kind
@@ -1,43 +1,75 @@
-from collections import defaultdict
-import sc2reader
-from features.utils_features import get_cut_events, add_feature_name_suffix
+import numpy as np
 
+from features.event_digest import CAMERA
+from features.utils_features import add_feature_name_suffix
+from features.feature_extracting.extractor_registry import EventExtractor, register_extractor
 
-def get_camera_event_chains(events, min_chain_length=0):
+
+def get_camera_event_chains(digest):
     """
-    Helper function to get the chains of camera events which is broken by any other type of event eg selection event
-    @return: list, [chain1, chain2, ...] where chain = [cam1, cam2, ...] where cam = [camera_event, camera_location_id]
-    The camera event coordinates are given by camera_event.x etc
-    The camera location id is meant to identify if the location has been visited before, numbered by 0,1,2,3,4,...
+    Helper function to get the chains of camera events which is broken by any other type of event eg selection event.
+    Note that a chain is only complete once it is broken, so camera events at the very end are counted for the
+    location ranking but are not part of any chain.
+    @param digest: EventDigest of the player.
+    @return: dict of numpy arrays with one element per camera event in a chain, in order:
+    "frame", "x", "y": of the camera event.
+    "chain_start": True for the first camera event of each chain.
+    "location_id": is meant to identify if the location has been visited before, numbered by 0,1,2,3,4,...
     where 0 means it is a unique location and 1 is the most visited and 2 is the second most visited etc.
     """
-    camera_counter = defaultdict(int)
-    chains = []
-    cameras = []
-    for event in events:
-        if type(event) == sc2reader.events.game.CameraEvent:
-            camera_counter[str(event.x) + ", " + str(event.y)] += 1
-            cameras.append([event])
-        else:
-            if len(cameras) > min_chain_length:
-                chains.append(cameras)
-            if len(cameras) > 0:
-                cameras = []
+    is_camera = digest.kind == CAMERA
+    n_events = len(is_camera)
+    # Chains are the runs of camera events, found from where is_camera changes.
+    changes = np.diff(np.concatenate(([0], is_camera.view(np.int8), [0])))
+    chain_starts = np.flatnonzero(changes == 1)
+    chain_ends = np.flatnonzero(changes == -1)
+    in_chain = is_camera.copy()
+    if len(chain_ends) > 0 and chain_ends[-1] == n_events:  # The last chain was never broken.
+        in_chain[chain_starts[-1] :] = False
+        chain_starts = chain_starts[:-1]
+    chain_start = np.zeros(n_events, dtype=bool)
+    chain_start[chain_starts] = True
+
     # figure out the ranking for each camera location, 0 visited only once, 1 most visited, 2 second most visited etc
-    sorted_camera_counter = sorted(list(camera_counter.items()), key=lambda x: -x[1])
-    cam_to_ranking = {}
-    for i in range(len(sorted_camera_counter)):
-        cam = sorted_camera_counter[i][0]
-        if sorted_camera_counter[i][1] == 1:
-            cam_to_ranking[cam] = 0
-        else:
-            cam_to_ranking[cam] = i + 1
-    # add this ranking into the chain
-    for chain in chains:
-        for lst in chain:
-            cam = str(lst[0].x) + ", " + str(lst[0].y)
-            lst.append(cam_to_ranking[cam])
-    return chains
+    # Ties are ranked by which location was visited first.
+    location_id = np.zeros(n_events, dtype=np.int64)
+    if np.any(is_camera):
+        locations = np.stack((digest.x[is_camera], digest.y[is_camera]), axis=1)
+        _, first_visit, inverse, counts = np.unique(
+            locations, axis=0, return_index=True, return_inverse=True, return_counts=True
+        )
+        ranking = np.empty(len(counts), dtype=np.int64)
+        ranking[np.lexsort((first_visit, -counts))] = np.arange(1, len(counts) + 1)
+        ranking[counts == 1] = 0
+        location_id[is_camera] = ranking[inverse.reshape(-1)]
+
+    return {
+        "frame": digest.frame[in_chain],
+        "x": digest.x[in_chain].astype(np.float64),
+        "y": digest.y[in_chain].astype(np.float64),
+        "chain_start": chain_start[in_chain],
+        "location_id": location_id[in_chain],
+    }
+
+
+@register_extractor
+class CameraFeatureExtractor(EventExtractor):
+    """Camera features over the whole game."""
+
+    suffix = ""
+
+    def extract(self, digest):
+        camera_chains = get_camera_event_chains(digest)
+        features = {**get_basic_camera_features(camera_chains), **get_recurrent_camera_features(camera_chains)}
+        return add_feature_name_suffix(features, self.suffix)
+
+
+@register_extractor
+class EarlyCameraFeatureExtractor(CameraFeatureExtractor):
+    """The same camera features, but only from the first 30 seconds."""
+
+    cutting_time = 30
+    suffix = "_earlygame"
 
 
 def get_basic_camera_features(camera_chains):
@@ -47,61 +79,30 @@ def get_basic_camera_features(camera_chains):
         location since a centered base camera will be 0 in x/y direction on some maps,
         this distance is highly correlated with speed so i ignore speed
         - fraction of unrepeated side scrolls compared to all movements
-    @param camera_chains: list, [chain1, chain2, ...] where chain = [cam1, cam2, ...] where cam = [camera_event, camera_location_id]
-        The camera event coordinates are given by camera_event.x etc
-        The camera location id is meant to identify if the location has been visited before, numbered by 0,1,2,3,4,...
-        where 0 means it is a unique location and 1 is the most visited and 2 is the second most visited etc.
+    @param camera_chains: dict of arrays, see get_camera_event_chains.
     @return: dict with all the features per replay-player.
     """
     return_dict = dict()
     # count total number of camera moves, total and chains
-    n_camera_moves = 0
-    n_chains = 0
-    n_equal_frames = 0
-    previous_frame = -1
-    for chain in camera_chains:
-        n_chains += 1
-        n_camera_moves += len(chain)
-        for cam in chain:
-            frame = cam[0].frame
-            if frame == previous_frame:
-                n_equal_frames += 1
-            else:
-                previous_frame = frame
-
-    n_side_scrolls = 0
-    distances_side_scrolls = []
-    prev_x = "unknown"
-    prev_y = "unknown"
-    for chain in camera_chains:
-        for i in range(len(chain)):
-            cam = chain[i][0]
-            camera_location_id = chain[i][1]
-            x = cam.x
-            y = cam.y
-            if camera_location_id != 0:  # it is a repeated camera, eg base
-                prev_x = "unknown"
-                prev_y = "unknown"
-                continue
-            elif i == 0:
-                prev_x = x
-                prev_y = y
-                continue
-            elif prev_x != "unknown" and prev_y != "unknown":
-                distance = ((x - prev_x) ** 2 + (y - prev_y) ** 2) ** 0.5
-                distances_side_scrolls.append(distance)
-                if x == prev_x or y == prev_y:
-                    n_side_scrolls += 1
-                prev_x = x
-                prev_y = y
-            else:  # not repeated, not the first in chain and they are set to unknown
-                prev_x = x
-                prev_y = y
+    n_camera_moves = len(camera_chains["frame"])
+    n_chains = int(np.count_nonzero(camera_chains["chain_start"]))
+    frames = camera_chains["frame"]
+    n_equal_frames = int(np.count_nonzero(frames[1:] == frames[:-1]))
+
+    # A side scroll is a move between two unrepeated camera locations within the same chain.
+    x = camera_chains["x"]
+    y = camera_chains["y"]
+    unrepeated = camera_chains["location_id"] == 0
+    is_side_scroll_move = unrepeated[1:] & unrepeated[:-1] & ~camera_chains["chain_start"][1:]
+    dx = (x[1:] - x[:-1])[is_side_scroll_move]
+    dy = (y[1:] - y[:-1])[is_side_scroll_move]
+    distances_side_scrolls = (dx**2 + dy**2) ** 0.5
+    n_side_scrolls = int(np.count_nonzero((dx == 0) | (dy == 0)))
     # final fixing of return variables
     if len(distances_side_scrolls) == 0:
         return_dict["distances_side_scrolls_mean"] = 0
     else:
-        return_dict["distances_side_scrolls_mean"] = sum(distances_side_scrolls) / len(distances_side_scrolls)
+        return_dict["distances_side_scrolls_mean"] = float(distances_side_scrolls.mean())
     if n_camera_moves == 0:
         return_dict["percentage_side_scrolls"] = 0
         return_dict["average_chain_length"] = 0
@@ -118,35 +119,8 @@ def get_recurrent_camera_features(camera_chains):
     This is just a simple function for now, ideally I want to connect the camera locations to base locations on a map basis automatically so I know which base is being selected.
     """
     return_dict = dict()
-    # reformat the data a bit for this purpose
-    location_id_and_frame_list = []
-    for chain in camera_chains:
-        for cam in chain:
-            location_id = cam[1]
-            frame = cam[0].frame
-            location_id_and_frame_list.append([location_id, frame])
-    # get features
-    non_zero_jumps = 0
-    previous_zero = False
-    for e in location_id_and_frame_list:
-        loc_id = e[0]
-        if not previous_zero:
-            if loc_id != 0:
-                non_zero_jumps += 1
-        if loc_id == 0:
-            previous_zero = True
-        else:
-            previous_zero = False
-    return_dict["non_zero_jumps"] = non_zero_jumps
+    # Count the repeated locations that do not come right after an unrepeated one.
+    repeated = camera_chains["location_id"] != 0
+    non_zero_jumps = np.count_nonzero(repeated[1:] & repeated[:-1]) + int(len(repeated) > 0 and repeated[0])
+    return_dict["non_zero_jumps"] = int(non_zero_jumps)
     return return_dict
-
-
-def get_all_camera_features(player, events):
-    camera_chains = get_camera_event_chains(events)
-    early_camera_chains = get_camera_event_chains(get_cut_events(player, "start", 30))
-    return {
-        **get_basic_camera_features(camera_chains),
-        **get_recurrent_camera_features(camera_chains),
-        **add_feature_name_suffix(get_basic_camera_features(early_camera_chains), "_earlygame"),
-        **add_feature_name_suffix(get_recurrent_camera_features(early_camera_chains), "_earlygame"),
-    }  # merge the dicts
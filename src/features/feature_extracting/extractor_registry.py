@@ -0,0 +1,31 @@
+# Registry of everything that is extracted from a player's events, see features.main_features.extract_features.
+
+EXTRACTORS = []
+
+
+def register_extractor(extractor_class):
+    """Class decorator that adds an EventExtractor to the registry. Extractors run in the order they are registered."""
+    EXTRACTORS.append(extractor_class)
+    return extractor_class
+
+
+class EventExtractor:
+    """
+    Base class for extracting something from the events of a single player. The events are first summarized into an
+    EventDigest in a single pass (see features.event_digest), and every extractor then works on the numpy columns of
+    the digest instead of looping over the events itself.
+
+    cutting_time: only get the events before this many seconds into the game, None for the whole game.
+    output: "features" if extract() returns a dict of features that should be added to PlayerData.features, otherwise
+    the name under which the result of extract() is returned by extract_features.
+    """
+
+    cutting_time = None
+    output = "features"
+
+    def __init__(self, config):
+        self.config = config
+
+    def extract(self, digest):
+        """@param digest: EventDigest of the player, already cut to cutting_time."""
+        raise NotImplementedError
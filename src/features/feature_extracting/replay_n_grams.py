@@ -1,52 +1,61 @@
-import pandas as pd
 from scipy import sparse
 import numpy as np
-import sc2reader
 
 from utils.utils import camera_distance
+from features import event_digest
+from features.feature_extracting.extractor_registry import EventExtractor, register_extractor
 
 
-def extract_n_grams(config, early_events, replay_id, toon_race):
-    n_grams = []
-    # hyperparams
-    # Transform events to ids: a list of a unique id (int) for each type of event.
-    ids, base = events_to_ids(config, early_events)
-    for n in range(1, config['hyperparams']['HIGHEST_N'] + 1):  # n as in n_gram.
-        # Get the n_gram_vector from the current replay
-        n_gram_vector = n_gram(ids, n, base)
-        # Update sparse_n_gram
-        df_addition = pd.DataFrame()
-        df_addition["replay_id"] = [replay_id]
-        df_addition["toon_race"] = [toon_race]
-        df_addition["sparse_n_gram"] = [n_gram_vector]
-        n_grams.append(df_addition)
-    return n_grams
-
-
-def n_gram(int_list, N, base):
-    """
-    Transforms a list of integers into the n_grams, but represents each n_gram as a single unique integer.
-    Base is then the number of possible unique integers in the input list.
-    """
+@register_extractor
+class NGramIdExtractor(EventExtractor):
+    """Transforms the earlygame events to ids: a list of a unique id (int) for each type of event, see events_to_ids."""
 
-    def array_to_vector_idx(v, base):
-        """
-        Transforms a number from other base to regular base 10.
-        @param v: vector, for example [3, 5, 7]
-        @param base: numerical base used in transformation, for example 20
-        @return: in this example, returns 3*20^0 + 5*20^1 + 7*20^2.
-        """
-        multiplier = [base**i for i in range(len(v))]
-        return np.dot(v, multiplier)
+    cutting_time = 30
+    output = "n_gram_ids"
 
-    s = sparse.dok_array((1, base**N), dtype=np.float32)
-    for i in range(len(int_list) - N + 1):
-        s[0, array_to_vector_idx(int_list[i : i + N], base)] += 1
-    s = s.tocsr()
-    return s
+    def extract(self, digest):
+        return events_to_ids(self.config, digest)
 
 
-def events_to_ids(config, events):
+def extract_n_grams(config, ids, base):
+    """
+    @param ids, base: the output of events_to_ids (through NGramIdExtractor).
+    @return: [csr_array of shape (1, base**N), ...] for N = 1, ..., HIGHEST_N.
+
+    The n_grams are left in code space: this runs in the worker processes (see DBMS._parse_replay) where the
+    NGramVocabulary of the database is not available, and it is still growing while the replays are loaded. NGrams maps
+    the codes to its columns once, when a game is entered or classified. The wide shape costs nothing, a csr_array only
+    stores the n_grams that occur.
+    """
+    return all_n_grams(ids, config['hyperparams']['HIGHEST_N'], base)
+
+
+def all_n_grams(int_list, highest_n, base):
+    """
+    Transforms a list of integers into the n_grams for every N from 1 to highest_n, but represents each n_gram as a
+    single unique integer: the n_gram [3, 5, 7] gets the index 3*base^0 + 5*base^1 + 7*base^2.
+    Base is then the number of possible unique integers in the input list.
+    The index of every N-long window is found from the (N-1)-long window starting at the same place, for all windows at
+    once.
+    @return: [csr_array of shape (1, base**N) with the number of occurrences of each n_gram, ...] for N = 1, ...,
+    highest_n.
+    """
+    int_list = np.asarray(int_list, dtype=np.int64)
+    n_gram_vectors = []
+    codes = np.zeros(len(int_list), dtype=np.int64)
+    for N in range(1, highest_n + 1):
+        # codes[i] is the index of the n_gram int_list[i : i + N].
+        codes = codes[: max(len(int_list) - N + 1, 0)] + int_list[N - 1 :] * base ** (N - 1)
+        n_gram_idxs, counts = np.unique(codes, return_counts=True)
+        n_gram_vectors.append(
+            sparse.csr_array(
+                (counts.astype(np.float32), n_gram_idxs, np.array([0, len(n_gram_idxs)])), shape=(1, base**N)
+            )
+        )
+    return n_gram_vectors
+
+
+def events_to_ids(config, digest):
     """
 
     Numerical order of events and how many different types of each:
@@ -56,6 +65,7 @@ def events_to_ids(config, events):
     ControlGroupEvent - 5: set, get, remove, steal set, steal add (steal set / steal add might be in reversed order)
     CameraEvent_N - 3: unique cam, repeated cam, main base cam
     other - 1
+    @param digest: EventDigest of the events to transform, see features.event_digest.
     """
     # Prep.
     # Help with mapping from event to int
@@ -74,118 +84,51 @@ def events_to_ids(config, events):
     others_start = CameraEvent_start + CameraEvent_N
     base = others_start + 1
 
-    # Save all camera data since I need all of it before I can start classifying.
-    base_location = False
-    locations = []
-
-    ids = np.zeros(len(events), dtype=int)
-    break_idxs = []
-    for i, event in enumerate(events):
-        if event.frame - events[max(i - 1, 0)].frame >= config['hyperparams']['BREAKTIME']:
-            break_idxs.append(i)
-
-
-        if _is_startup_event(event):
-            ids[i] = -1
-            continue
-
-        elif isinstance(event, sc2reader.events.game.SelectionEvent):
-            # 0 = base, 1 = single worker, 2 = multiple workers, 3 = other
-            ids[i] = SelectionEvent_start
-            selection = event.objects
-            if len(selection) == 1:
-                if selection[0].is_worker:
-                    ids[i] = SelectionEvent_start + 1
-                elif selection[0].is_building:
-                    if selection[0].minerals > 200:
-                        ids[i] = SelectionEvent_start
-                        if not base_location:
-                            base_location = selection[0].location
-                else:
-                    ids[i] = SelectionEvent_start + 3
-            else:
-                only_workers = True
-                for obj in selection:
-                    if not obj.is_worker:
-                        ids[i] = SelectionEvent_start + 3
-                        only_workers = False
-                        break
-                if only_workers:
-                    ids[i] = SelectionEvent_start + 2
-            continue
-
-        elif isinstance(event, sc2reader.events.game.CommandManagerStateEvent):
-            ids[i] = CommandManagerStateEvent_start
-            continue
-
-        elif isinstance(event, sc2reader.events.game.CommandEvent):
-            ids[i] = CommandEvent_start
-            continue
-
-        elif isinstance(event, sc2reader.events.game.ControlGroupEvent):
-            # update_type: 0=set, 1=add, 2=get, 3=remove (when stolen to another),
-            # 4/5 are create-steal/add-steal (or the other way around i don't remember atm).
-            ids[i] = ControlGroupEvent_start + event.update_type
-            continue
-
-        elif isinstance(event, sc2reader.events.game.CameraEvent):
-            # IMPROVEMENT: write this function, I want 0 = unique, 1 = repeated, 2 = main base repeated,
-            # 3 = main base unique
-            ids[i] = -10  # will be changed later
-            locations.append(event.location)
-            continue
-
-        else:
-            ids[i] = others_start
-            continue
-
-    #   Swap all camera events from -10 to their proper value now that I have all of them.
-    # First figure out which locations are repeated, make a set
-    repeated_locations_set = set()
-    seen_once = set()
-    for loc in locations:
-        if loc in seen_once:
-            repeated_locations_set.add(loc)
-        else:
-            seen_once.add(loc)
-    # Use this data along with camera distance to main base_location to classify the camera events
-    main_base_radius = 10
-    updated_camera_ids = []
-    for loc in locations:
-        dist = camera_distance(base_location, loc)
-        if loc in repeated_locations_set:
-            if dist < main_base_radius:
-                updated_camera_ids.append(CameraEvent_start + 2)
-            else:
-                updated_camera_ids.append(CameraEvent_start + 1)
-        else:
-            if dist < main_base_radius:
-                updated_camera_ids.append(CameraEvent_start + 3)
-            else:
-                updated_camera_ids.append(CameraEvent_start + 0)
-    # Swap out all -10 values to updated_camera_ids
-    ids[ids == -10] = updated_camera_ids
-
-    # SPEEDUP: instead of transforming back and forth to list it might be neater to find a way to insert into numpy array...
-    # insert break actions at given indexes.
-    ids = list(ids)
-    for i in reversed(break_idxs):  # reverse order so insertions do not affect the indexes afterwards
-        ids.insert(i, break_start)
-
-    ids = np.array(ids, dtype=int)
+    # Id of each event kind, selection and control group events then add their value (see EventDigest) to this.
+    id_by_kind = np.zeros(max(event_digest.KIND_CODES) + 1, dtype=int)
+    id_by_kind[event_digest.OTHER] = others_start
+    id_by_kind[event_digest.STARTUP] = -1
+    # 0 = base, 1 = single worker, 2 = multiple workers, 3 = other
+    id_by_kind[event_digest.SELECTION] = SelectionEvent_start
+    id_by_kind[event_digest.COMMAND_MANAGER] = CommandManagerStateEvent_start
+    id_by_kind[event_digest.COMMAND] = CommandEvent_start
+    id_by_kind[event_digest.RETURN_CARGO] = CommandEvent_start
+    # update_type: 0=set, 1=add, 2=get, 3=remove (when stolen to another),
+    # 4/5 are create-steal/add-steal (or the other way around i don't remember atm).
+    id_by_kind[event_digest.CONTROL_GROUP] = ControlGroupEvent_start
+    id_by_kind[event_digest.CAMERA] = CameraEvent_start
+
+    kind = digest.kind
+    ids = id_by_kind[kind]
+    has_value = (kind == event_digest.SELECTION) | (kind == event_digest.CONTROL_GROUP)
+    ids[has_value] += digest.value[has_value]
+
+    # IMPROVEMENT: write this function, I want 0 = unique, 1 = repeated, 2 = main base repeated,
+    # 3 = main base unique
+    # The main base is the first base that was selected.
+    is_camera = kind == event_digest.CAMERA
+    base_selections = np.flatnonzero((kind == event_digest.SELECTION) & ~np.isnan(digest.x))
+    if np.any(is_camera):
+        x = digest.x[is_camera].astype(np.float64)
+        y = digest.y[is_camera].astype(np.float64)
+        _, inverse, counts = np.unique(np.stack((x, y), axis=1), axis=0, return_inverse=True, return_counts=True)
+        is_repeated = counts[inverse.reshape(-1)] > 1
+        # Use this data along with camera distance to main base_location to classify the camera events
+        main_base_radius = 10
+        base_location = False
+        if len(base_selections) > 0:
+            base_location = (float(digest.x[base_selections[0]]), float(digest.y[base_selections[0]]))
+        is_main_base = camera_distance(base_location, (x, y)) < main_base_radius
+        camera_offsets = np.where(is_repeated, np.where(is_main_base, 2, 1), np.where(is_main_base, 3, 0))
+        ids[is_camera] += camera_offsets
+
+    # insert break actions before every event that comes at least BREAKTIME frames after the previous one.
+    frames = digest.frame.astype(np.int64)
+    break_idxs = np.flatnonzero(np.diff(frames, prepend=frames[:1]) >= config['hyperparams']['BREAKTIME'])
+    ids = np.insert(ids, break_idxs, break_start)
     # remove all starting events = -1
     ids = ids[ids != -1]
 
     # finally remove all starting zeros that were put as a "break" before
     ids = np.trim_zeros(ids, "f")
     return ids, base
-
-
-def _is_startup_event(event):
-    if isinstance(event, sc2reader.events.message.ChatEvent):
-        return True
-    if isinstance(event, sc2reader.events.message.ProgressEvent):
-        return True
-    if isinstance(event, sc2reader.events.game.UserOptionsEvent):
-        return True
-    return False
@@ -1,16 +1,18 @@
-import sc2reader
+import numpy as np
 
+from features.event_digest import RETURN_CARGO
+from features.feature_extracting.extractor_registry import EventExtractor, register_extractor
 
-def get_return_cargo_info(events):
+
+@register_extractor
+class ReturnCargoExtractor(EventExtractor):
     """
     returns 1 if return cargo was used, otherwise 0.
     """
+
     # IMPROVEMENT: see if it is used at home or just to send home scout that picked up minerals. and for all game to see if key is bound, 2 things to look at. could also see what is done when probe is holding a mineral (not great for other races, but does it matter?)
     # IMPROVEMENT: see if it is done after sending back workers to mineral fields or INSTEAD of sending back to mineral field.
     # IMPROVEMENT: see if it is done before sending into a gas guyser
-    n = 0
-    for event in events:
-        if isinstance(event, sc2reader.events.game.CommandEvent):
-            if event.ability_name == "ReturnCargo":
-                return {"return cargo used": 1}
-    return {"return cargo used": 0}
+
+    def extract(self, digest):
+        return {"return cargo used": int(np.any(digest.kind == RETURN_CARGO))}
@@ -1,17 +1,31 @@
 # Holds main function for feature extraction.
-from features.feature_extracting.return_cargo import get_return_cargo_info
-from features.feature_extracting.camera_features import get_all_camera_features
+from features.feature_extracting.extractor_registry import EXTRACTORS
+# The extractor modules register their extractors when imported, in this order.
+from features.feature_extracting import camera_features, return_cargo, replay_n_grams  # noqa: F401
 
 
-def extract_features(player, early_events):
+def extract_features(config, digest):
+    """
+    Runs every registered extractor on the player's events.
+    @param digest: EventDigest of the player, see features.event_digest.
+    @return: (feature_dict, outputs) where outputs holds the results of the extractors that do not make features,
+    {output: result, ...}.
+    """
     # basic info features
     feature_dict = dict()
-    feature_dict["toon"] = player.toon_handle
-    feature_dict["race"] = player.play_race
-    feature_dict["apm"] = player.avg_apm
-    # prep for more advanced features
-    events = player.events
-    # add features from my more advanced functions
-    feature_dict = {**feature_dict, **get_all_camera_features(player, events)}
-    feature_dict = {**feature_dict, **get_return_cargo_info(events)}
-    return feature_dict
+    feature_dict["toon"] = digest.toon
+    feature_dict["race"] = digest.race
+    feature_dict["apm"] = digest.apm
+
+    cut_digests = dict()  # Each time window is only cut once, {cutting_time: EventDigest}.
+    outputs = dict()
+    for extractor_class in EXTRACTORS:
+        extractor = extractor_class(config)
+        if extractor.cutting_time not in cut_digests:
+            cut_digests[extractor.cutting_time] = digest.cut(extractor.cutting_time)
+        result = extractor.extract(cut_digests[extractor.cutting_time])
+        if extractor.output == "features":
+            feature_dict = {**feature_dict, **result}
+        else:
+            outputs[extractor.output] = result
+    return feature_dict, outputs
@@ -1,5 +1,5 @@
 from features.main_features import extract_features
-from features.utils_features import get_cut_events
+from features.event_digest import EventDigest
 from features.feature_extracting.replay_n_grams import extract_n_grams
 
 
@@ -7,29 +7,36 @@ class PlayerData:
     """
     self.toon_race: str((toon, race))
     self.features: Dict of features, {feat_1_name: feat_1, ...}
-    self.n_grams: List of dataframes, each dataframe has 3 columns, "replay_id", "toon_race", "sparse_n_gram" where
-    sparse_n_gram is a scipy sparse csr array.
+    self.n_grams: List of scipy sparse csr arrays of shape (1, n_columns), the first element is 1_gram, 2_gram etc.
     self.replay_id: The replay hash.
+    self.digest: The EventDigest that the features were extracted from, None if made from complete_data.
     """
 
-    def __init__(self, config, player=None, replay_id=None, complete_data=None):
+    def __init__(self, config, player=None, replay_id=None, complete_data=None, digest=None):
         """
-        Call either with player (sc2reader replay.player) and replay_id or with complete_data.
+        Call either with player (sc2reader replay.player) and replay_id, with digest and replay_id or with
+        complete_data.
 
+        @param digest: an EventDigest, typically loaded from the database to extract the features again without
+        parsing the replay.
         @param complete_data: a dict with all the required data, this is typically used from the database where
         the replay sc2reader player object is not accessible.
         """
-        assert ((player is not None) and (replay_id is not None)) or complete_data is not None
+        assert ((player is not None or digest is not None) and (replay_id is not None)) or complete_data is not None
         # If we need to extract the data from the replay.
-        if (player is not None) and (replay_id is not None):
-            self.toon_race = str((player.toon_handle, player.play_race))
-            early_events = get_cut_events(player, "start", cutting_time=30)
-            self.features = extract_features(player, early_events)
-            self.n_grams = extract_n_grams(config, early_events, replay_id, self.toon_race)
+        if player is not None:
+            digest = EventDigest.from_player(player)
+        if (digest is not None) and (replay_id is not None):
+            self.toon_race = str((digest.toon, digest.race))
+            self.features, outputs = extract_features(config, digest)
+            ids, base = outputs["n_gram_ids"]
+            self.n_grams = extract_n_grams(config, ids, base)
             self.replay_id = replay_id
+            self.digest = digest
         # If the data has already been extracted from the replay, we simply want to convert it to this class instance.
         elif complete_data is not None:
             self.features = complete_data["features"]
             self.n_grams = complete_data["n_grams"]
             self.toon_race = complete_data["toon_race"]
             self.replay_id = complete_data["replay_id"]
+            self.digest = None
@@ -1,7 +1,4 @@
 # utility functions related to the features.
-import os
-import json
-from collections import defaultdict
 
 
 def add_feature_name_suffix(features, suffix):
@@ -40,18 +37,3 @@ def get_cut_events(player, game_part="all", cutting_time=30):
                 reached_cutting_time = True
         return filtered_events
 
-
-def add_name_to_toon_dict(program_path, toon, name):
-    # load toon_dict from file
-    dict_path = os.path.join(program_path, "database", "toon_handle_to_names.txt")
-    with open(dict_path, "r") as infile:
-        toon_dict = json.load(infile)
-    toon_dict = defaultdict(list, toon_dict)
-    # update the variable
-    if name in toon_dict[toon]:
-        return
-    else:
-        toon_dict[toon].append(name)
-    # update the file
-    with open(dict_path, "w") as outfile:
-        json.dump(toon_dict, outfile)
@@ -1,17 +1,16 @@
 import os
 import tkinter as tk
 from tkinter import messagebox
-import time
 import threading
 
 import sc2reader
 from sc2reader.engine.plugins.apm import APMTracker
 
-from features.evaluate_features import get_feature_relevances
 from classifiers.eval_classificatiton import test_classification_accuracy
 from database.DBMS import DBMS
+from database.replay_scanner import ReplayScanner
+from database.replay_watcher import ReplayWatcher
 from utils.utils import (
-    get_toon_dict,
     load_config,
     get_most_recent_replay_filename,
     try_load_replay,
@@ -29,6 +28,7 @@ class MainApplication:
         self.user_quit_event = threading.Event()
 
         self.dbms = False
+        self.watcher = False
         self.data_path = data_path
         self.config = config
         self.program_path = program_path
@@ -50,6 +50,13 @@ class MainApplication:
             command=self.load_all_unloaded_replays,
         )
         self.button_load.pack(padx=10, pady=5)
+        self.button_refeaturize = tk.Button(
+            self.frame_main,
+            text="Extract features again",
+            font=("Arial", 14),
+            command=self.refeaturize_loaded_replays,
+        )
+        self.button_refeaturize.pack(padx=10, pady=5)
         self.button_classify_recent = tk.Button(
             self.frame_main,
             text="Classify the most recent game",
@@ -90,14 +97,29 @@ class MainApplication:
 
         self.frame_main.pack()
         self.root.protocol("WM_DELETE_WINDOW", self.when_closing_window)
+        if self.config["options"]["AUTO_INGEST"]:
+            self.start_watcher()
         self.root.mainloop()
 
+    def start_watcher(self):
+        """Start loading new replays in the background as soon as they are written, see ReplayWatcher."""
+        if not self.dbms:
+            self.dbms = DBMS(self.config, program_path, reset_before_loading=False)
+        if self.watcher:
+            self.watcher.stop()
+        self.watcher = ReplayWatcher(
+            self.dbms,
+            poll_seconds=self.config["options"]["AUTO_INGEST_POLL_SECONDS"],
+            debounce_seconds=self.config["options"]["AUTO_INGEST_DEBOUNCE_SECONDS"],
+        )
+        self.watcher.start()
+
     def set_replay_dir(self):
         replay_dir = tk.filedialog.askdirectory()
         print(f"You selected the directory: {replay_dir}")
         # Check how many replays there are in the dir.
         list_of_replay_paths, latest_replay_time = get_replays_recursively(
-            folder_path=replay_dir
+            ReplayScanner(), folder_path=replay_dir
         )
         print(
             f"There are {len(list_of_replay_paths)} replays in this directory and it's sub-folders."
@@ -112,6 +134,9 @@ class MainApplication:
             if self.dbms is not False:
                 self.dbms.config["options"]["REPLAY_FOLDER_PATH"] = replay_dir
             set_config(self.program_path, config=self.config)
+            # Restart so that the replays already in the new folder are not treated as new.
+            if self.watcher:
+                self.start_watcher()
         else:
             print("Not setting the replay path.")
 
@@ -120,6 +145,8 @@ class MainApplication:
         print("Closing program, please wait...")
         self.user_quit_event.set()
         self.stop_event.set()
+        if self.watcher:
+            self.watcher.stop()
         self.root.destroy()
         print("Program closed.")
 
@@ -145,19 +172,44 @@ class MainApplication:
 
         threading.Thread(target=process_all_replays).start()
 
+    def refeaturize_loaded_replays(self):
+        """
+        Start a new thread to extract the features of all loaded replays again, without parsing them. Used after
+        changing the hyperparams in config.yaml or the feature extraction.
+        """
+
+        def refeaturize():
+            self.stop_event.clear()
+            self.frame_main.pack_forget()
+            self.frame_stop.pack()
+            # Use the current hyperparams from config.yaml.
+            self.config = load_config(self.program_path)
+            if not self.dbms:
+                self.dbms = DBMS(self.config, program_path, reset_before_loading=False)
+            self.dbms.config = self.config
+            self.dbms.refeaturize_from_digests(self.stop_event)
+            # Put GUI back when it is finished.
+            if not self.user_quit_event.is_set():
+                self.frame_stop.pack_forget()
+                self.frame_main.pack()
+
+        threading.Thread(target=refeaturize).start()
+
     def classify_most_recent_replay(self):
         if not self.dbms:
             self.dbms = DBMS(self.config, program_path, reset_before_loading=False)
         # Classify most recent.
-        most_recent_replay_path = get_most_recent_replay_filename(self.config)[0]
+        most_recent_replay_path = get_most_recent_replay_filename(self.config, self.dbms.scanner)[0]
+        if most_recent_replay_path is None:
+            return
         classify_replay_filepath(
             self.config,
             most_recent_replay_path,
             dbms=self.dbms,
             to_visualize=True,
-            data_path=self.data_path,
         )
-        if self.config["options"]["UPDATE_DB_AFTER_CLASSIFYING"]:
+        # The watcher already loads new replays by itself, no need to go through the whole folder.
+        if self.config["options"]["UPDATE_DB_AFTER_CLASSIFYING"] and not (self.watcher and self.watcher.is_running()):
             self.load_all_unloaded_replays()
         return
 
@@ -171,7 +223,6 @@ class MainApplication:
             filename,
             dbms=self.dbms,
             to_visualize=True,
-            data_path=self.data_path,
         )
         return
 
@@ -193,6 +244,8 @@ class MainApplication:
             self.dbms = DBMS(self.config, program_path, reset_before_loading=True)
             self.dbms.save_to_file()
             print("Database reset.")
+            if self.watcher:
+                self.start_watcher()
         else:
             print("Not resetting.")
 
@@ -211,8 +264,7 @@ if __name__ == "__main__":
     # test
     if config["options"]["RUN_TESTS"]:
         dbms = DBMS(config, program_path, reset_before_loading=False)
-        toon_dict = get_toon_dict(data_path)
-        feature_relevances = get_feature_relevances(dbms.rep_feats.features)
+        feature_relevances = dbms.get_feature_relevances()
         print("Feature relevances:\n", feature_relevances, "-----------------------")
 
         features_to_drop = [
@@ -224,7 +276,7 @@ if __name__ == "__main__":
 
         acc, n_trials = test_classification_accuracy(
             config,
-            toon_dict,
+            dbms.toon_dir,
             dbms,
             n_sample_games=1,
             columns_to_remove=features_to_drop,
@@ -1,7 +1,7 @@
-import json
 import os
 import platform
 import re
+from contextlib import contextmanager
 from pathlib import Path
 
 import yaml
@@ -64,26 +64,10 @@ def is_barcode(name):
     return True
 
 
-def is_toon_barcode(toon, toon_dict):
-    names = toon_dict[toon]
-    bc = True
-    for name in names:
-        if not is_barcode(name):
-            bc = False
-    return bc
-
-
-
-def get_toon_dict(data_path):
-    dict_path = os.path.join(data_path, "toon_handle_to_names.txt")
-    with open(dict_path, "r") as infile:
-        toon_dict = json.load(infile)
-    return toon_dict
-
-
 def camera_distance(base_loc, loc2):
     """
-    Measures the distance between two camera event location as tuples of (x, y) coordinates.
+    Measures the distance between two camera event location as tuples of (x, y) coordinates. The coordinates of loc2
+    can also be numpy arrays to measure the distance to many locations at once.
 
     Note that base_loc can have the value False if it is unknown. (was never selected in the earlygame).
     """
@@ -94,6 +78,20 @@ def camera_distance(base_loc, loc2):
     )
 
 
+@contextmanager
+def open_atomic(file_path, mode="w"):
+    """
+    Use like open() for writing. The data is written to a temporary file which then replaces file_path, so that a crash
+    or closing the program mid-write leaves either the old or the new file, never a half-written one.
+    """
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, mode) as f:
+        yield f
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
 def load_config(program_path):
     filename = os.path.join(program_path, "config", "config.yaml")
     with open(filename, "r") as f:
@@ -107,50 +105,65 @@ def set_config(program_path, config):
         yaml.safe_dump(config, f, sort_keys=False)
 
 
-def get_replays_recursively(config=False, filter_update_time=False, folder_path=False):
-    """This function is called either using config or a set folder path."""
-    if not folder_path:
-        folder_path = config["options"]["REPLAY_FOLDER_PATH"]
-    list_of_replay_paths = []
-    for root, subdirs, files in os.walk(folder_path):
-        for file in files:
-            if file.endswith(".SC2Replay"):
-                list_of_replay_paths.append(os.path.join(root, file))
+def get_replay_folder_paths(config):
+    """options -> REPLAY_FOLDER_PATH is either a single folder or a list of folders."""
+    folder_paths = config["options"]["REPLAY_FOLDER_PATH"]
+    if isinstance(folder_paths, str):
+        return [folder_paths]
+    return list(folder_paths)
+
+
+def get_replays_recursively(scanner, config=False, filter_update_time=False, folder_path=False):
+    """
+    This function is called either using config or a set folder path.
+    @param scanner: ReplayScanner, normally dbms.scanner so that unchanged folders are not listed again.
+    """
+    if folder_path:
+        folder_paths = [folder_path]
+    else:
+        folder_paths = get_replay_folder_paths(config)
+    replays = scanner.scan(folder_paths)  # [(path, mtime), ...]
 
     # Display message if no replays are found.
-    if len(list_of_replay_paths) == 0:
+    if len(replays) == 0:
         print(
-            f"No replays found in {folder_path}"
+            f"No replays found in {', '.join(folder_paths)}"
             f", This path can be updated manually in config/config.yaml or set with the GUI interface."
         )
-
-    # Filepaths length 259 and longer struggle on Windows, need to rewrite them.
-    # Unfortunately a lot of replay packs have very deep folders with very long names so this is a common occurrence.
-    if platform.system() == "Windows":
-        for i, path in enumerate(list_of_replay_paths):
-            if len(path) > 259:
-                list_of_replay_paths[i] = Path("\\\\?\\" + path)
+        return [], filter_update_time or 0.0
 
     # Sort replays, start with oldest
-    list_of_replay_paths.sort(key=lambda x: os.path.getmtime(x))
-    latest_replay_time = os.path.getmtime(list_of_replay_paths[-1])
+    replays.sort(key=lambda x: x[1])
+    latest_replay_time = replays[-1][1]
 
     # Remove all replays before or at the same time as filter_update_time since they have already been processed, if we
     # want this
     if config:
         if not config["options"]["LOAD_OLD_REPLAYS"]:
             if filter_update_time is not False:
-                list_of_replay_paths = [p for p in list_of_replay_paths if (os.path.getmtime(p) > filter_update_time)]
+                replays = [(p, mtime) for p, mtime in replays if mtime > filter_update_time]
 
+    list_of_replay_paths = [long_path_safe(p) for p, _ in replays]
     return list_of_replay_paths, latest_replay_time
 
 
-def get_most_recent_replay_filename(config):
-    folder_path = config["options"]["REPLAY_FOLDER_PATH"]
-    list_of_replay_paths = get_replays_recursively(config=config)[0]
-    list_of_replay_paths.sort(key=lambda x: os.path.getmtime(x))
-    print(f"The most recent replay is {list_of_replay_paths[-1]}")
-    return list_of_replay_paths[-1], os.path.getmtime(list_of_replay_paths[-1])
+def get_most_recent_replay_filename(config, scanner):
+    replay_path, mtime = scanner.get_most_recent_replay(get_replay_folder_paths(config))
+    if replay_path is None:
+        print(f"No replays found in {', '.join(get_replay_folder_paths(config))}")
+        return None, None
+    print(f"The most recent replay is {replay_path}")
+    return long_path_safe(replay_path), mtime
+
+
+def long_path_safe(path):
+    """
+    Filepaths length 259 and longer struggle on Windows, need to rewrite them.
+    Unfortunately a lot of replay packs have very deep folders with very long names so this is a common occurrence.
+    """
+    if platform.system() == "Windows" and len(path) > 259:
+        return Path("\\\\?\\" + path)
+    return path
 
 
 def replay_is_relevant(replay):
@@ -163,13 +176,23 @@ def replay_is_relevant(replay):
     @param replay: sc2reader.resources.Replay
     @return: Bool
     """
-    # check that it is longer than 3 min
-    if replay.game_length.seconds < 180:
+    if not replay_details_are_relevant(replay):
         return False
     # check that it was not played from replay
     for event in replay.events:
         if type(event) == sc2reader.events.game.HijackReplayGameEvent:
             return False
+    return True
+
+
+def replay_details_are_relevant(replay):
+    """
+    The part of replay_is_relevant that does not need the game events, so that it also works on a replay loaded with
+    load_level=DETAILS_LOAD_LEVEL.
+    """
+    # check that it is longer than 3 min
+    if replay.game_length.seconds < 180:
+        return False
     # check that it includes exactly 2 non AI players
     if len(replay.players) != 2:
         return False
@@ -179,10 +202,35 @@ def replay_is_relevant(replay):
     return True
 
 
-def try_load_replay(replay_path):
+# sc2reader load level that reads the replay header (game length), details and players, but no game events.
+DETAILS_LOAD_LEVEL = 2
+
+
+def try_load_replay(replay_path, load_level=4):
     try:
-        return sc2reader.load_replay(replay_path)
+        return sc2reader.load_replay(replay_path, load_level=load_level)
     except Exception:
         print(f"Unable to parse the replay with sc2reader. The given filepath was: {replay_path}")
         return False
 
+
+def try_load_relevant_replay(replay_path):
+    """
+    Loads the replay in two steps: first only the header and details, which is enough to throw away short games, team
+    games and games against AI without decoding the game events (by far the slowest part of loading). Only replays that
+    pass this get the full load, after which the remaining relevance check is done.
+    @return: (replay, is_relevant), where replay is False if sc2reader could not parse it and None if it was found
+    irrelevant by the first step.
+    """
+    try:
+        # engine=None since the engine plugins (e.g. the APMTracker) are only needed with the game events.
+        details_replay = sc2reader.load_replay(replay_path, load_level=DETAILS_LOAD_LEVEL, engine=None)
+    except Exception:
+        details_replay = None  # Let the full load decide, it also prints the error message.
+    if details_replay is not None and not replay_details_are_relevant(details_replay):
+        return None, False
+    replay = try_load_replay(replay_path)
+    if replay is False:
+        return False, False
+    return replay, replay_is_relevant(replay)
+
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The program is run from src, which is where its imports start from.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,18 @@
+import os
+
+from database.event_digests import EventDigests
+
+
+def test_replay_hashes_are_in_the_order_they_were_saved(tmp_path):
+    event_digests = EventDigests(str(tmp_path))
+    replay_hashes = ["c" * 32, "a" * 32, "b" * 32]
+    for replay_hash in replay_hashes:
+        event_digests.save_replay(replay_hash, [])
+    # The order does not depend on the modification times of the files, e.g. after copying them.
+    for i, replay_hash in enumerate(replay_hashes):
+        os.utime(event_digests.get_path(replay_hash), ns=(0, (len(replay_hashes) - i) * 10**9))
+    assert event_digests.get_replay_hashes() == replay_hashes
+
+    # A replay that is saved again moves to the end.
+    event_digests.save_replay("c" * 32, [])
+    assert event_digests.get_replay_hashes() == ["a" * 32, "b" * 32, "c" * 32]
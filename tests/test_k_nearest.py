@@ -0,0 +1,28 @@
+import numpy as np
+
+from classifiers.k_nearest import best_games_mean, closest_indices
+
+
+def test_best_games_mean():
+    rng = np.random.default_rng(0)
+    game_players = rng.integers(0, 20, size=300)
+    game_dists = np.round(rng.random(300) * 5)
+    expected = [np.sort(game_dists[game_players == player])[:3].mean() for player in range(20)]
+    assert np.allclose(best_games_mean(game_dists, game_players, 21, 3), expected + [np.inf])
+
+
+def test_best_games_mean_with_close_distances():
+    # Many players and distances that only differ far behind the decimal point, relative to the largest one.
+    n_players = 100000
+    game_players = np.repeat(np.arange(n_players), 2)
+    game_dists = np.tile([1e12 + 1, 1e12], n_players)
+    game_dists[0] = 0.5
+    dists = best_games_mean(game_dists, game_players, n_players, 1)
+    assert dists[0] == 0.5
+    assert np.all(dists[1:] == 1e12)
+
+
+def test_closest_indices():
+    dists = np.array([5.0, 1.0, 4.0, 2.0, 3.0])
+    assert closest_indices(dists, 3).tolist() == [1, 3, 4]
+    assert closest_indices(dists, 10).tolist() == [1, 3, 4, 2, 0]
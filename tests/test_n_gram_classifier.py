@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from classifiers.n_gram_classifier import n_gram_classify
+from database.n_grams_class import NGrams
+from database.player_keys import PlayerKeys
+
+HIGHEST_N = 4
+BASE = 17
+
+
+class FakeToonDirectory:
+    def is_barcode(self, toon):
+        return False
+
+    def __getitem__(self, toon):
+        return toon
+
+
+def make_n_grams(codes):
+    """
+    @param codes: [[code, ...], ...] the n_grams for each n, each one occurring once.
+    @return: [csr_array, ...] like PlayerData.n_grams.
+    """
+    return [
+        sparse.csr_array(
+            (np.ones(len(n_codes), dtype=np.float32), (np.zeros(len(n_codes), dtype=int), n_codes)), shape=(1, BASE**n)
+        )
+        for n, n_codes in enumerate(codes, start=1)
+    ]
+
+
+class FakePlayerData:
+    def __init__(self, toon, race, replay_id, codes):
+        self.toon_race = str((toon, race))
+        self.replay_id = replay_id
+        self.n_grams = make_n_grams(codes)
+
+
+def make_config(budget, instance_based):
+    return {
+        "hyperparams": {"HIGHEST_N": HIGHEST_N},
+        "options": {
+            "NEIGHBOURS_TO_PRINT": 1,
+            "N_GRAM_CANDIDATE_BUDGET": budget,
+            "INSTANCE_BASED": instance_based,
+            "INSTANCE_TOP_K_GAMES": 1,
+        },
+    }
+
+
+@pytest.mark.parametrize("budget, instance_based", [(0, False), (1, False), (0, True)])
+def test_classify_after_another_race_grew_the_vocabulary(tmp_path, budget, instance_based):
+    config = make_config(budget, instance_based)
+    player_keys = PlayerKeys(str(tmp_path / "player_keys.txt"))
+    n_grams = NGrams(config, str(tmp_path), player_keys)
+    codes = [[1, 2], [3, 4], [5, 6], [7, 8]]
+    n_grams.enter_replay(FakePlayerData("1-S2-1-1", "Zerg", "a" * 32, codes))
+    n_grams.enter_replay(FakePlayerData("1-S2-1-2", "Zerg", "b" * 32, [[c + 5 for c in n] for n in codes]))
+    barcode = FakePlayerData("1-S2-1-3", "Zerg", "c" * 32, codes)
+    expected = n_gram_classify(config, FakeToonDirectory(), barcode, n_grams, False)
+
+    # The Zerg matrices are cached now, a Terran game then adds n_grams that none of the Zerg players have.
+    n_grams.enter_replay(FakePlayerData("1-S2-1-4", "Terran", "d" * 32, [[c + 10 for c in n] for n in codes]))
+    # The barcode also has those n_grams, which are not among the columns of the cached Zerg matrices.
+    barcode.n_grams = make_n_grams([n + [c + 10 for c in n] for n in codes])
+
+    assert expected == (str(("1-S2-1-1", "Zerg")), str(("1-S2-1-1", "Zerg")))
+    assert n_gram_classify(config, FakeToonDirectory(), barcode, n_grams, False) == expected
@@ -0,0 +1,137 @@
+import os
+
+import numpy as np
+from scipy import sparse
+
+from database.n_grams_class import NGrams
+from database.player_keys import PlayerKeys
+
+HIGHEST_N = 3
+BASE = 17
+CONFIG = {"hyperparams": {"HIGHEST_N": HIGHEST_N}}
+
+
+class FakePlayerData:
+    def __init__(self, rng, i):
+        self.toon_race = str((f"1-S2-1-{rng.integers(0, 6)}", ["Zerg", "Terran"][rng.integers(0, 2)]))
+        self.replay_id = f"{i:032x}"
+        self.n_grams = []
+        for n in range(1, HIGHEST_N + 1):
+            codes = np.unique(rng.integers(0, BASE**n, size=8))
+            counts = rng.integers(1, 4, size=len(codes)).astype(np.float32)
+            self.n_grams.append(sparse.csr_array((counts, codes, [0, len(codes)]), shape=(1, BASE**n)))
+
+
+def load_n_grams(tmp_path):
+    player_keys = PlayerKeys(str(tmp_path / "player_keys.txt"))
+    player_keys.load_from_file()
+    n_grams = NGrams(CONFIG, str(tmp_path), player_keys)
+    n_grams.load_from_file()
+    return n_grams
+
+
+def new_n_grams(tmp_path):
+    n_grams = load_n_grams(tmp_path)
+    n_grams.reset_files()
+    return n_grams
+
+
+def enter_games(n_grams, games, rng, first, n_games):
+    for i in range(first, first + n_games):
+        player_data = FakePlayerData(rng, i)
+        n_grams.enter_replay(player_data)
+        games[(player_data.toon_race, player_data.replay_id)] = player_data
+
+
+def remove_games(n_grams, games, n_games):
+    for key in list(games)[::3][:n_games]:
+        n_grams.remove_replay(*key)
+        del games[key]
+
+
+def assert_games_equal(n_grams, games):
+    assert len(n_grams.rows) == len(games)
+    for key, player_data in games.items():
+        for loaded, expected in zip(n_grams.get_replay_n_grams(*key), player_data.n_grams):
+            assert (loaded != expected).nnz == 0
+
+
+def assert_sums_equal(n_grams):
+    """Compares the sums with the sums of the games of each player, calculated from scratch."""
+    assert set(n_grams.sums[0]) == set(n_grams.rows_by_toon_race)
+    for i, matrix in enumerate(n_grams.matrices):
+        for toon_race_id, rows in n_grams.rows_by_toon_race.items():
+            expected = matrix.get_rows(rows).toarray().sum(axis=0)
+            loaded = n_grams.sums[i][toon_race_id].toarray().ravel()
+            assert np.array_equal(np.pad(loaded, (0, len(expected) - len(loaded))), expected)
+            assert n_grams.totals[i][toon_race_id] == expected.sum()
+
+
+def test_load_sums(tmp_path):
+    rng = np.random.default_rng(0)
+    n_grams = new_n_grams(tmp_path)
+    games = {}
+    for step in range(4):
+        enter_games(n_grams, games, rng, 10 * step, 10)
+        remove_games(n_grams, games, 2)
+        n_grams.save_to_file()
+    # A save with only removed games.
+    remove_games(n_grams, games, 3)
+    n_grams.save_to_file()
+
+    loaded = load_n_grams(tmp_path)
+    assert_games_equal(loaded, games)
+    assert_sums_equal(loaded)
+
+
+def test_background_compaction(tmp_path):
+    rng = np.random.default_rng(1)
+    n_grams = new_n_grams(tmp_path)
+    n_grams.SEGMENTS_TO_COMPACT = 2
+    games = {}
+    for step in range(3):
+        enter_games(n_grams, games, rng, 10 * step, 10)
+        remove_games(n_grams, games, 2)
+        n_grams.save_to_file()
+    compaction = n_grams._compaction
+    assert compaction is not None
+    # Games that are entered and removed while compacting are kept.
+    enter_games(n_grams, games, rng, 100, 5)
+    remove_games(n_grams, games, 4)
+    compaction["thread"].join()
+    n_grams.save_to_file()
+    assert n_grams.segment_names[0] == compaction["name"]
+    assert len(n_grams.segment_names) == 2
+    assert sorted(os.listdir(n_grams.segments_path)) == sorted(n_grams.segment_names)
+    assert len(n_grams.row_toon_race) == len(games) + len(n_grams.removed_rows)
+    assert_games_equal(n_grams, games)
+
+    loaded = load_n_grams(tmp_path)
+    assert_games_equal(loaded, games)
+    assert_sums_equal(loaded)
+
+
+def test_reload_after_interrupted_compaction(tmp_path):
+    rng = np.random.default_rng(2)
+    n_grams = new_n_grams(tmp_path)
+    n_grams.SEGMENTS_TO_COMPACT = 2
+    games = {}
+    for step in range(3):
+        enter_games(n_grams, games, rng, 10 * step, 10)
+        remove_games(n_grams, games, 2)
+        n_grams.save_to_file()
+    compaction = n_grams._compaction
+    compaction["thread"].join()
+    # The program is closed before the merged segment is swapped in, and it only wrote part of it.
+    os.remove(os.path.join(compaction["segment_path"], "rows.npy"))
+
+    loaded = load_n_grams(tmp_path)
+    assert loaded.segment_names == compaction["segment_names"]
+    assert_games_equal(loaded, games)
+    assert_sums_equal(loaded)
+    enter_games(loaded, games, rng, 100, 5)
+    loaded.save_to_file()
+    assert not os.path.exists(compaction["segment_path"])
+    assert_games_equal(load_n_grams(tmp_path), games)
+    if loaded._compaction is not None:
+        loaded._compaction["thread"].join()
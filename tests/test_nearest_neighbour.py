@@ -0,0 +1,34 @@
+import numpy as np
+
+from classifiers.nearest_neighbour import mean_feature_classify
+
+
+class FakeFeatureIndex:
+    """Stands in for a MeanFeatureIndex, with given distances to the barcode."""
+
+    def __init__(self, sq_dists, is_barcode):
+        self._sq_dists = np.array(sq_dists, dtype=np.float64)
+        self.is_barcode = np.array(is_barcode, dtype=bool)
+        self.toons = np.array([f"2-S2-1-{i}" for i in range(len(sq_dists))], dtype=object)
+        self.toon_races = np.array([str((toon, "Zerg")) for toon in self.toons], dtype=object)
+
+    def __len__(self):
+        return len(self.toon_races)
+
+    def sq_dists(self, features):
+        return self._sq_dists
+
+
+class FakePlayerData:
+    features = {}
+
+
+def test_classify_when_all_players_are_barcodes():
+    config = {"options": {"NEIGHBOURS_TO_PRINT": 5}}
+    feature_index = FakeFeatureIndex([3.0, 1.0, 2.0], [True, True, True])
+    toon_estimate, non_barcode_toon_estimate = mean_feature_classify(
+        config, None, FakePlayerData(), feature_index, to_visualize=False
+    )
+    assert toon_estimate == feature_index.toon_races[1]
+    assert non_barcode_toon_estimate is False
+
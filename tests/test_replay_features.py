@@ -0,0 +1,160 @@
+import os
+
+import numpy as np
+
+from database.player_keys import PlayerKeys
+from database.replay_features_class import ReplayFeatures
+
+
+class FakePlayerData:
+    def __init__(self, rng, i, n_features):
+        toon, race = f"1-S2-1-{rng.integers(0, 6)}", ["Zerg", "Terran"][rng.integers(0, 2)]
+        self.toon_race = str((toon, race))
+        self.replay_id = f"{i:032x}"
+        self.features = {"toon": toon, "race": race}
+        self.features.update({f"f{j}": float(np.float32(rng.normal(5, 3))) for j in range(n_features)})
+
+
+def load_replay_features(tmp_path):
+    player_keys = PlayerKeys(str(tmp_path / "player_keys.txt"))
+    player_keys.load_from_file()
+    replay_features = ReplayFeatures(str(tmp_path), player_keys)
+    replay_features.load_from_file()
+    return replay_features
+
+
+def new_replay_features(tmp_path):
+    replay_features = load_replay_features(tmp_path)
+    replay_features.reset_files()
+    return replay_features
+
+
+def enter_games(replay_features, games, rng, first, n_games, n_features=4):
+    for i in range(first, first + n_games):
+        player_data = FakePlayerData(rng, i, n_features)
+        replay_features.enter_replay(player_data)
+        games[(player_data.toon_race, player_data.replay_id)] = player_data
+
+
+def remove_games(replay_features, games, n_games):
+    for key in list(games)[::3][:n_games]:
+        replay_features.remove_replay(*key)
+        del games[key]
+
+
+def assert_games_equal(replay_features, games):
+    assert len(replay_features.rows) == len(games)
+    for key, player_data in games.items():
+        features = replay_features.get_replay_features(*key)
+        # Features that the game did not have are NaN.
+        features = {feature: value for feature, value in features.items() if not isinstance(value, float) or
+                    not np.isnan(value)}
+        assert features == player_data.features
+
+
+def test_segments_reload(tmp_path):
+    rng = np.random.default_rng(0)
+    replay_features = new_replay_features(tmp_path)
+    games = {}
+    for step in range(4):
+        # Later games have more features, the earlier segments do not have their columns.
+        enter_games(replay_features, games, rng, 10 * step, 10, n_features=4 + step)
+        remove_games(replay_features, games, 2)
+        replay_features.save_to_file()
+    assert len(replay_features.segment_names) == 4
+
+    loaded = load_replay_features(tmp_path)
+    assert loaded.columns == replay_features.columns
+    assert_games_equal(loaded, games)
+    for stat in ["mean", "std"]:
+        expected = replay_features.get_stats()[stat].sort_index()
+        assert np.allclose(loaded.get_stats()[stat].sort_index(), expected, equal_nan=True)
+
+    loaded.drop_columns(["f1"])
+    loaded.save_to_file()
+    assert len(loaded.segment_names) == 1
+    for player_data in games.values():
+        del player_data.features["f1"]
+    assert_games_equal(load_replay_features(tmp_path), games)
+
+
+def test_background_compaction(tmp_path):
+    rng = np.random.default_rng(1)
+    replay_features = new_replay_features(tmp_path)
+    replay_features.SEGMENTS_TO_COMPACT = 2
+    games = {}
+    for step in range(3):
+        enter_games(replay_features, games, rng, 10 * step, 10)
+        remove_games(replay_features, games, 2)
+        replay_features.save_to_file()
+    compaction = replay_features._compaction
+    assert compaction is not None
+    # Games that are entered and removed while compacting are kept.
+    enter_games(replay_features, games, rng, 100, 5)
+    remove_games(replay_features, games, 4)
+    compaction["thread"].join()
+    replay_features.save_to_file()
+    assert replay_features.segment_names[0] == compaction["name"]
+    assert len(replay_features.segment_names) == 2
+    assert sorted(os.listdir(replay_features.segments_path)) == sorted(replay_features.segment_names)
+    assert len(replay_features.row_toon_race) == len(games) + len(replay_features.removed_rows)
+    assert_games_equal(replay_features, games)
+    assert_games_equal(load_replay_features(tmp_path), games)
+
+
+def test_reload_after_interrupted_compaction(tmp_path):
+    rng = np.random.default_rng(2)
+    replay_features = new_replay_features(tmp_path)
+    replay_features.SEGMENTS_TO_COMPACT = 2
+    games = {}
+    for step in range(3):
+        enter_games(replay_features, games, rng, 10 * step, 10)
+        remove_games(replay_features, games, 2)
+        replay_features.save_to_file()
+    compaction = replay_features._compaction
+    compaction["thread"].join()
+    # The program is closed before the merged segment is swapped in, and it only wrote part of it.
+    os.remove(os.path.join(compaction["segment_path"], "values.npy"))
+
+    loaded = load_replay_features(tmp_path)
+    assert loaded.segment_names == compaction["segment_names"]
+    assert_games_equal(loaded, games)
+    enter_games(loaded, games, rng, 100, 5)
+    loaded.save_to_file()
+    assert not os.path.exists(compaction["segment_path"])
+    assert_games_equal(load_replay_features(tmp_path), games)
+    if loaded._compaction is not None:
+        loaded._compaction["thread"].join()
+
+
+def test_running_stats(tmp_path):
+    rng = np.random.default_rng(3)
+    replay_features = new_replay_features(tmp_path)
+    games = {}
+    for step in range(20):
+        enter_games(replay_features, games, rng, 10 * step, 10)
+        remove_games(replay_features, games, 4)
+    # Values that are missing are left out of the stats.
+    for i, player_data in enumerate(list(games.values())[:20]):
+        replay_features.remove_replay(player_data.toon_race, player_data.replay_id)
+        del player_data.features[f"f{i % 4}"]
+        replay_features.enter_replay(player_data)
+
+    stats = replay_features.get_stats()
+    columns = replay_features.columns
+    for toon_race_id, toon_race in enumerate(replay_features.player_keys.keys):
+        values = np.array(
+            [
+                [player_data.features.get(column, np.nan) for column in columns]
+                for player_data in games.values()
+                if player_data.toon_race == toon_race
+            ]
+        )
+        counts = (~np.isnan(values)).sum(axis=0)
+        expected_std = np.where(counts > 1, np.nanstd(values, axis=0, ddof=1), 0)
+        assert np.allclose(stats["mean"].loc[toon_race_id], np.nanmean(values, axis=0))
+        assert np.allclose(stats["std"].loc[toon_race_id], expected_std)
+        assert stats["general"].loc[toon_race_id, "n_games"] == len(values)
+    overall_stats = replay_features.get_overall_stats()
+    assert np.allclose(list(overall_stats["average_mean"].values()), stats["mean"].mean())
+    assert np.allclose(list(overall_stats["average_std"].values()), stats["std"].mean())
@@ -0,0 +1,94 @@
+import os
+
+from database.replay_hash import ReplayHash
+
+
+def make_replay_hash(tmp_path):
+    replay_hash = ReplayHash(str(tmp_path))
+    replay_hash.reset_file()
+    replay_hash.load_from_file()
+    return replay_hash
+
+
+def write_replays(tmp_path, n_replays):
+    replay_paths = []
+    for i in range(n_replays):
+        replay_path = str(tmp_path / f"replay_{i}.SC2Replay")
+        with open(replay_path, "wb") as outfile:
+            outfile.write(bytes([i]) * 100)
+        replay_paths.append(replay_path)
+    return replay_paths
+
+
+def test_fingerprints_are_only_saved_when_changed(tmp_path):
+    replay_hash = make_replay_hash(tmp_path)
+    replay_paths = write_replays(tmp_path, 3)
+    replay_hashes = replay_hash.get_hashes(replay_paths)
+    assert replay_hashes == [ReplayHash.hash_replay(replay_path) for replay_path in replay_paths]
+    replay_hash.save_to_file()
+    assert os.path.exists(replay_hash.fingerprints_file_path)
+
+    os.remove(replay_hash.fingerprints_file_path)
+    assert replay_hash.get_hashes(replay_paths) == replay_hashes
+    replay_hash.save_to_file()
+    assert not os.path.exists(replay_hash.fingerprints_file_path)
+
+
+def test_prune_fingerprints(tmp_path):
+    replay_hash = make_replay_hash(tmp_path)
+    replay_paths = write_replays(tmp_path, 3)
+    replay_hash.get_hashes(replay_paths)
+    replay_hash.save_to_file()
+
+    replay_hash.prune_fingerprints(replay_paths[1:])
+    replay_hash.save_to_file()
+    loaded = ReplayHash(str(tmp_path))
+    loaded.load_from_file()
+    assert set(loaded.fingerprints) == set(replay_paths[1:])
+
+
+def test_hashes_round_trip(tmp_path):
+    replay_hash = make_replay_hash(tmp_path)
+    hashes = [f"{i:032x}" for i in range(5)]
+    for hash_hex in hashes[:3]:
+        replay_hash.add_hash(hash_hex)
+    replay_hash.save_to_file()
+    # Only the new hashes are appended.
+    for hash_hex in hashes[3:]:
+        replay_hash.add_hash(hash_hex)
+    replay_hash.save_to_file()
+    assert os.path.getsize(replay_hash.file_path) == 5 * 16
+
+    loaded = ReplayHash(str(tmp_path))
+    loaded.load_from_file()
+    assert all(loaded.in_db(hash_hex) for hash_hex in hashes)
+
+    loaded.remove_replay(hashes[1])
+    loaded.save_to_file()
+    assert os.path.getsize(loaded.file_path) == 4 * 16
+    reloaded = ReplayHash(str(tmp_path))
+    reloaded.load_from_file()
+    assert [reloaded.in_db(hash_hex) for hash_hex in hashes] == [True, False, True, True, True]
+
+
+def test_incomplete_hash_is_cut_off(tmp_path):
+    replay_hash = make_replay_hash(tmp_path)
+    replay_hash.add_hash("ab" * 16)
+    replay_hash.save_to_file()
+    with open(replay_hash.file_path, "ab") as outfile:
+        outfile.write(b"\x01\x02\x03")
+    loaded = ReplayHash(str(tmp_path))
+    loaded.load_from_file()
+    assert loaded.hashes == {bytes.fromhex("ab" * 16)}
+    assert os.path.getsize(loaded.file_path) == 16
+
+
+def test_convert_legacy_file(tmp_path):
+    hashes = {"cd" * 16, "ef" * 16}
+    with open(tmp_path / "replay_hashes.txt", "w") as outfile:
+        outfile.write(str(hashes))
+    replay_hash = ReplayHash(str(tmp_path))
+    replay_hash.load_from_file()
+    assert all(replay_hash.in_db(hash_hex) for hash_hex in hashes)
+    assert not os.path.exists(tmp_path / "replay_hashes.txt")
+    assert os.path.getsize(replay_hash.file_path) == 2 * 16
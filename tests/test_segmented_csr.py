@@ -0,0 +1,54 @@
+import numpy as np
+from scipy import sparse
+
+from database.segmented_csr import SegmentedCSR
+
+
+def random_rows(rng, n_rows, n_cols):
+    return sparse.csr_array(rng.integers(0, 3, size=(n_rows, n_cols)).astype(np.float32))
+
+
+def test_append_save_and_load(tmp_path):
+    rng = np.random.default_rng(0)
+    matrix = SegmentedCSR()
+    expected = []
+    for i, n_cols in enumerate([4, 6, 9]):
+        rows = random_rows(rng, 3 + i, n_cols)
+        matrix.append_rows(rows)
+        expected.append(rows.toarray())
+        # The last rows stay unsaved.
+        if i < 2:
+            segment_path = tmp_path / str(i)
+            segment_path.mkdir()
+            matrix.save_tail(str(segment_path), "1_gram")
+    # The older rows have zeros in the columns that were added later.
+    expected = np.vstack([np.pad(rows, ((0, 0), (0, 9 - rows.shape[1]))) for rows in expected])
+    assert matrix.n_rows == len(expected) and matrix.n_saved_rows == 7 and matrix.n_cols == 9
+    assert np.array_equal(matrix.to_csr().toarray(), expected)
+    rows = [9, 0, 4, 11, 3]
+    assert np.array_equal(matrix.get_rows(rows).toarray(), expected[rows])
+
+    loaded = SegmentedCSR()
+    for i in range(2):
+        loaded.add_part(SegmentedCSR.load_part(str(tmp_path / str(i)), "1_gram", 9))
+    assert np.array_equal(loaded.to_csr().toarray(), expected[:7])
+
+    picker = sparse.csr_array(rng.integers(0, 2, size=(2, matrix.n_rows)).astype(np.float32))
+    assert np.allclose(matrix.left_multiply(picker).toarray(), picker.toarray() @ expected)
+
+
+def test_replace_rows(tmp_path):
+    rng = np.random.default_rng(1)
+    matrix = SegmentedCSR()
+    expected = []
+    for i in range(3):
+        rows = random_rows(rng, 4, 5)
+        matrix.append_rows(rows)
+        expected.append(rows.toarray())
+        segment_path = tmp_path / str(i)
+        segment_path.mkdir()
+        matrix.save_tail(str(segment_path), "1_gram")
+    expected = np.vstack(expected)
+    # The first 6 rows (the first part and half of the second) are replaced by 2 of them.
+    matrix.replace_rows(6, sparse.csr_array(expected[[1, 4]]))
+    assert np.array_equal(matrix.to_csr().toarray(), expected[[1, 4, 6, 7, 8, 9, 10, 11]])